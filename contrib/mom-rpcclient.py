@@ -57,6 +57,26 @@ def getStatistics(mom):
         print "\nGuest %s:\n=======%s" % (key, len(key)*'=')
         _print_stats(val)
 
+def getPolicyProfile(mom):
+    profile = mom.getPolicyProfile()
+    if len(profile) == 0:
+        print "Policy profiling is disabled (see policy-profile-ticks)"
+        return
+    print "Policy profile for the last %i evaluations" % profile['ticks']
+    for (kind, title) in (('functions', 'Function'), ('forms', 'Form'),
+                          ('lines', 'Line')):
+        entries = profile[kind].items()
+        if len(entries) == 0:
+            continue
+        # Most expensive first
+        entries.sort(key=lambda (name, entry): entry['self'], reverse=True)
+        print "\n%-24s %10s %12s %12s" % (title, 'Calls', 'Total (ms)',
+                                          'Self (ms)')
+        for (name, entry) in entries:
+            print "%-24s %10i %12.3f %12.3f" % (name, entry['calls'],
+                                              entry['total'] * 1000,
+                                              entry['self'] * 1000)
+
 def getActiveGuests(mom):
     guests = mom.getActiveGuests()
     for guest in guests:
@@ -86,6 +106,8 @@ def main():
                     const='get_statistics', help='(No arguments) Get the latest host and guest statistics')
     cmds.add_option('--get-active-guests', dest='cmd', action='append_const',
                     const='get_active_guests', help='(No arguments) Get a list of guests that are being actively managed')
+    cmds.add_option('--policy-profile', dest='cmd', action='append_const',
+                    const='policy_profile', help='(No arguments) Show where the policy spends its time (requires policy-profile-ticks)')
     parser.add_option_group(cmds)
     (options, args) = parser.parse_args()
 
@@ -110,6 +132,8 @@ def main():
             getStatistics(mom)
         elif options.cmd[0] == 'get_active_guests':
             getActiveGuests(mom)
+        elif options.cmd[0] == 'policy_profile':
+            getPolicyProfile(mom)
     except Exception, e:
         print "Command '%s' failed: %s" % (options.cmd[0], e)
         sys.exit(1)
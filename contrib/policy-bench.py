@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+# Memory Overcommitment Manager
+# Copyright (C) 2010 Adam Litke, IBM Corporation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public
+# License along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""
+Microbenchmarks for the MOM policy engine.  Run from the top of the source tree:
+    python contrib/policy-bench.py --dispatch
+    python contrib/policy-bench.py --policy doc/balloon.rules --guests 400
+"""
+
+import sys
+import os
+import time
+import random
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from mom.Entity import Entity
+from mom.Policy import Parser
+from mom.Policy.Policy import Policy
+
+def timeit(fn, count):
+    start = time.time()
+    for i in xrange(count):
+        fn()
+    return (time.time() - start) / count
+
+def report(name, secs):
+    print "%-40s %10.2f usec" % (name, secs * 1000000)
+
+class DocParsingEvaluator(Parser.Evaluator):
+    """
+    An Evaluator that parses the signature docstring on every special form
+    call, as the dispatcher did before signatures were kept in a table.
+    """
+    def _dispatch(self, name, args):
+        fn = self.signatures[name][0]
+        self.signatures[name] = (fn, self.parse_signature(fn.__doc__))
+        return Parser.Evaluator._dispatch(self, name, args)
+
+def bench_dispatch(count):
+    code = Parser.get_code(Parser.Evaluator(), "(if 1 2 3)")[0]
+    for (name, cls) in (('docstring parsed per call', DocParsingEvaluator),
+                        ('dispatch table', Parser.Evaluator)):
+        e = cls()
+        report("(if 1 2 3): %s" % name, timeit(lambda: e.eval(code), count))
+
+def make_entity(rng, stats):
+    entity = Entity()
+    rows = []
+    for i in range(10):
+        row = {}
+        for (key, (lo, hi)) in stats.items():
+            row[key] = rng.randint(lo, hi)
+        rows.append(row)
+    entity._set_statistics(rows)
+    entity._finalize()
+    return entity
+
+def bench_policy(fname, nr_guests, count):
+    f = open(fname, 'r')
+    policy_str = f.read()
+    f.close()
+
+    rng = random.Random(0)
+    host_stats = { 'mem_available': (8000000, 8000000),
+                   'mem_free': (500000, 2000000),
+                   'ksm_shareable': (0, 4000000),
+                   'ksm_pages_to_scan': (64, 1250) }
+    guest_stats = { 'balloon_cur': (900000, 1000000),
+                    'balloon_max': (1000000, 1000000),
+                    'mem_unused': (1000, 500000) }
+    host = make_entity(rng, host_stats)
+    guests = [ make_entity(rng, guest_stats) for i in range(nr_guests) ]
+
+    for compiled in (False, True):
+        policy = Policy(policy_str, compiled)
+        secs = timeit(lambda: policy.evaluate(host, guests), count)
+        mode = compiled and 'compiled' or 'interpreted'
+        report("%s, %i guests: %s" % (os.path.basename(fname), nr_guests,
+                                      mode), secs)
+
+def main():
+    parser = OptionParser("usage: %prog [options]")
+    parser.add_option('--dispatch', dest='dispatch', action='store_true',
+                      help='Measure the per-call overhead of special forms')
+    parser.add_option('--policy', dest='policy', metavar='FILE',
+                      help='Measure the evaluation time of the policy in FILE')
+    parser.add_option('--guests', dest='guests', type='int', default=100,
+                      help='Number of simulated guests [%default]')
+    parser.add_option('-n', '--count', dest='count', type='int', default=10,
+                      help='Number of iterations (x1000 for --dispatch) '
+                           '[%default]')
+    (options, args) = parser.parse_args()
+    if not options.dispatch and options.policy is None:
+        parser.error("Select at least one benchmark")
+
+    if options.dispatch:
+        bench_dispatch(options.count * 1000)
+    if options.policy is not None:
+        bench_policy(options.policy, options.guests, options.count)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+# Memory Overcommitment Manager
+# Copyright (C) 2010 Adam Litke, IBM Corporation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public
+# License along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+"""
+Microbenchmark for reading statistics from /proc/meminfo and /proc/vmstat.  It
+compares a regular expression search per field over the file contents with the
+one pass parser in mom.Collectors.ProcFile.  Run from the top of the source
+tree:
+    python contrib/procfs-bench.py --count 10000
+"""
+
+import sys
+import os
+import time
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from mom.Collectors.Collector import parse_int
+from mom.Collectors.ProcFile import ProcFile
+
+meminfo_keys = [ 'MemTotal', 'AnonPages', 'MemFree', 'Buffers', 'Cached' ]
+vmstat_keys = [ 'pswpin', 'pswpout', 'pgfault', 'pgmajfault' ]
+
+def timeit(fn, count):
+    start = time.time()
+    for i in xrange(count):
+        fn()
+    return (time.time() - start) / count
+
+def report(name, secs):
+    print "%-40s %10.2f usec" % (name, secs * 1000000)
+
+def regex_reader(path, keys, suffix):
+    f = open(path, 'r')
+    def read():
+        f.seek(0)
+        contents = f.read()
+        return dict([ (key, parse_int("^%s%s (.*)%s" % (key, suffix[0],
+                                      suffix[1]), contents)) for key in keys ])
+    return read
+
+def main():
+    cmdline = OptionParser()
+    cmdline.add_option('-c', '--count', dest='count', type='int',
+                       default=10000, help='Number of iterations')
+    (options, args) = cmdline.parse_args()
+
+    for (path, keys, suffix) in (('/proc/meminfo', meminfo_keys, (':', ' kB')),
+                                 ('/proc/vmstat', vmstat_keys, ('', ''))):
+        regex = regex_reader(path, keys, suffix)
+        procfile = ProcFile(path, keys)
+        assert sorted(regex()) == sorted(procfile.read())
+        report("%s: parse_int per field" % path, timeit(regex, options.count))
+        report("%s: ProcFile" % path, timeit(procfile.read, options.count))
+
+if __name__ == "__main__":
+    main()
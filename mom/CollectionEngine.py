@@ -0,0 +1,249 @@
+# Memory Overcommitment Manager
+# Copyright (C) 2010 Adam Litke, IBM Corporation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public
+# License along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+
+import threading
+import time
+import os
+import fcntl
+import errno
+import heapq
+import select
+import logging
+import Queue
+from mom.Collectors.Collector import CollectionError, Wait
+
+class Task(object):
+    """
+    One collection by one Collector
+    """
+    def __init__(self, collector, deadline, callback):
+        self.collector = collector
+        self.deadline = deadline
+        self.callback = callback
+        self.gen = None
+        self.fd = None
+        self.done = False
+
+class CollectionEngine(threading.Thread):
+    """
+    The CollectionEngine runs many collections concurrently on one thread.
+
+    A Collector may provide collect_async(), a generator that yields a Wait
+    for each file it needs to read or write and finally yields its dictionary
+    of statistics.  The engine polls all waiting files at once and resumes
+    each collection when its file is ready.  Collectors which only provide
+    collect() are run on a pool of executor threads instead.
+
+    Every collection must finish before its timeout.  Otherwise it fails with
+    a CollectionError.  The results of collectors that are run by executors
+    are discarded when they arrive late.  Such a collector is not run again
+    until its late call returns, so a collector that hangs only ties up one
+    executor.
+
+    Callbacks are called on the engine thread with (data, error).
+    """
+    def __init__(self, name, nr_executors, timeout):
+        threading.Thread.__init__(self, name=name)
+        self.setDaemon(True)
+        self.logger = logging.getLogger('mom.CollectionEngine')
+        self.timeout = timeout
+        self.running = True
+        self.poller = select.poll()
+        # Tasks waiting on a file, indexed by file descriptor
+        self.waiting = {}
+        # (deadline, sequence, task) for every unfinished task
+        self.deadlines = []
+        self.seq = 0
+        # Tasks to start and results from executors, passed in from other
+        # threads.  A byte written to the pipe wakes up the engine.
+        self.incoming = Queue.Queue()
+        (self.wakeup_r, self.wakeup_w) = os.pipe()
+        for fd in (self.wakeup_r, self.wakeup_w):
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        self.poller.register(self.wakeup_r, select.POLLIN)
+        self.executor_queue = Queue.Queue()
+        # Collectors that have been handed to an executor and have not
+        # returned yet
+        self.busy = set()
+        self.executors = []
+        for i in range(nr_executors):
+            executor = threading.Thread(target=self._executor,
+                                        name="%s-executor-%i" % (name, i))
+            executor.setDaemon(True)
+            self.executors.append(executor)
+
+    def submit(self, collector, callback):
+        """
+        Start a collection.  This may be called from any thread.
+        """
+        self.incoming.put(('start', collector, callback))
+        self._wakeup()
+
+    def _wakeup(self):
+        try:
+            os.write(self.wakeup_w, '.')
+        except OSError, e:
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def _executor(self):
+        """
+        Run a synchronous collector and pass its result back to the engine
+        """
+        while True:
+            task = self.executor_queue.get()
+            if task is None:
+                break
+            if task.done:
+                # Let the engine know that the collector is free again
+                self.incoming.put(('result', task, None, None))
+                self._wakeup()
+                continue
+            try:
+                self.incoming.put(('result', task, task.collector.collect(),
+                                   None))
+            except Exception, e:
+                self.incoming.put(('result', task, None, e))
+            self._wakeup()
+
+    def _start(self, collector, callback):
+        task = Task(collector, time.time() + self.timeout, callback)
+        self.seq += 1
+        heapq.heappush(self.deadlines, (task.deadline, self.seq, task))
+        if hasattr(collector, 'collect_async'):
+            try:
+                task.gen = collector.collect_async()
+            except Exception, e:
+                self._finish(task, None, e)
+                return
+            self._step(task)
+        elif collector in self.busy:
+            self._finish(task, None, CollectionError("Collector %s is still "
+                         "running" % collector.__class__.__name__))
+        else:
+            self.busy.add(collector)
+            self.executor_queue.put(task)
+
+    def _finish(self, task, data, error):
+        if task.done:
+            return
+        task.done = True
+        if task.fd is not None:
+            self.poller.unregister(task.fd)
+            del self.waiting[task.fd]
+            task.fd = None
+        if task.gen is not None:
+            task.gen.close()
+        try:
+            task.callback(data, error)
+        except Exception, e:
+            self.logger.error("Unexpected error in collection callback: %s", e)
+
+    def _step(self, task):
+        """
+        Resume an asynchronous collection until it waits or finishes
+        """
+        try:
+            item = task.gen.next()
+        except StopIteration:
+            self._finish(task, None, CollectionError("Collector %s returned "
+                         "no data" % task.collector.__class__.__name__))
+            return
+        except Exception, e:
+            self._finish(task, None, e)
+            return
+        if not isinstance(item, Wait):
+            self._finish(task, item, None)
+            return
+        fd = item.fd
+        if not isinstance(fd, int):
+            fd = fd.fileno()
+        if fd in self.waiting:
+            self._finish(task, None, CollectionError("File %i is already "
+                         "being waited on" % fd))
+            return
+        task.fd = fd
+        self.waiting[fd] = task
+        if item.write:
+            self.poller.register(fd, select.POLLOUT)
+        else:
+            self.poller.register(fd, select.POLLIN)
+
+    def _resume(self, fd):
+        task = self.waiting.pop(fd)
+        self.poller.unregister(fd)
+        task.fd = None
+        self._step(task)
+
+    def _process_incoming(self):
+        try:
+            os.read(self.wakeup_r, 4096)
+        except OSError, e:
+            if e.errno != errno.EAGAIN:
+                raise
+        while True:
+            try:
+                msg = self.incoming.get_nowait()
+            except Queue.Empty:
+                break
+            if msg[0] == 'start':
+                self._start(msg[1], msg[2])
+            else:
+                self.busy.discard(msg[1].collector)
+                self._finish(msg[1], msg[2], msg[3])
+
+    def _expire(self, now):
+        """
+        Fail all tasks which have passed their deadline.
+        Return: The number of seconds until the next deadline or None
+        """
+        while len(self.deadlines) > 0:
+            (deadline, seq, task) = self.deadlines[0]
+            if task.done:
+                heapq.heappop(self.deadlines)
+            elif deadline <= now:
+                heapq.heappop(self.deadlines)
+                self._finish(task, None, CollectionError("Collector %s timed "
+                             "out" % task.collector.__class__.__name__))
+            else:
+                return deadline - now
+        return None
+
+    def run(self):
+        for executor in self.executors:
+            executor.start()
+        while self.running:
+            timeout = self._expire(time.time())
+            if timeout is None or timeout > 1:
+                timeout = 1
+            try:
+                events = self.poller.poll(timeout * 1000)
+            except select.error, e:
+                if e[0] == errno.EINTR:
+                    continue
+                raise
+            for (fd, event) in events:
+                if fd == self.wakeup_r:
+                    self._process_incoming()
+                elif fd in self.waiting:
+                    self._resume(fd)
+        for executor in self.executors:
+            self.executor_queue.put(None)
+
+    def stop(self):
+        self.running = False
+        self._wakeup()
@@ -23,7 +23,19 @@ class Collector:
     Collectors are plugins that return a specific set of data items pertinent to
     a given Monitor object every time their collect() method is called.  Context
     is given by the Monitor properties that are used to init the Collector.
+
+    Collectors that spend their time waiting on sockets or pipes may also
+    provide collect_async(), a generator which yields a Wait for each file it
+    needs to read from or write to and finally yields the dictionary of
+    statistics.  It is used instead of collect() when the collection engine is
+    enabled.
+
+    Collectors normally run in every collection of their Monitor.  If the
+    collector's config section sets an interval, collect_interval is set and
+    the collector is only run once per that many seconds.
     """
+    collect_interval = 0
+
     def __init__(self, properties):
         """
         The Collector constructor should use the passed-in properties to
@@ -78,13 +90,18 @@ def get_collectors(config_str, properties, global_config):
         
         # Check for Collector-specific configuration in the global config
         section = "Collector: %s" % name
+        interval = 0
         if global_config.has_section(section):
             properties['config'] = dict(global_config.items(section))
+            if global_config.has_option(section, 'interval'):
+                interval = global_config.getfloat(section, 'interval')
 
         # Create an instance
         try:
             module = __import__('mom.Collectors.' + name, None, None, name)
-            collectors.append(module.instance(properties))
+            collector = module.instance(properties)
+            collector.collect_interval = interval
+            collectors.append(collector)
         except ImportError:
             logger.warn("Unable to import collector: %s", name)
             return None
@@ -104,6 +121,9 @@ class CollectionError(Exception):
     def __init__(self, msg):
         self.msg = msg
 
+    def __str__(self):
+        return str(self.msg)
+
 class FatalError(Exception):
     """
     This exception should be raised if a Collector has a permanent problem that
@@ -112,6 +132,18 @@ class FatalError(Exception):
     def __init__(self, msg):
         self.msg = msg
 
+    def __str__(self):
+        return str(self.msg)
+
+class Wait:
+    """
+    Yielded by collect_async() to wait until a file (a descriptor or an object
+    with a fileno() method) is ready for reading or, if write is set, writing.
+    """
+    def __init__(self, fd, write=False):
+        self.fd = fd
+        self.write = write
+
 #
 # Collector utility functions
 #
@@ -15,6 +15,11 @@
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
 
 import sys
+import os
+import errno
+import time
+import random
+import threading
 import signal
 import socket
 from subprocess import *
@@ -22,6 +27,7 @@ import ConfigParser
 import logging
 from mom.Collectors.Collector import *
 from mom.Collectors.HostMemory import HostMemory
+from mom.Collectors.ProcFile import ProcFile
 
 def sock_send(conn, msg):
     """
@@ -143,8 +149,57 @@ class GuestNetworkDaemon(Collector):
                                   (self.name, msg))
 
         self.state = 'ok'
+        return self.parse_stats(data)
 
-        # Parse the data string
+    def collect_async(self):
+        if self.state == 'dead':
+            yield {}
+            return
+        if self.ip is None:
+            self.state = 'dead'
+            raise CollectionError('No IP address for guest %s' % self.name)
+
+        data = ""
+        try:
+            if self.socket is None:
+                self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                self.socket.setblocking(0)
+                err = self.socket.connect_ex((self.ip, self.port))
+                if err == errno.EINPROGRESS:
+                    yield Wait(self.socket, write=True)
+                    err = self.socket.getsockopt(socket.SOL_SOCKET,
+                                                 socket.SO_ERROR)
+                if err != 0:
+                    raise socket.error(err, os.strerror(err))
+            msg = "stats\n"
+            while len(msg) > 0:
+                yield Wait(self.socket, write=True)
+                msg = msg[self.socket.send(msg):]
+            while data[-1:] != '\n':
+                yield Wait(self.socket)
+                chunk = self.socket.recv(4096)
+                if chunk == '':
+                    raise socket.error("Unable to receive on socket")
+                data = data + chunk
+        except socket.error, msg:
+            sock_close(self.socket)
+            self.socket = None
+            raise CollectionError('Network communication to %s failed: %s' %
+                                  (self.name, msg))
+        except GeneratorExit:
+            # Abandoned part way through a request.  Don't let the reply to it
+            # be mistaken for the reply to the next one.
+            sock_close(self.socket)
+            self.socket = None
+            raise
+
+        self.state = 'ok'
+        yield self.parse_stats(data.rstrip("\n"))
+
+    def parse_stats(self, data):
+        """
+        Parse a reply of the form "name:value,name:value" from the guest
+        """
         result = {}
         for item in data.split(","):
             parts = item.split(":")
@@ -171,49 +226,107 @@ def instance(properties):
 class _Server:
     """
     A simple TCP server that implements the guest side of the guest network
-    Collector.
+    Collector.  Each connection is served by a thread of its own.  At most
+    max-sessions connections are served at once and further connections are
+    closed right away.  A connection that sends no request for
+    session-timeout seconds is closed.  The stats response is cached for
+    stats-ttl seconds so that a burst of requests only reads /proc once.
     """
     def __init__(self, config):
         self.config = config
         self.logger = logging.getLogger('mom.Collectors.GuestNetworkDaemon.Server')
         # Borrow a HostMemory Collector to get the needed data
         self.collector = HostMemory(None)
-        self.vmstat = open_datafile("/proc/vmstat")
+        self.vmstat = ProcFile("/proc/vmstat", [ 'pgfault', 'pgmajfault' ])
 
         # Socket Setup
         self.listen_ip = config.get('main', 'host')
         self.listen_port = config.getint('main', 'port')
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.socket.bind((self.listen_ip, self.listen_port))
-        self.socket.listen(1)
+        self.socket.listen(16)
         self.min_free = config.get('main', 'min_free')
         self.max_free = config.get('main', 'max_free')
 
+        self.sessions = threading.Semaphore(config.getint('main',
+                                                          'max-sessions'))
+        self.session_timeout = config.getfloat('main', 'session-timeout')
+
+        self.stats_ttl = config.getfloat('main', 'stats-ttl')
+        self.stats = None
+        self.stats_time = 0
+        self.stats_lock = threading.Lock()
+
+        # Request counters: the number served, the number answered from the
+        # cache and the total and maximum time taken (in seconds)
+        self.counters = { 'requests': 0, 'cache_hits': 0, 'total_time': 0.0,
+                          'max_time': 0.0 }
+        self.counters_lock = threading.Lock()
+
     def __del__(self):
         sock_close(self.socket)
-        if self.vmstat is not None:    
-            self.vmstat.close()
 
     def send_props(self, conn):
         response = "min_free:" + self.min_free + ",max_free:" + self.max_free
         sock_send(conn, response)
 
+    def get_stats(self):
+        """
+        Return: The stats response, read from /proc at most once per stats-ttl
+        and a flag telling whether it came from the cache
+        """
+        self.stats_lock.acquire()
+        try:
+            if self.stats is not None and \
+                    time.time() - self.stats_time < self.stats_ttl:
+                return (self.stats, True)
+            data = self.collector.collect()
+            vmstat = self.vmstat.read()
+            minflt = vmstat['pgfault']
+            majflt = vmstat['pgmajfault']
+
+            self.stats = "mem_available:%i,mem_unused:%i,swap_in:%i," \
+                         "swap_out:%i,major_fault:%i,minor_fault:%i" % \
+                         (data['mem_available'], data['mem_free'], \
+                          data['swap_in'], data['swap_out'], majflt, minflt)
+            self.stats_time = time.time()
+            return (self.stats, False)
+        finally:
+            self.stats_lock.release()
+
     def send_stats(self, conn):
-        data = self.collector.collect()
-        self.vmstat.seek(0)
-        contents = self.vmstat.read()
-        minflt = parse_int("^pgfault (.*)", contents)
-        majflt = parse_int("^pgmajfault (.*)", contents)
-
-        response = "mem_available:%i,mem_unused:%i,swap_in:%i,swap_out:%i," \
-                   "major_fault:%i,minor_fault:%i" % \
-                   (data['mem_available'], data['mem_free'], data['swap_in'], \
-                    data['swap_out'], majflt, minflt)
+        start = time.time()
+        (response, cached) = self.get_stats()
+        sock_send(conn, response)
+        self.count_request(time.time() - start, cached)
+
+    def count_request(self, elapsed, cached):
+        self.counters_lock.acquire()
+        self.counters['requests'] += 1
+        if cached:
+            self.counters['cache_hits'] += 1
+        self.counters['total_time'] += elapsed
+        self.counters['max_time'] = max(self.counters['max_time'], elapsed)
+        self.counters_lock.release()
+
+    def send_counters(self, conn):
+        self.counters_lock.acquire()
+        response = ",".join([ "%s:%s" % item for item in
+                              sorted(self.counters.items()) ])
+        self.counters_lock.release()
         sock_send(conn, response)
 
     def session(self, conn, addr):
         self.logger.debug("Connection received from %s", addr)
-        conn.settimeout(10)
+        conn.settimeout(self.session_timeout)
+        try:
+            self.serve(conn)
+        finally:
+            sock_close(conn)
+            self.sessions.release()
+        self.logger.debug("Connection closed")
+
+    def serve(self, conn):
         while self.running:
             try:
                 cmd = sock_receive(conn)
@@ -221,19 +334,60 @@ class _Server:
                     self.send_props(conn)
                 elif cmd == "stats":
                     self.send_stats(conn)
+                elif cmd == "counters":
+                    self.send_counters(conn)
                 else:
                     break
             except socket.error, msg:
                 self.logger.warn("Exception: %s" % msg)
                 break
-        sock_close(conn)
-        self.logger.debug("Connection closed")
 
     def run(self):
         self.logger.info("Server starting")
         self.running = True
         while self.running:
             (conn, addr) = self.socket.accept()
-            self.session(conn, addr)
+            if not self.sessions.acquire(False):
+                self.logger.warn("Too many connections, closing connection "
+                                 "from %s", addr)
+                sock_close(conn)
+                continue
+            session = threading.Thread(target=self.session, args=(conn, addr))
+            session.setDaemon(True)
+            session.start()
         sock_close(self.socket)
 
+class _Pusher(threading.Thread):
+    """
+    Push the statistics of a _Server to the GuestNetworkPush listener on the
+    host every push-interval seconds.  Samples are sent as UDP datagrams which
+    carry a session (a random number chosen when this daemon starts) and a
+    sequence number so the host can discard samples that arrive late or
+    twice.
+    """
+    def __init__(self, config, server):
+        threading.Thread.__init__(self, name='GuestNetworkDaemon.Pusher')
+        self.setDaemon(True)
+        self.logger = logging.getLogger('mom.Collectors.GuestNetworkDaemon.Pusher')
+        self.server = server
+        self.address = (config.get('main', 'push-host'),
+                        config.getint('main', 'push-port'))
+        self.interval = config.getfloat('main', 'push-interval')
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.session = random.SystemRandom().getrandbits(32)
+        self.seq = 0
+
+    def push(self):
+        (stats, cached) = self.server.get_stats()
+        self.seq += 1
+        msg = "session:%i,seq:%i,%s" % (self.session, self.seq, stats)
+        self.socket.sendto(msg, self.address)
+
+    def run(self):
+        self.logger.info("Pushing statistics to %s:%i", *self.address)
+        while True:
+            try:
+                self.push()
+            except socket.error, msg:
+                self.logger.warn("Unable to push statistics: %s", msg)
+            time.sleep(self.interval)
@@ -0,0 +1,229 @@
+# Memory Overcommitment Manager
+# Copyright (C) 2010 Adam Litke, IBM Corporation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public
+# License along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+
+import time
+import threading
+import socket
+import logging
+from mom.Collectors.Collector import *
+from mom.Collectors.GuestNetworkDaemon import GuestNetworkDaemon
+
+class GuestNetworkPush(GuestNetworkDaemon):
+    """
+    The push mode counterpart of the GuestNetworkDaemon Collector.  Rather than
+    being polled, mom-guestd sends a sample of its statistics at its own
+    push-interval to one UDP listener on the host which is shared by all
+    guests and closed when the last of them is gone.  Samples are matched to
+    guests by their source address and the latest one is returned by
+    collect(), so a collection never waits on the network.  A guest that has
+    not sent a sample within max-age seconds is reported as a
+    CollectionError.
+    """
+    def __init__(self, properties):
+        self.logger = logging.getLogger('mom.Collectors.GuestNetworkPush')
+        self.name = properties['name']
+        self.ip = self.get_guest_ip(properties)
+        config = properties.get('config', {})
+        self.max_age = float(config.get('max-age', 15))
+        self.listener = None
+        try:
+            self.listener = get_listener(config.get('listen-host', ''),
+                                         int(config.get('listen-port', 2188)))
+        except socket.error, msg:
+            self.ip = None
+            raise FatalError('Cannot listen for pushed statistics: %s' % msg)
+        if self.ip is not None:
+            self.listener.register(self.ip)
+
+    def __del__(self):
+        if self.listener is None:
+            return
+        if self.ip is not None:
+            self.listener.unregister(self.ip)
+        release_listener()
+
+    def collect(self):
+        if self.ip is None:
+            raise CollectionError('No IP address for guest %s' % self.name)
+        sample = self.listener.get(self.ip)
+        if sample is None:
+            raise CollectionError('No statistics received from %s' % self.name)
+        (received, values) = sample
+        if time.time() - received > self.max_age:
+            raise CollectionError('Statistics from %s are stale' % self.name)
+        ret = {}
+        for key in self.getFields():
+            if key in values:
+                ret[key] = values[key]
+        return ret
+
+    def collect_async(self):
+        # Samples arrive on the listener thread so there is nothing to wait for
+        yield self.collect()
+
+_listener = None
+_listener_refs = 0
+_listener_lock = threading.Lock()
+
+def get_listener(host, port):
+    """
+    Return: The listener for pushed samples, started on first use.  Each call
+    must be matched by a call to release_listener().
+    """
+    global _listener, _listener_refs
+    _listener_lock.acquire()
+    try:
+        if _listener is None:
+            _listener = _PushListener(host, port)
+        _listener_refs += 1
+        return _listener
+    finally:
+        _listener_lock.release()
+
+def release_listener():
+    """
+    Stop the listener and close its socket once it is no longer used
+    """
+    global _listener, _listener_refs
+    _listener_lock.acquire()
+    try:
+        _listener_refs -= 1
+        if _listener_refs == 0:
+            _listener.stop()
+            _listener = None
+    finally:
+        _listener_lock.release()
+
+class _PushListener(threading.Thread):
+    """
+    Receive samples pushed by guests.  Each datagram is a message of the form
+    "session:N,seq:N,name:value,..." where session identifies one run of the
+    guest daemon and seq increases by one for each sample it sends.  Samples
+    from unregistered addresses and samples which arrive out of order are
+    dropped.
+    """
+    def __init__(self, host, port):
+        threading.Thread.__init__(self, name='GuestNetworkPush')
+        self.setDaemon(True)
+        self.logger = logging.getLogger('mom.Collectors.GuestNetworkPush')
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.bind((host, port))
+        self.running = True
+        self.lock = threading.Lock()
+        # Registered guests: ip -> [session, seq, received, data]
+        self.guests = {}
+        # The number of collectors registered for each ip
+        self.refs = {}
+        # Samples that were discarded and samples that never arrived
+        self.dropped = 0
+        self.lost = 0
+        self.start()
+
+    def register(self, ip):
+        self.lock.acquire()
+        if ip in self.refs:
+            self.refs[ip] += 1
+        else:
+            self.refs[ip] = 1
+            self.guests[ip] = [ None, None, None, None ]
+        self.lock.release()
+
+    def unregister(self, ip):
+        self.lock.acquire()
+        self.refs[ip] -= 1
+        if self.refs[ip] == 0:
+            del self.refs[ip]
+            del self.guests[ip]
+        self.lock.release()
+
+    def get(self, ip):
+        """
+        Return: The time the latest sample from a guest was received and its
+        statistics or None
+        """
+        self.lock.acquire()
+        try:
+            guest = self.guests.get(ip)
+            if guest is None or guest[3] is None:
+                return None
+            return (guest[2], guest[3])
+        finally:
+            self.lock.release()
+
+    def receive(self, msg, ip):
+        try:
+            values = {}
+            for item in msg.split(","):
+                (key, val) = item.split(":")
+                values[key] = int(val)
+            session = values['session']
+            seq = values['seq']
+        except (ValueError, KeyError, IndexError):
+            self.logger.debug("Malformed sample from %s: %s", ip, repr(msg))
+            self.dropped += 1
+            return
+        self.lock.acquire()
+        try:
+            guest = self.guests.get(ip)
+            if guest is None:
+                self.dropped += 1
+                self.logger.debug("Dropped sample from unknown address %s "
+                                  "(%i dropped in total)", ip, self.dropped)
+                return
+            if guest[0] == session:
+                if seq <= guest[1]:
+                    self.dropped += 1
+                    return
+                if seq > guest[1] + 1:
+                    self.lost += seq - guest[1] - 1
+                    self.logger.debug("Lost %i samples from %s (%i in total)",
+                                      seq - guest[1] - 1, ip, self.lost)
+            del values['session']
+            del values['seq']
+            guest[:] = [ session, seq, time.time(), values ]
+        finally:
+            self.lock.release()
+
+    def run(self):
+        while self.running:
+            try:
+                (msg, addr) = self.socket.recvfrom(4096)
+            except socket.error, e:
+                self.logger.warn("Error receiving pushed statistics: %s", e)
+                continue
+            if self.running:
+                self.receive(msg.rstrip("\n"), addr[0])
+        self.socket.close()
+
+    def stop(self):
+        """
+        Stop receiving samples.  The listener is woken up by an empty datagram
+        and closes its socket.
+        """
+        self.running = False
+        (host, port) = self.socket.getsockname()
+        if host == '0.0.0.0':
+            host = '127.0.0.1'
+        wakeup = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            wakeup.sendto('', (host, port))
+        except socket.error, e:
+            self.logger.warn("Unable to stop the listener: %s", e)
+        wakeup.close()
+        self.join(5)
+
+def instance(properties):
+    return GuestNetworkPush(properties)
@@ -21,6 +21,7 @@ import ConfigParser
 import logging
 from mom.Collectors.Collector import *
 from mom.Collectors.QemuGuestAgentClient import *
+from mom.Collectors.ProcFile import parse_keyvals
 
 class GuestQemuAgent(Collector):
     """
@@ -32,7 +33,21 @@ class GuestQemuAgent(Collector):
         minor_fault   - Total number of minor page faults
         swap_in       - The amount of memory swapped in since the last collection (pages)
         swap_out      - The amount of memory swapped out since the last collection (pages)
+        agent_round_trips - The number of exchanges with the agent during this collection
+
+    The files that statistics are read from are kept open between collections.
+    Each collection seeks them back to the start and reads them with a single
+    pipelined exchange.  An agent which does not allow guest-file-seek is
+    remembered and the files are opened and read again for each collection
+    instead.  collect_async() does the same through a non-blocking client.
     """
+    # The files that statistics are read from
+    files = [ '/proc/meminfo', '/proc/vmstat' ]
+    meminfo_keys = frozenset([ 'MemTotal', 'MemFree', 'Buffers', 'Cached' ])
+    vmstat_keys = frozenset([ 'pgfault', 'pgmajfault', 'pswpin', 'pswpout' ])
+
+    # The number of bytes to request with each guest-file-read
+    read_size = 65536
     
     def __init__(self, properties):
         self.name = properties['name']
@@ -42,7 +57,18 @@ class GuestQemuAgent(Collector):
         except KeyError:
             socket_path = '/var/lib/libvirt/qemu'
         self.sockets = [ "%s/%s.agent" % (socket_path, self.name) ]
+        try:
+            self.max_response = int(properties['config']['max_response_size'])
+        except KeyError:
+            self.max_response = 1048576
         self.agent = None
+        self.async_agent = None
+        # Agent file handles for each of the files, while they are open
+        self.handles = None
+        # Handles that are no longer used, to be closed with the next open
+        self.stale_handles = []
+        # Cleared when the agent refuses to seek
+        self.seek_supported = True
         self.logger = logging.getLogger('mom.Collectors.GuestQemuAgent')
         
         self.swap_in_prev = None
@@ -65,17 +91,50 @@ class GuestQemuAgent(Collector):
             ret = func(*args)
         except ProtocolError, e:
             raise CollectionError("Agent communication failed: %s" % e)
+        return self.check_ret(ret)
+
+    def check_ret(self, ret):
+        """
+        Raise a CollectionError if an agent call failed.
+        Return: The data returned by the call
+        """
         if ret.error:
-            # Convert error data into a string of the form:
-            #    "foo=bar, whiz=bang"
-            details = reduce(lambda x, y: x + ", %s" % y, 
-                             map(lambda x: "%s=%s" % x,
-                                 ret.error['data'].items()))
-            err_str = "%s (details: %s)" % (ret.error['class'], details)
-            raise CollectionError("Agent command failed: %s" % err_str)
+            raise CollectionError("Agent command failed: %s" % \
+                                  self.error_str(ret.error))
 
         return ret.data
 
+    def error_str(self, error):
+        """
+        Convert agent error data into a string of the form:
+            "Class: description (details: foo=bar, whiz=bang)"
+        """
+        err_str = str(error.get('class', 'Unknown error'))
+        if error.get('desc'):
+            err_str += ": %s" % error['desc']
+        details = ", ".join([ "%s=%s" % item for item in
+                              error.get('data', {}).items() ])
+        if details:
+            err_str += " (details: %s)" % details
+        return err_str
+
+    def check_seeks(self, seeks, reads):
+        """
+        Check the results of seeking the files back to the start.  An agent
+        which fails a seek but not the following read of the same file does not
+        support seeking.
+        Return: False if the agent does not support seeking
+        """
+        for (seek, read) in zip(seeks, reads):
+            if seek.error and not read.error:
+                self.logger.info("Agent can't seek files, reopening them for "
+                                 "each collection: %s",
+                                 self.error_str(seek.error))
+                self.seek_supported = False
+                return False
+            self.check_ret(seek)
+        return True
+
     def connect(self):
         """
         Connect to the correct agent socket.  To transparently support both
@@ -89,7 +148,8 @@ class GuestQemuAgent(Collector):
 
         for path in self.sockets:
             try:                
-                agent = QemuGuestAgentClient(path)
+                agent = QemuGuestAgentClient(path,
+                                             max_response=self.max_response)
                 ret = agent.api.ping()
                 if not ret.error:
                     self.agent = agent
@@ -98,41 +158,197 @@ class GuestQemuAgent(Collector):
                 self.logger.debug("Connection failed: %s" % e)
         return self.agent is not None
 
-    def getfile(self, path):
+    def run_batch(self, batch):
+        try:
+            return batch.run()
+        except ProtocolError, e:
+            raise CollectionError("Agent communication failed: %s" % e)
+
+    def open_files(self):
+        # Close any handles that are no longer used in the same exchange
+        batch = self.agent.batch()
+        for fh in self.stale_handles:
+            batch.file_close(fh)
+        for path in self.files:
+            batch.file_open(path, "r")
+        rets = self.run_batch(batch)
+        self.stale_handles = []
+        rets = rets[-len(self.files):]
+        self.handles = [ ret.data for ret in rets ]
+        for ret in rets:
+            if ret.error:
+                self.close_files()
+                self.check_ret(ret)
+
+    def close_files(self):
         """
-        Convenience function to fetch a whole file using open/read/close APIs
+        Close any open files.  This is only an attempt since the handles are
+        invalid if the agent has restarted.
         """
-        fh = self.agent_cmd('file_open', path, "r")
-        data = ""
-        while True:
-            ret = self.agent_cmd('file_read', fh, 1024)
-            data += ret['buf']
-            if len(ret) < 1024:
-                break
-        self.agent_cmd('file_close', fh)
-        return data
+        batch = self.agent.batch()
+        for fh in self.handles:
+            if fh is not None:
+                batch.file_close(fh)
+        self.handles = None
+        try:
+            batch.run()
+        except ProtocolError:
+            pass
+
+    def read_files(self):
+        """
+        Read the whole contents of the open files.  Seeking each file back to
+        the start and reading it are pipelined so normally this takes just one
+        exchange with the agent.
+        Return: A list of the contents of each file or None if the agent turned
+        out not to support seeking
+        """
+        seek = self.seek_supported
+        batch = self.agent.batch()
+        for fh in self.handles:
+            if seek:
+                batch.file_seek(fh, 0)
+            batch.file_read(fh, self.read_size)
+        rets = self.run_batch(batch)
+        if seek:
+            if not self.check_seeks(rets[0::2], rets[1::2]):
+                return None
+            rets = rets[1::2]
+        contents = []
+        for (fh, ret) in zip(self.handles, rets):
+            ret = self.check_ret(ret)
+            data = ret['buf']
+            while not ret.get('eof', True) and ret['count'] > 0:
+                ret = self.agent_cmd('file_read', fh, self.read_size)
+                data += ret['buf']
+            contents.append(data)
+        return contents
 
     def collect(self):
         if not self.connect():
             raise CollectionError('Unable to connect to agent')
-        meminfo = self.getfile("/proc/meminfo")
-        vmstat = self.getfile("/proc/vmstat")
-        
-        avail = parse_int("^MemTotal: (.*) kB", meminfo)
-        anon = parse_int("^AnonPages: (.*) kB", meminfo)
-        unused = parse_int("^MemFree: (.*) kB", meminfo)
-        buffers = parse_int("^Buffers: (.*) kB", meminfo)
-        cached = parse_int("^Cached: (.*) kB", meminfo)
-        free = unused + buffers + cached
+        round_trips = self.agent.round_trips
+        try:
+            if self.handles is None:
+                self.open_files()
+            contents = self.read_files()
+            if contents is None:
+                # Read the files from the start
+                self.drop_handles()
+                self.open_files()
+                contents = self.read_files()
+            if not self.seek_supported:
+                self.drop_handles()
+        except CollectionError:
+            # The agent may have been restarted.  Start over next time.
+            if self.handles is not None:
+                self.close_files()
+            raise
+        (meminfo, vmstat) = contents
+        data = self.parse_stats(meminfo, vmstat)
+        data['agent_round_trips'] = self.agent.round_trips - round_trips
+        return data
+
+    def collect_async(self):
+        if self.async_agent is None:
+            self.async_agent = AsyncQemuGuestAgentClient(self.sockets[0],
+                                                         self.max_response)
+        agent = self.async_agent
+        round_trips = agent.round_trips
+        try:
+            contents = None
+            while contents is None:
+                if self.handles is None:
+                    # Close any handles that are no longer used in the same
+                    # exchange
+                    batch = agent.batch()
+                    for fh in self.stale_handles:
+                        batch.file_close(fh)
+                    for path in self.files:
+                        batch.file_open(path, "r")
+                    for item in batch.run():
+                        if isinstance(item, Wait):
+                            yield item
+                        else:
+                            rets = item
+                    self.stale_handles = []
+                    rets = rets[-len(self.files):]
+                    self.handles = [ ret.data for ret in rets ]
+                    for ret in rets:
+                        self.check_ret(ret)
+
+                seek = self.seek_supported
+                batch = agent.batch()
+                for fh in self.handles:
+                    if seek:
+                        batch.file_seek(fh, 0)
+                    batch.file_read(fh, self.read_size)
+                for item in batch.run():
+                    if isinstance(item, Wait):
+                        yield item
+                    else:
+                        rets = item
+                if seek:
+                    if not self.check_seeks(rets[0::2], rets[1::2]):
+                        # Read the files from the start
+                        self.drop_handles()
+                        continue
+                    rets = rets[1::2]
+                contents = []
+                for (fh, ret) in zip(self.handles, rets):
+                    ret = self.check_ret(ret)
+                    data = ret['buf']
+                    while not ret.get('eof', True) and ret['count'] > 0:
+                        for item in agent.api.file_read(fh, self.read_size):
+                            if isinstance(item, Wait):
+                                yield item
+                            else:
+                                ret = self.check_ret(item)
+                        data += ret['buf']
+                    contents.append(data)
+            if not self.seek_supported:
+                self.drop_handles()
+        except ProtocolError, e:
+            self.drop_handles()
+            raise CollectionError("Agent communication failed: %s" % e)
+        except (CollectionError, GeneratorExit):
+            self.drop_handles()
+            raise
+
+        (meminfo, vmstat) = contents
+        data = self.parse_stats(meminfo, vmstat)
+        data['agent_round_trips'] = agent.round_trips - round_trips
+        yield data
+
+    def drop_handles(self):
+        """
+        Forget about the open files.  They are closed along with the next
+        time the files are opened.
+        """
+        if self.handles is not None:
+            self.stale_handles.extend([ fh for fh in self.handles
+                                        if fh is not None ])
+            self.handles = None
+
+    def parse_stats(self, meminfo, vmstat):
+        """
+        Calculate the statistics from the contents of /proc/meminfo and
+        /proc/vmstat
+        """
+        meminfo = parse_keyvals(meminfo, self.meminfo_keys)
+        avail = meminfo.get('MemTotal')
+        unused = meminfo.get('MemFree')
+        free = unused + meminfo.get('Buffers') + meminfo.get('Cached')
 
         # /proc/vmstat reports cumulative statistics so we must subtract the
         # previous values to get the difference since the last collection.
-        minflt = parse_int("^pgfault (.*)", vmstat)
-        majflt = parse_int("^pgmajfault (.*)", vmstat)
+        vmstat = parse_keyvals(vmstat, self.vmstat_keys)
+        minflt = vmstat.get('pgfault')
+        majflt = vmstat.get('pgmajfault')
         self.swap_in_prev = self.swap_in_cur
         self.swap_out_prev = self.swap_out_cur
-        self.swap_in_cur = parse_int("^pswpin (.*)", vmstat)
-        self.swap_out_cur = parse_int("^pswpout (.*)", vmstat)
+        self.swap_in_cur = vmstat.get('pswpin')
+        self.swap_out_cur = vmstat.get('pswpout')
         if self.swap_in_prev is None:
             self.swap_in_prev = self.swap_in_cur
         if self.swap_out_prev is None:
@@ -142,12 +358,13 @@ class GuestQemuAgent(Collector):
 
         data = { 'mem_available': avail, 'mem_unused': unused, \
                  'mem_free': free, 'swap_in': swap_in, 'swap_out': swap_out, \
-                 'major_fault': majflt, 'minor_fault': minflt, }
+                 'major_fault': majflt, 'minor_fault': minflt }
         return data
         
     def getFields(self=None):
         return set(['mem_available', 'mem_unused', 'mem_free',
-                    'major_fault', 'minor_fault', 'swap_in', 'swap_out'])
+                    'major_fault', 'minor_fault', 'swap_in', 'swap_out',
+                    'agent_round_trips'])
         
 def instance(properties):
     return GuestQemuAgent(properties)
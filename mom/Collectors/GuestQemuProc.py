@@ -14,6 +14,8 @@
 # License along with this program; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
 
+import time
+import threading
 from mom.Collectors.Collector import *
 
 class GuestQemuProc(Collector):
@@ -27,32 +29,33 @@ class GuestQemuProc(Collector):
                   host minor faults do not.
         rss - The resident set size counts the number of resident pages
               associated with this qemu process.
+
+    The stat files of all guests are read together by one shared reader, at
+    most once per half of the collection interval.
     """
     def __init__(self, properties):
         self.pid = properties['pid']
-        self.pid_stat_file = None
+        self.max_age = properties.get('interval', 0) / 2.0
+        self.reader = get_reader()
         if self.pid is not None:
-            self.pid_stat_file = open_datafile("/proc/" + str(self.pid) + "/stat")
+            self.reader.register(self.pid)
         self.prev_minor_faults = None
         self.prev_major_faults = None
 
     def __del__(self):
-        if self.pid_stat_file is not None:
-            self.pid_stat_file.close()
+        if self.pid is not None:
+            self.reader.unregister(self.pid)
 
     def collect(self):
-        if self.pid_stat_file is None:
+        if self.pid is None:
             return {}
 
+        stats = self.reader.get(self.pid, self.max_age)
+        if stats is None:
+            raise CollectionError("qemu process %s is not running" % self.pid)
+        (cur_minor_faults, cur_major_faults, rss) = stats
+
         # Only report the change in these statistics since the last collection
-        self.pid_stat_file.seek(0)
-        try:
-            stats = self.pid_stat_file.read().split()
-        except IOError, (errno, strerror):
-            raise CollectionError("Cannot read stat file: %s" % strerror)
-        cur_minor_faults = int(stats[9])
-        cur_major_faults = int(stats[11])
-        rss = int(stats[23])
         if self.prev_minor_faults is None:
             self.prev_minor_faults = cur_minor_faults
         if self.prev_major_faults is None:
@@ -67,5 +70,104 @@ class GuestQemuProc(Collector):
     def getFields(self=None):
         return set(['host_minor_faults', 'host_major_faults', 'rss'])
 
+class _QemuProcReader:
+    """
+    Read /proc/<pid>/stat for every registered qemu process in one pass.
+
+    Each stat file is opened once when its pid is registered and kept open.
+    An open file keeps referring to the same process even if the pid is later
+    reused, and reading it fails once that process has exited.  When a pid is
+    registered again, the file is reopened if the process it refers to has
+    exited or has a different start time, since the pid now belongs to a new
+    process.
+    """
+    # The stat file of a process
+    stat_path = "/proc/%s/stat"
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # Registered processes: pid -> [refs, file, stats, start time]
+        self.procs = {}
+        self.last_refresh = 0
+
+    def register(self, pid):
+        self.lock.acquire()
+        try:
+            try:
+                f = open(self.stat_path % pid, 'r')
+            except IOError:
+                f = None
+            proc = [ 1, f, None, None ]
+            self._read(proc)
+            old = self.procs.get(pid)
+            if old is not None:
+                if old[1] is not None and old[3] == proc[3]:
+                    # Still the same process
+                    self._close(proc)
+                    old[0] += 1
+                    return
+                # The pid has been reused
+                self._close(old)
+                proc[0] += old[0]
+            self.procs[pid] = proc
+        finally:
+            self.lock.release()
+
+    def unregister(self, pid):
+        self.lock.acquire()
+        proc = self.procs[pid]
+        proc[0] -= 1
+        if proc[0] == 0:
+            self._close(proc)
+            del self.procs[pid]
+        self.lock.release()
+
+    def _close(self, proc):
+        if proc[1] is not None:
+            proc[1].close()
+            proc[1] = None
+        proc[2] = None
+
+    def _read(self, proc):
+        """
+        Update the (minor faults, major faults, rss) and the start time of a
+        process
+        """
+        f = proc[1]
+        if f is None:
+            return
+        try:
+            f.seek(0)
+            stat = f.read()
+            # The command name may contain spaces so skip past it
+            fields = stat[stat.rfind(')') + 2:].split()
+            proc[2] = (int(fields[7]), int(fields[9]), int(fields[21]))
+            proc[3] = int(fields[19])
+        except (IOError, ValueError, IndexError):
+            self._close(proc)
+
+    def refresh(self):
+        for proc in self.procs.values():
+            self._read(proc)
+        self.last_refresh = time.time()
+
+    def get(self, pid, max_age):
+        """
+        Return: The (minor faults, major faults, rss) of a process, read at
+        most max_age seconds ago, or None if it is not running
+        """
+        self.lock.acquire()
+        try:
+            if time.time() - self.last_refresh >= max_age:
+                self.refresh()
+            return self.procs[pid][2]
+        finally:
+            self.lock.release()
+
+_reader = _QemuProcReader()
+
+def get_reader():
+    return _reader
+
 def instance(properties):
     return GuestQemuProc(properties)
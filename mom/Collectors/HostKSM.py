@@ -15,6 +15,8 @@
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
 
 import os
+import time
+import logging
 from subprocess import *
 from mom.Collectors.Collector import *
 
@@ -31,35 +33,58 @@ class HostKSM(Collector):
         ksm_pages_volatile - The number of pages that are changing too fast to be shared
         ksm_full_scans - The number of times all mergeable memory areas have been scanned
         ksm_shareable - Estimated amount of host memory that is eligible for sharing 
-        ksmd_cpu_usage - The cpu usage of kernel thread ksmd during the monitor interval
+        ksmd_cpu_usage - The cpu usage of kernel thread ksmd since the last collection
+        ksm_shareable_time - Time taken to calculate ksm_shareable (us)
+
+    ksm_shareable is the sum of the virtual sizes of all qemu processes.  They
+    are read from /proc/<pid>/statm for the pids of the guests known to the
+    GuestManager.  All of /proc is only scanned for qemu processes once per
+    reconcile-interval to catch any that it does not know about.
     """
     
     sysfs_keys = [ 'full_scans', 'pages_sharing', 'pages_unshared', 'run',
                    'pages_shared', 'pages_to_scan', 'pages_volatile',
                    'sleep_millisecs' ]
+
+    # Where the KSM and process files are found
+    sysfs_dir = '/sys/kernel/mm/ksm'
+    proc_dir = '/proc'
     
     def __init__(self, properties):
         self.open_files()
-        self.interval = properties['interval']
-        self.pid = int(Popen(['pidof', 'ksmd'], stdout=PIPE).communicate()[0])
+        self.logger = logging.getLogger('mom.Collectors.HostKSM')
+        self.guest_manager = properties.get('guest_manager')
+        config = properties.get('config', {})
+        self.reconcile_interval = float(config.get('reconcile-interval', 60))
+        self.next_reconcile = 0
+        # Open statm files of qemu processes, indexed by pid
+        self.qemu_statm = {}
+        self.page_kb = os.sysconf('SC_PAGE_SIZE') / 1024
+        self.pid = self.get_ksmd_pid()
         self.last_jiff = self.get_ksmd_jiffies()
+        self.last_time = time.time()
 
     def __del__(self):
         for datum in self.sysfs_keys:
             if datum in self.files and self.files[datum] is not None:
                 self.files[datum].close()
+        for f in self.qemu_statm.values():
+            f.close()
 
     def open_files(self):
         self.files = {}
         for datum in self.sysfs_keys:
-            name = '/sys/kernel/mm/ksm/%s' % datum
+            name = '%s/%s' % (self.sysfs_dir, datum)
             try:
                 self.files[datum] = open(name, 'r')
             except IOError, (errno, msg):
                 raise FatalError("HostKSM: open %s failed: %s" % (name, msg))
 
+    def get_ksmd_pid(self):
+        return int(Popen(['pidof', 'ksmd'], stdout=PIPE).communicate()[0])
+
     def get_ksmd_jiffies(self):
-        return sum(map(int, file('/proc/%s/stat' % self.pid) \
+        return sum(map(int, file('%s/%s/stat' % (self.proc_dir, self.pid)) \
                    .read().split()[13:15]))
 
     def get_ksmd_cpu_usage(self):
@@ -67,27 +92,77 @@ class HostKSM(Collector):
         Calculate the cpu utilization of the ksmd kernel thread as a percentage.
         """
         cur_jiff = self.get_ksmd_jiffies()
+        cur_time = time.time()
         # Get the number of jiffies used in this interval taking counter
         # wrap-around into account.
         interval_jiffs = (cur_jiff - self.last_jiff) % 2**32
-        total_jiffs = os.sysconf('SC_CLK_TCK') * self.interval
+        total_jiffs = os.sysconf('SC_CLK_TCK') * (cur_time - self.last_time)
+        self.last_jiff = cur_jiff
+        self.last_time = cur_time
+        if total_jiffs <= 0:
+            return 0
         # Calculate percentage of total jiffies during this interval.
         return 100 * interval_jiffs / total_jiffs
 
+    def find_qemu_pids(self):
+        """
+        Scan /proc for processes whose name contains 'qemu'
+        """
+        pids = []
+        for entry in os.listdir(self.proc_dir):
+            if not entry.isdigit():
+                continue
+            try:
+                f = open('%s/%s/stat' % (self.proc_dir, entry), 'r')
+                try:
+                    stat = f.read()
+                finally:
+                    f.close()
+            except IOError:
+                continue
+            name = stat[stat.find('(') + 1:stat.rfind(')')]
+            if 'qemu' in name:
+                pids.append(int(entry))
+        return pids
+
+    def update_qemu_pids(self):
+        """
+        Open the statm files of qemu processes we don't know about yet
+        """
+        pids = []
+        if self.guest_manager is not None:
+            pids = self.guest_manager.get_guest_pids()
+        if time.time() >= self.next_reconcile:
+            pids = pids + self.find_qemu_pids()
+            self.next_reconcile = time.time() + self.reconcile_interval
+        for pid in map(int, pids):
+            if pid in self.qemu_statm:
+                continue
+            try:
+                self.qemu_statm[pid] = open('%s/%i/statm' % (self.proc_dir,
+                                                             pid), 'r')
+            except IOError:
+                pass
+
     def get_shareable_mem(self):
         """
         Estimate how much memory has been reported to KSM for potential sharing.
         We assume that qemu is reporting guest physical memory areas to KSM.
+        An open statm file keeps referring to the same process even if its pid
+        is reused.  Once the process has exited it reads as all zeros.
         """
-        p1 = Popen(["pgrep", "qemu"], stdout=PIPE).communicate()[0]
-        pids = p1.split()
-        if len(pids) == 0:
-            return 0
-        ps_argv = ["ps", "-ovsz", "h"] + pids
-        p1 = Popen(ps_argv, stdout=PIPE).communicate()[0]
+        self.update_qemu_pids()
         mem_tot = 0
-        for mem in p1.split():
-            mem_tot = mem_tot + int(mem)
+        for (pid, f) in self.qemu_statm.items():
+            try:
+                f.seek(0)
+                pages = int(f.read().split()[0])
+            except (IOError, ValueError, IndexError):
+                pages = 0
+            if pages == 0:
+                f.close()
+                del self.qemu_statm[pid]
+            mem_tot = mem_tot + pages * self.page_kb
         return mem_tot
 
     def collect(self):
@@ -95,14 +170,16 @@ class HostKSM(Collector):
         for (datum, file) in self.files.items():
             file.seek(0)
             data['ksm_' + datum] = parse_int('(.*)', file.read())
+        start = time.time()
         data['ksm_shareable'] = self.get_shareable_mem()
+        data['ksm_shareable_time'] = int((time.time() - start) * 1000000)
         data['ksmd_cpu_usage'] = self.get_ksmd_cpu_usage()
         return data
         
     def getFields(self=None):
         f = lambda x: 'ksm_' + x
         return set(map(f, HostKSM.sysfs_keys)) | set(['ksm_shareable', \
-                   'ksmd_cpu_usage'])
+                   'ksmd_cpu_usage', 'ksm_shareable_time'])
 
 def instance(properties):
     return HostKSM(properties)
@@ -15,6 +15,7 @@
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
 
 from mom.Collectors.Collector import *
+from mom.Collectors.ProcFile import ProcFile
 
 class HostMemory(Collector):
     """
@@ -28,38 +29,28 @@ class HostMemory(Collector):
         anon_pages    - The amount of memory used for anonymous memory areas (kB)
     """
     def __init__(self, properties):
-        self.meminfo = open_datafile("/proc/meminfo")
-        self.vmstat = open_datafile("/proc/vmstat")
+        self.meminfo = ProcFile("/proc/meminfo", [ 'MemTotal', 'AnonPages',
+                                'MemFree', 'Buffers', 'Cached' ])
+        self.vmstat = ProcFile("/proc/vmstat", [ 'pswpin', 'pswpout' ])
         self.swap_in_prev = None
         self.swap_in_cur = None
         self.swap_out_prev = None
         self.swap_out_cur = None
 
-    def __del__(self):
-        if self.meminfo is not None:
-            self.meminfo.close()
-        if self.vmstat is not None:    
-            self.vmstat.close()
-
     def collect(self):
-        self.meminfo.seek(0)
-        self.vmstat.seek(0)
-        
-        contents = self.meminfo.read()
-        avail = parse_int("^MemTotal: (.*) kB", contents)
-        anon = parse_int("^AnonPages: (.*) kB", contents)
-        unused = parse_int("^MemFree: (.*) kB", contents)
-        buffers = parse_int("^Buffers: (.*) kB", contents)
-        cached = parse_int("^Cached: (.*) kB", contents)
-        free = unused + buffers + cached
+        meminfo = self.meminfo.read()
+        avail = meminfo.get('MemTotal')
+        anon = meminfo.get('AnonPages')
+        unused = meminfo.get('MemFree')
+        free = unused + meminfo.get('Buffers') + meminfo.get('Cached')
 
         # /proc/vmstat reports cumulative statistics so we must subtract the
         # previous values to get the difference since the last collection.
-        contents = self.vmstat.read()
+        vmstat = self.vmstat.read()
         self.swap_in_prev = self.swap_in_cur
         self.swap_out_prev = self.swap_out_cur
-        self.swap_in_cur = parse_int("^pswpin (.*)", contents)
-        self.swap_out_cur = parse_int("^pswpout (.*)", contents)
+        self.swap_in_cur = vmstat.get('pswpin')
+        self.swap_out_cur = vmstat.get('pswpout')
         if self.swap_in_prev is None:
             self.swap_in_prev = self.swap_in_cur
         if self.swap_out_prev is None:
@@ -0,0 +1,85 @@
+# Memory Overcommitment Manager
+# Copyright (C) 2010 Adam Litke, IBM Corporation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public
+# License along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+
+import os
+from mom.Collectors.Collector import FatalError
+
+def parse_keyvals(text, keys):
+    """
+    Parse the integer values of the requested keys from text in the format of
+    /proc/meminfo ("Key:   value kB") or /proc/vmstat ("key value").  Each key
+    is located with a string search so only the lines that are needed are
+    split and converted.
+    Return: A dictionary of the values that were found, indexed by key
+    """
+    ret = {}
+    for key in keys:
+        i = text.find(key)
+        while i >= 0:
+            end = i + len(key)
+            # Match whole keys at the start of a line only
+            if (i == 0 or text[i - 1] == '\n') and \
+                    text[end:end + 1] in (':', ' '):
+                eol = text.find('\n', end)
+                if eol < 0:
+                    eol = len(text)
+                ret[key] = int(text[end + 1:eol].split()[0])
+                break
+            i = text.find(key, i + 1)
+    return ret
+
+class ProcFile:
+    """
+    A /proc file of key/value pairs which is kept open and read from the start
+    each time its values are needed.  Only the keys given to the constructor
+    are parsed.
+    """
+    def __init__(self, path, keys, bufsize=16384):
+        self.path = path
+        self.keys = frozenset(keys)
+        self.bufsize = bufsize
+        try:
+            self.fd = os.open(path, os.O_RDONLY)
+        except OSError, e:
+            self.fd = None
+            raise FatalError("Cannot open %s: %s" % (path, e.strerror))
+
+    def __del__(self):
+        self.close()
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def read_text(self):
+        """
+        Return: The current contents of the file
+        """
+        os.lseek(self.fd, 0, os.SEEK_SET)
+        chunks = []
+        while True:
+            chunk = os.read(self.fd, self.bufsize)
+            if len(chunk) == 0:
+                break
+            chunks.append(chunk)
+        return ''.join(chunks)
+
+    def read(self):
+        """
+        Return: A dictionary of the current values of the keys
+        """
+        return parse_keyvals(self.read_text(), self.keys)
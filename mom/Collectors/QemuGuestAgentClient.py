@@ -15,9 +15,12 @@
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
 
 import socket
+import errno
 import time
+import random
 import json
 import base64
+from mom.Collectors.Collector import Wait
 
 class ProtocolError(Exception):
     """
@@ -65,16 +68,28 @@ class QemuGuestAgentClient:
     file_close:  Close a previously opened file
     file_read:   Read some data from an open file
     file_write:  Write to an open file
+    file_seek:   Move the position of an open file
 
+    Calls made through a batch (see batch()) are sent together and their
+    responses received together, costing a single round trip.
     """
-    def __init__(self, where, verbose=False):
+    # The size of each read from the socket
+    recv_size = 65536
+
+    def __init__(self, where, verbose=False, max_response=1048576):
         """
-        Initialize the client for a particular unix socket
+        Initialize the client for a particular unix socket.  Responses longer
+        than max_response bytes are treated as protocol errors.
         """
         self.api = _QemuGuestAgentAPI(self)
         self.where = where
         self.sock = None
         self.verbose = verbose
+        self.max_response = max_response
+        # Data received but not yet returned
+        self.recv_buffer = ""
+        # The number of request/response exchanges with the agent
+        self.round_trips = 0
 
     def _reset_conn(self, sock):
         """
@@ -90,6 +105,7 @@ class QemuGuestAgentClient:
         request = { 'execute': 'guest-sync', 'arguments': { 'id': seq } }
         req_str = json.dumps(request)
         self._sock_send(sock, req_str)
+        self.round_trips += 1
         
         # Read data from the channel until we get a matching response
         while True:
@@ -107,6 +123,7 @@ class QemuGuestAgentClient:
         if self.verbose:
             print "Connecting to %s" % self.where
         try:
+            self.recv_buffer = ""
             self.sock = socket.socket(sock_type, socket.SOCK_STREAM)
             self.sock.settimeout(2)
             self.sock.connect(self.where)
@@ -180,14 +197,23 @@ class QemuGuestAgentClient:
         
     def _sock_recv_until(self, sock, token):
         """
-        Receive data from the socket one byte at a time until the token is read
+        Receive data from the socket until the token is read.  Data is read in
+        large blocks and anything that follows the token is kept for the next
+        call, so several responses may arrive in one read.
         """
-        data = ""
+        pos = self.recv_buffer.find(token)
+        if pos >= 0:
+            return self._take(pos + len(token))
+        chunks = [ self.recv_buffer ]
+        size = len(self.recv_buffer)
         while True:
-            if len(data) > 4096:
-                return None
+            if size > self.max_response:
+                self._sock_close(self.sock)
+                self.sock = None
+                raise ProtocolError(-1, "Response larger than %i bytes" % \
+                                    self.max_response)
             try:
-                ch = sock.recv(1)
+                data = sock.recv(self.recv_size)
             except socket.timeout:
                 self._sock_close(self.sock)
                 self.sock = None
@@ -196,12 +222,28 @@ class QemuGuestAgentClient:
                 self._sock_close(self.sock)
                 self.sock = None
                 raise ProtocolError(e.errno, e.message)
-            if ch == '':
-                print "Connection closed"
-                return None
-            data += ch
-            if data[-len(token):] == token:
-                return data
+            if data == '':
+                self._sock_close(self.sock)
+                self.sock = None
+                raise ProtocolError(-1, "Connection closed")
+
+            # The token may straddle two reads
+            last = chunks[-1]
+            window = last[max(0, len(last) - len(token) + 1):] + data
+            pos = window.find(token)
+            chunks.append(data)
+            size += len(data)
+            if pos >= 0:
+                self.recv_buffer = ''.join(chunks)
+                return self._take(size - len(window) + pos + len(token))
+
+    def _take(self, nr):
+        """
+        Remove and return the first nr bytes of the receive buffer
+        """
+        data = self.recv_buffer[:nr]
+        self.recv_buffer = self.recv_buffer[nr:]
+        return data
 
     def _sock_close(self, sock):
         """
@@ -224,9 +266,40 @@ class QemuGuestAgentClient:
         
         sock = self._make_connection()
         self._sock_send(sock, json_str)
+        self.round_trips += 1
         response = self._sock_recv_until(sock, "\n")
         return QemuAgentRet(response)
 
+    def _call_many(self, requests):
+        """
+        Pipeline several agent RPC calls.  All requests are sent at once and
+        then the responses, which the agent returns in order, are received.
+        Return: A list of QemuAgentRet, one for each (command, args) request
+        """
+        json_str = ''.join([ json.dumps({ 'execute': command,
+                                          'arguments': args })
+                             for (command, args) in requests ])
+        sock = self._make_connection()
+        self._sock_send(sock, json_str)
+        self.round_trips += 1
+        return [ QemuAgentRet(self._sock_recv_until(sock, "\n"))
+                 for request in requests ]
+
+    def batch(self):
+        """
+        Return: An object with the same API calls as 'api'.  They are queued
+        instead of being made until its run() method is called.
+        """
+        return _QemuGuestAgentBatch(self)
+
+def _decode_read(ret):
+    """
+    Decode the buffer returned by guest-file-read
+    """
+    if ret.data:
+        ret.data['buf'] = base64.b64decode(ret.data['buf-b64'])
+    return ret
+
 class _QemuGuestAgentAPI():
     """
     Wrapper functions for the supported Qemu guest agent API calls.
@@ -234,25 +307,262 @@ class _QemuGuestAgentAPI():
     def __init__(self, client):
         self.client = client
 
+    def _call(self, command, args={}, post=None):
+        ret = self.client._call(command, args)
+        if post is not None:
+            ret = post(ret)
+        return ret
+
     def ping(self):
-        return self.client._call('guest-ping')
+        return self._call('guest-ping')
 
     def file_open(self, path, mode="r"):
         args = { 'path': path, 'mode': mode }
-        return self.client._call('guest-file-open', args) 
+        return self._call('guest-file-open', args)
 
     def file_close(self, handle):
         args = { 'handle': handle }
-        return self.client._call('guest-file-close', args)
+        return self._call('guest-file-close', args)
 
     def file_read(self, handle, count):
         args = { 'handle': handle, 'count': count }
-        ret = self.client._call('guest-file-read', args)
-        if ret.data:
-            # Decode the buffer before returning it
-            ret.data['buf'] = base64.b64decode(ret.data['buf-b64'])
-        return ret
+        return self._call('guest-file-read', args, _decode_read)
 
     def file_write(self, handle, buffer):
         args = { 'handle': handle, 'buf-b64': base64.b64encode(buffer) }
-        return self.client._call('guest-file-write', args)
+        return self._call('guest-file-write', args)
+
+    def file_seek(self, handle, offset, whence=0):
+        args = { 'handle': handle, 'offset': offset, 'whence': whence }
+        return self._call('guest-file-seek', args)
+
+class _QemuGuestAgentBatch(_QemuGuestAgentAPI):
+    """
+    Queues API calls so that they can be pipelined
+    """
+    def __init__(self, client):
+        _QemuGuestAgentAPI.__init__(self, client)
+        self.requests = []
+        self.posts = []
+
+    def _call(self, command, args={}, post=None):
+        self.requests.append((command, args))
+        self.posts.append(post)
+
+    def run(self):
+        """
+        Make the queued calls in one round trip.
+        Return: The list of their results, in order
+        """
+        rets = self.client._call_many(self.requests)
+        for (i, post) in enumerate(self.posts):
+            if post is not None:
+                rets[i] = post(rets[i])
+        return rets
+
+class AsyncQemuGuestAgentClient:
+    """
+    AsyncQemuGuestAgentClient: A non-blocking version of QemuGuestAgentClient
+    which lets one thread talk to the agents of many guests through the
+    CollectionEngine.  The calls of its 'api' member and the run() method of
+    its batches are generators: they yield a Wait whenever the agent socket is
+    not ready and finally yield the result of the call.
+
+    A call that is abandoned part way through, for example when it times out,
+    may still get its response later.  So the channel is synchronized with a
+    new 'guest-sync' id before the next call and responses to earlier
+    requests are discarded.  When connecting or synchronizing fails, further
+    attempts are delayed with exponential backoff.
+
+    Only one call may be in progress at a time.
+    """
+    # Delays (in seconds) between failed connection attempts
+    min_backoff = 1
+    max_backoff = 60
+
+    # The size of each read from the socket
+    recv_size = 65536
+
+    def __init__(self, where, max_response=1048576):
+        self.api = _AsyncQemuGuestAgentAPI(self)
+        self.where = where
+        self.max_response = max_response
+        self.sock = None
+        self.synced = False
+        self.busy = False
+        self.recv_buffer = ""
+        self.round_trips = 0
+        self.sync_id = random.randint(0, 2147483646)
+        self.backoff = 0
+        self.next_attempt = 0
+
+    def batch(self):
+        return _AsyncQemuGuestAgentBatch(self)
+
+    def close(self):
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except socket.error:
+                pass
+        self.sock = None
+        self.synced = False
+        self.recv_buffer = ""
+
+    def _fail(self, code, msg):
+        self.close()
+        raise ProtocolError(code, msg)
+
+    def _delay(self):
+        """
+        Back off after a failed attempt to establish a usable channel
+        """
+        self.close()
+        self.backoff = min(max(2 * self.backoff, self.min_backoff),
+                           self.max_backoff)
+        self.next_attempt = time.time() + self.backoff
+
+    def _connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.setblocking(0)
+        try:
+            sock.connect(self.where)
+        except socket.error, e:
+            sock.close()
+            raise ProtocolError(e.errno, "Connection failed: %s" % e.strerror)
+        self.sock = sock
+
+    def _send(self, msg):
+        while len(msg) > 0:
+            try:
+                msg = msg[self.sock.send(msg):]
+            except socket.error, e:
+                if e.errno != errno.EAGAIN:
+                    self._fail(e.errno, "Send failed: %s" % e.strerror)
+                yield Wait(self.sock, write=True)
+
+    def _recv_line(self):
+        """
+        Receive one response.  Finally yield it.
+        """
+        searched = 0
+        while True:
+            pos = self.recv_buffer.find("\n", searched)
+            if pos >= 0:
+                line = self.recv_buffer[:pos + 1]
+                self.recv_buffer = self.recv_buffer[pos + 1:]
+                yield line
+                return
+            searched = len(self.recv_buffer)
+            if searched > self.max_response:
+                self._fail(-1, "Response larger than %i bytes" % \
+                           self.max_response)
+            try:
+                data = self.sock.recv(self.recv_size)
+            except socket.error, e:
+                if e.errno != errno.EAGAIN:
+                    self._fail(e.errno, "Receive failed: %s" % e.strerror)
+                yield Wait(self.sock)
+                continue
+            if data == '':
+                self._fail(-1, "Connection closed")
+            self.recv_buffer += data
+
+    def _sync(self):
+        """
+        Discard responses from the channel until the one to a new guest-sync
+        """
+        self.sync_id = (self.sync_id + 1) % 2147483647
+        seq = self.sync_id
+        request = { 'execute': 'guest-sync', 'arguments': { 'id': seq } }
+        for item in self._send(json.dumps(request)):
+            yield item
+        while True:
+            for item in self._recv_line():
+                if isinstance(item, Wait):
+                    yield item
+                else:
+                    line = item
+            try:
+                resp_obj = json.loads(line)
+            except ValueError:
+                continue
+            if isinstance(resp_obj, dict) and resp_obj.get('return') == seq:
+                break
+        self.round_trips += 1
+        self.synced = True
+
+    def _call(self, requests, posts):
+        """
+        Pipeline a list of (command, args) requests.  Finally yield the list of
+        QemuAgentRet results, each passed through its entry in posts.
+        """
+        if self.busy:
+            raise ProtocolError(-1, "Another call is in progress")
+        now = time.time()
+        if self.sock is None and now < self.next_attempt:
+            raise ProtocolError(-1, "Not reconnecting for another %is" % \
+                                (self.next_attempt - now))
+        connecting = not self.synced
+        self.busy = True
+        try:
+            if self.sock is None:
+                self._connect()
+            if not self.synced:
+                for item in self._sync():
+                    yield item
+                self.backoff = 0
+            connecting = False
+
+            json_str = ''.join([ json.dumps({ 'execute': command,
+                                              'arguments': args })
+                                 for (command, args) in requests ])
+            # Until all responses have been read
+            self.synced = False
+            for item in self._send(json_str):
+                yield item
+            rets = []
+            for request in requests:
+                for item in self._recv_line():
+                    if isinstance(item, Wait):
+                        yield item
+                    else:
+                        rets.append(QemuAgentRet(item))
+            self.synced = True
+            self.round_trips += 1
+        except (ProtocolError, GeneratorExit):
+            if connecting:
+                self._delay()
+            raise
+        finally:
+            self.busy = False
+
+        for (i, post) in enumerate(posts):
+            if post is not None:
+                rets[i] = post(rets[i])
+        yield rets
+
+def _first(gen):
+    """
+    Pass on the Waits of a call made through a batch and finally yield its
+    only result
+    """
+    try:
+        for item in gen:
+            if isinstance(item, Wait):
+                yield item
+            else:
+                yield item[0]
+    finally:
+        gen.close()
+
+class _AsyncQemuGuestAgentAPI(_QemuGuestAgentAPI):
+    """
+    The agent API calls, as generators
+    """
+    def _call(self, command, args={}, post=None):
+        return _first(self.client._call([ (command, args) ], [ post ]))
+
+class _AsyncQemuGuestAgentBatch(_QemuGuestAgentBatch):
+    def run(self):
+        return self.client._call(self.requests, self.posts)
@@ -0,0 +1,123 @@
+# Memory Overcommitment Manager
+# Copyright (C) 2010 Adam Litke, IBM Corporation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public
+# License along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+
+# Run from the top level directory with:
+#   python -m mom.Collectors.TestGuestNetworkDaemon
+
+import unittest
+import threading
+import socket
+import time
+import ConfigParser
+from mom.Collectors.GuestNetworkDaemon import _Server, sock_send, sock_receive
+
+class FakeSource:
+    """
+    Stand in for the HostMemory Collector and the /proc/vmstat reader of a
+    _Server and count how often statistics are read
+    """
+    def __init__(self):
+        self.reads = 0
+
+    def collect(self):
+        self.reads += 1
+        return { 'mem_available': 1000, 'mem_free': 100, 'swap_in': 0,
+                 'swap_out': 0 }
+
+    def read(self):
+        return { 'pgfault': 5, 'pgmajfault': self.reads }
+
+class TestServer(unittest.TestCase):
+    def setUp(self):
+        config = ConfigParser.ConfigParser()
+        config.add_section('main')
+        for (key, val) in (('host', '127.0.0.1'), ('port', '0'),
+                           ('min_free', '0.20'), ('max_free', '0.50'),
+                           ('stats-ttl', '0.5'), ('max-sessions', '4'),
+                           ('session-timeout', '2')):
+            config.set('main', key, val)
+        self.server = _Server(config)
+        self.source = FakeSource()
+        self.server.collector = self.source
+        self.server.vmstat = self.source
+        self.port = self.server.socket.getsockname()[1]
+        thread = threading.Thread(target=self.server.run)
+        thread.setDaemon(True)
+        thread.start()
+        self.conns = []
+
+    def tearDown(self):
+        self.server.running = False
+        for conn in self.conns:
+            conn.close()
+        # Let the sessions end before the interpreter exits
+        time.sleep(0.1)
+
+    def connect(self):
+        conn = socket.create_connection(('127.0.0.1', self.port))
+        conn.settimeout(2)
+        self.conns.append(conn)
+        return conn
+
+    def request(self, conn, cmd):
+        sock_send(conn, cmd)
+        return sock_receive(conn)
+
+    def test_concurrent(self):
+        conns = [ self.connect() for i in range(4) ]
+        for conn in conns:
+            sock_send(conn, 'stats')
+        for conn in conns:
+            self.assertTrue(sock_receive(conn).startswith('mem_available:'))
+        self.assertEqual(self.request(conns[0], 'props'),
+                         'min_free:0.20,max_free:0.50')
+        # The burst of requests read the statistics once
+        self.assertEqual(self.source.reads, 1)
+
+    def test_session_cap(self):
+        conns = [ self.connect() for i in range(4) ]
+        for conn in conns:
+            self.request(conn, 'props')
+        # A fifth connection is closed right away
+        extra = self.connect()
+        sock_send(extra, 'props')
+        self.assertRaises(socket.error, sock_receive, extra)
+
+        # Closing a session frees its slot
+        conns[0].close()
+        for i in range(20):
+            time.sleep(0.05)
+            try:
+                conn = self.connect()
+                self.request(conn, 'props')
+                break
+            except socket.error:
+                pass
+        else:
+            self.fail("No session slot became free")
+
+    def test_stats_ttl(self):
+        conn = self.connect()
+        first = self.request(conn, 'stats')
+        self.assertEqual(self.request(conn, 'stats'), first)
+        self.assertEqual(self.source.reads, 1)
+        time.sleep(0.6)
+        self.assertNotEqual(self.request(conn, 'stats'), first)
+        self.assertEqual(self.source.reads, 2)
+        self.assertTrue('cache_hits:1,' in self.request(conn, 'counters'))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,127 @@
+# Memory Overcommitment Manager
+# Copyright (C) 2010 Adam Litke, IBM Corporation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public
+# License along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+
+# Run from the top level directory with:
+#   python -m mom.Collectors.TestGuestNetworkPush
+
+import unittest
+import tempfile
+import shutil
+import socket
+import time
+import os
+import ConfigParser
+from mom.Collectors import GuestNetworkPush
+from mom.Collectors.GuestNetworkPush import _PushListener
+from mom.Collectors.GuestNetworkDaemon import _Pusher
+
+class TestPushListener(unittest.TestCase):
+    def setUp(self):
+        self.listener = _PushListener('127.0.0.1', 0)
+        self.listener.register('10.0.0.1')
+
+    def tearDown(self):
+        self.listener.stop()
+
+    def latest(self):
+        return self.listener.get('10.0.0.1')[1]['mem_free']
+
+    def test_order(self):
+        receive = lambda msg: self.listener.receive(msg, '10.0.0.1')
+        receive("session:1,seq:1,mem_free:10")
+        self.assertEqual(self.latest(), 10)
+        # Duplicate and late samples are dropped
+        receive("session:1,seq:1,mem_free:11")
+        self.assertEqual((self.latest(), self.listener.dropped), (10, 1))
+        receive("session:1,seq:3,mem_free:13")
+        self.assertEqual((self.latest(), self.listener.lost), (13, 1))
+        receive("session:1,seq:2,mem_free:12")
+        self.assertEqual((self.latest(), self.listener.dropped), (13, 2))
+
+    def test_session_restart(self):
+        receive = lambda msg: self.listener.receive(msg, '10.0.0.1')
+        receive("session:1,seq:50,mem_free:10")
+        # A restarted daemon starts counting again
+        receive("session:2,seq:1,mem_free:20")
+        self.assertEqual(self.latest(), 20)
+        receive("session:2,seq:2,mem_free:21")
+        self.assertEqual((self.latest(), self.listener.dropped), (21, 0))
+
+    def test_registration(self):
+        self.listener.receive("session:1,seq:1,mem_free:10", '10.0.0.2')
+        self.assertEqual(self.listener.dropped, 1)
+        # Entries are shared by the collectors of one address
+        self.listener.register('10.0.0.1')
+        self.listener.unregister('10.0.0.1')
+        self.listener.receive("session:1,seq:1,mem_free:10", '10.0.0.1')
+        self.assertEqual(self.latest(), 10)
+        self.listener.unregister('10.0.0.1')
+        self.assertEqual(self.listener.get('10.0.0.1'), None)
+
+class FakeServer:
+    def get_stats(self):
+        return ("mem_available:100,mem_unused:10", False)
+
+class TestPush(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        helper = "%s/name-to-ip" % self.dir
+        f = open(helper, 'w')
+        f.write("#!/bin/sh\necho 127.0.0.1\n")
+        f.close()
+        os.chmod(helper, 0755)
+        # Find a free port
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind(('127.0.0.1', 0))
+        self.port = sock.getsockname()[1]
+        sock.close()
+        self.properties = { 'name': 'guest',
+                            'config': { 'name-to-ip-helper': helper,
+                                        'listen-host': '127.0.0.1',
+                                        'listen-port': str(self.port) } }
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_push(self):
+        collectors = [ GuestNetworkPush.instance(self.properties)
+                       for i in range(2) ]
+        config = ConfigParser.ConfigParser()
+        config.add_section('main')
+        config.set('main', 'push-host', '127.0.0.1')
+        config.set('main', 'push-port', str(self.port))
+        config.set('main', 'push-interval', '1')
+        _Pusher(config, FakeServer()).push()
+        for i in range(50):
+            try:
+                data = collectors[1].collect()
+                break
+            except GuestNetworkPush.CollectionError:
+                time.sleep(0.01)
+        self.assertEqual(data, { 'mem_available': 100, 'mem_unused': 10 })
+
+        # The socket is closed along with the last collector
+        listener = collectors[0].listener
+        del collectors[0]
+        self.assertTrue(listener.isAlive())
+        del collectors[0]
+        self.assertFalse(listener.isAlive())
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind(('127.0.0.1', self.port))
+        sock.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,100 @@
+# Memory Overcommitment Manager
+# Copyright (C) 2010 Adam Litke, IBM Corporation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public
+# License along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+
+# Run from the top level directory with:
+#   python -m mom.Collectors.TestGuestQemuProc
+
+import unittest
+import tempfile
+import shutil
+import os
+from mom.Collectors.GuestQemuProc import _QemuProcReader
+
+class TestQemuProcReader(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.reader = _QemuProcReader()
+        self.reader.stat_path = self.dir + "/%s/stat"
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write_stat(self, pid, minflt, majflt, rss, start=100):
+        """
+        Write the stat file of a fake process.  A new file replaces the old
+        one, like the stat file of a new process with the same pid.
+        """
+        fields = [ '0' ] * 40
+        fields[0] = 'S'
+        fields[7] = str(minflt)
+        fields[9] = str(majflt)
+        fields[19] = str(start)
+        fields[21] = str(rss)
+        path = self.reader.stat_path % pid
+        if not os.path.isdir(os.path.dirname(path)):
+            os.mkdir(os.path.dirname(path))
+        elif os.path.exists(path):
+            os.unlink(path)
+        f = open(path, 'w')
+        f.write("%s (qemu kvm) %s\n" % (pid, ' '.join(fields)))
+        f.close()
+
+    def test_shared_read(self):
+        self.write_stat(10, 1, 2, 3)
+        self.write_stat(11, 4, 5, 6)
+        for pid in (10, 11, 10):
+            self.reader.register(pid)
+        self.assertEqual(len(self.reader.procs), 2)
+        self.assertEqual(self.reader.procs[10][0], 2)
+        self.assertEqual(self.reader.get(10, 0), (1, 2, 3))
+
+        # One refresh reads every process
+        self.write_stat(10, 7, 8, 9)
+        self.write_stat(11, 10, 11, 12)
+        self.reader.last_refresh = 0
+        self.assertEqual(self.reader.get(10, 60), (1, 2, 3))
+        self.assertEqual(self.reader.get(11, 60), (4, 5, 6))
+
+    def test_unregister(self):
+        self.write_stat(10, 1, 2, 3)
+        self.reader.register(10)
+        self.reader.register(10)
+        self.reader.unregister(10)
+        self.assertEqual(self.reader.get(10, 0), (1, 2, 3))
+        f = self.reader.procs[10][1]
+        self.reader.unregister(10)
+        self.assertFalse(10 in self.reader.procs)
+        self.assertTrue(f.closed)
+
+    def test_pid_reuse(self):
+        self.write_stat(10, 1, 2, 3, start=100)
+        self.reader.register(10)
+        # The process exits and a new one gets the same pid while the old one
+        # is still registered
+        self.write_stat(10, 4, 5, 6, start=200)
+        self.reader.register(10)
+        self.assertEqual(self.reader.procs[10][0], 2)
+        self.assertEqual(self.reader.get(10, 0), (4, 5, 6))
+
+        # The stat file could not be read when the old process exited
+        self.reader.procs[10][1].close()
+        self.reader.get(10, 0)
+        self.assertEqual(self.reader.procs[10][1], None)
+        self.reader.register(10)
+        self.assertEqual(self.reader.get(10, 0), (4, 5, 6))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,101 @@
+# Memory Overcommitment Manager
+# Copyright (C) 2010 Adam Litke, IBM Corporation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public
+# License along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+
+# Run from the top level directory with: python -m mom.Collectors.TestHostKSM
+
+import unittest
+import tempfile
+import shutil
+import os
+from mom.Collectors.HostKSM import HostKSM
+
+class FakeGuestManager:
+    def __init__(self):
+        self.pids = []
+
+    def get_guest_pids(self):
+        return self.pids
+
+class TestHostKSM(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        sysfs_dir = "%s/ksm" % self.dir
+        os.mkdir(sysfs_dir)
+        for key in HostKSM.sysfs_keys:
+            self.write("%s/%s" % (sysfs_dir, key), "1\n")
+        os.mkdir("%s/proc" % self.dir)
+        self.process(2, 'ksmd')
+        self.process(10, 'qemu-kvm', 1000)
+        self.process(11, 'qemu-system-x86', 500)
+        self.process(12, 'bash', 2000)
+
+        class FakeHostKSM(HostKSM):
+            def get_ksmd_pid(self):
+                return 2
+        FakeHostKSM.sysfs_dir = sysfs_dir
+        FakeHostKSM.proc_dir = "%s/proc" % self.dir
+        self.guest_manager = FakeGuestManager()
+        self.ksm = FakeHostKSM({ 'guest_manager': self.guest_manager,
+                                 'config': { 'reconcile-interval': 60 } })
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, path, contents):
+        # Write the file in place so that open files see the new contents
+        f = open(path, 'w')
+        f.write(contents)
+        f.close()
+
+    def process(self, pid, name, pages=0):
+        path = "%s/proc/%i" % (self.dir, pid)
+        if not os.path.isdir(path):
+            os.mkdir(path)
+        self.write("%s/stat" % path, "%i (%s) S %s\n" % (pid, name,
+                                                           "0 " * 40))
+        self.write("%s/statm" % path, "%i 100 10 1 0 50 0\n" % pages)
+
+    def test_collect(self):
+        data = self.ksm.collect()
+        self.assertEqual(data['ksm_run'], 1)
+        # Only qemu processes are counted
+        self.assertEqual(data['ksm_shareable'], 1500 * self.ksm.page_kb)
+        self.assertTrue(data['ksm_shareable_time'] >= 0)
+        self.assertEqual(data['ksmd_cpu_usage'], 0)
+        self.assertEqual(set(data.keys()), self.ksm.getFields())
+
+    def test_guest_pids(self):
+        self.ksm.collect()
+        # New processes are only found by scanning at the next reconcile
+        self.process(13, 'qemu-kvm', 100)
+        self.process(14, 'qemu-kvm', 10)
+        self.guest_manager.pids = [ 14 ]
+        self.assertEqual(self.ksm.collect()['ksm_shareable'],
+                         1510 * self.ksm.page_kb)
+        self.ksm.next_reconcile = 0
+        self.assertEqual(self.ksm.collect()['ksm_shareable'],
+                         1610 * self.ksm.page_kb)
+
+    def test_exited(self):
+        self.ksm.collect()
+        # The statm file of an exited process reads as all zeros
+        self.process(10, 'qemu-kvm', 0)
+        self.assertEqual(self.ksm.collect()['ksm_shareable'],
+                         500 * self.ksm.page_kb)
+        self.assertEqual(sorted(self.ksm.qemu_statm.keys()), [ 11 ])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+# Memory Overcommitment Manager
+# Copyright (C) 2010 Adam Litke, IBM Corporation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public
+# License along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+
+# Run from the top level directory with: python -m mom.Collectors.TestProcFile
+
+import unittest
+import tempfile
+import os
+from mom.Collectors.Collector import FatalError
+from mom.Collectors.ProcFile import ProcFile, parse_keyvals
+
+meminfo = """MemTotal:        8000000 kB
+MemFree:         1000000 kB
+SwapCached:            5 kB
+Cached:           300000 kB
+Active(anon):     200000 kB
+Active:           400000 kB
+Inactive:         100000 kB
+"""
+
+class TestProcFile(unittest.TestCase):
+    def test_keys(self):
+        values = parse_keyvals(meminfo, [ 'MemTotal', 'Cached', 'Active' ])
+        self.assertEqual(values, { 'MemTotal': 8000000, 'Cached': 300000,
+                                   'Active': 400000 })
+        self.assertEqual(parse_keyvals(meminfo, [ 'Active(anon)' ]),
+                         { 'Active(anon)': 200000 })
+
+    def test_missing_keys(self):
+        values = parse_keyvals(meminfo, [ 'MemFree', 'Mem', 'Buffers' ])
+        self.assertEqual(values, { 'MemFree': 1000000 })
+        self.assertEqual(parse_keyvals("", [ 'MemFree' ]), {})
+
+    def test_vmstat(self):
+        vmstat = "pgfault 10\npgfault_extra 20\npgmajfault 30"
+        self.assertEqual(parse_keyvals(vmstat, [ 'pgfault', 'pgmajfault' ]),
+                         { 'pgfault': 10, 'pgmajfault': 30 })
+
+    def test_reread(self):
+        (fd, path) = tempfile.mkstemp()
+        try:
+            os.write(fd, meminfo)
+            # Read in several chunks
+            f = ProcFile(path, [ 'MemFree', 'Inactive' ], bufsize=16)
+            self.assertEqual(f.read(), { 'MemFree': 1000000,
+                                         'Inactive': 100000 })
+            os.ftruncate(fd, 0)
+            os.lseek(fd, 0, os.SEEK_SET)
+            os.write(fd, "MemFree: 7 kB\n")
+            self.assertEqual(f.read(), { 'MemFree': 7 })
+            f.close()
+        finally:
+            os.close(fd)
+            os.unlink(path)
+        self.assertRaises(FatalError, ProcFile, path, [ 'MemFree' ])
+
+if __name__ == '__main__':
+    unittest.main()
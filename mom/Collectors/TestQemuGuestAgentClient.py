@@ -0,0 +1,304 @@
+# Memory Overcommitment Manager
+# Copyright (C) 2010 Adam Litke, IBM Corporation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public
+# License along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+
+# Run from the top level directory with:
+#   python -m mom.Collectors.TestQemuGuestAgentClient
+
+import unittest
+import threading
+import tempfile
+import shutil
+import socket
+import json
+import base64
+import time
+from mom.CollectionEngine import CollectionEngine
+from mom.Collectors.Collector import CollectionError
+from mom.Collectors.QemuGuestAgentClient import *
+from mom.Collectors.GuestQemuAgent import GuestQemuAgent
+
+class FakeAgent(threading.Thread):
+    """
+    A qemu guest agent listening on a unix socket.  It serves files from a
+    dictionary.  A wedged agent accepts connections but never responds.  A
+    stale agent sends an extra response before each guest-sync response, as
+    if an earlier request had been abandoned.  Without seek, guest-file-seek
+    is not one of the agent's commands.
+    """
+    def __init__(self, path, files, wedged=False, stale=False, seek=True):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.files = files
+        self.wedged = wedged
+        self.stale = stale
+        self.seek = seek
+        self.handles = {}
+        self.next_handle = 1
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(path)
+        self.sock.listen(5)
+        self.start()
+
+    def handle(self, request):
+        command = request['execute']
+        args = request.get('arguments', {})
+        if command == 'guest-sync':
+            return { 'return': args['id'] }
+        if command == 'guest-ping':
+            return { 'return': {} }
+        if command == 'guest-file-seek' and not self.seek:
+            return { 'error': { 'class': 'CommandNotFound',
+                                'desc': 'The command guest-file-seek has '
+                                        'not been found' } }
+        if command == 'guest-file-open':
+            handle = self.next_handle
+            self.next_handle += 1
+            self.handles[handle] = [ args['path'], 0 ]
+            return { 'return': handle }
+        if args.get('handle') not in self.handles:
+            return { 'error': { 'class': 'InvalidParameter',
+                                'data': { 'name': 'handle' } } }
+        f = self.handles[args['handle']]
+        if command == 'guest-file-seek':
+            f[1] = args['offset']
+            return { 'return': { 'position': f[1], 'eof': False } }
+        if command == 'guest-file-read':
+            data = self.files[f[0]][f[1]:f[1] + args['count']]
+            f[1] += len(data)
+            return { 'return': { 'count': len(data),
+                                 'buf-b64': base64.b64encode(data),
+                                 'eof': f[1] >= len(self.files[f[0]]) } }
+        if command == 'guest-file-close':
+            del self.handles[args['handle']]
+            return { 'return': {} }
+
+    def serve(self, conn):
+        decoder = json.JSONDecoder()
+        buf = ''
+        while True:
+            data = conn.recv(4096)
+            if data == '':
+                return
+            if self.wedged:
+                continue
+            buf += data
+            while len(buf) > 0:
+                try:
+                    (request, end) = decoder.raw_decode(buf)
+                except ValueError:
+                    break
+                buf = buf[end:]
+                if self.stale and request['execute'] == 'guest-sync':
+                    conn.sendall(json.dumps({ 'return': 'stale' }) + '\n')
+                conn.sendall(json.dumps(self.handle(request)) + '\n')
+
+    def run(self):
+        while True:
+            (conn, addr) = self.sock.accept()
+            t = threading.Thread(target=self.serve, args=(conn,))
+            t.setDaemon(True)
+            t.start()
+
+class Call:
+    """
+    Adapt an agent API call for the CollectionEngine
+    """
+    def __init__(self, gen):
+        self.gen = gen
+
+    def collect_async(self):
+        return self.gen
+
+class TestAsyncClient(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.files = { '/proc/meminfo': 'MemTotal: 1000 kB\n' * 100 }
+        self.engine = CollectionEngine('TestEngine', 1, 1)
+        self.engine.start()
+
+    def tearDown(self):
+        self.engine.stop()
+        self.engine.join()
+        shutil.rmtree(self.dir)
+
+    def agent(self, name, **kwargs):
+        path = "%s/%s.agent" % (self.dir, name)
+        FakeAgent(path, self.files, **kwargs)
+        return AsyncQemuGuestAgentClient(path)
+
+    def run_calls(self, gens):
+        """
+        Run API calls concurrently on the engine.
+        Return: The list of their (result, error)
+        """
+        results = [ None ] * len(gens)
+        done = threading.Event()
+        def callback(i, data, error):
+            results[i] = (data, error)
+            if None not in results:
+                done.set()
+        for (i, gen) in enumerate(gens):
+            self.engine.submit(Call(gen), lambda data, error, i=i: \
+                               callback(i, data, error))
+        done.wait(5)
+        return results
+
+    def read_file(self, client, path):
+        """
+        A coroutine which reads a whole file in one round trip
+        """
+        for item in client.api.file_open(path):
+            if isinstance(item, Wait):
+                yield item
+            else:
+                handle = item.data
+        batch = client.batch()
+        batch.file_read(handle, 65536)
+        batch.file_close(handle)
+        for item in batch.run():
+            if isinstance(item, Wait):
+                yield item
+            else:
+                yield item[0].data['buf']
+
+    def test_many_agents(self):
+        clients = [ self.agent('vm%i' % i) for i in range(50) ]
+        results = self.run_calls([ self.read_file(c, '/proc/meminfo')
+                                   for c in clients ])
+        expected = (self.files['/proc/meminfo'], None)
+        self.assertEqual(results, [ expected ] * len(clients))
+        # Connecting costs one exchange for the guest-sync
+        self.assertEqual([ c.round_trips for c in clients ],
+                         [ 3 ] * len(clients))
+
+    def test_stale_responses(self):
+        client = self.agent('stale', stale=True)
+        for i in range(2):
+            [ (ret, error) ] = self.run_calls([ client.api.ping() ])
+            self.assertEqual(error, None)
+            self.assertEqual((ret.error, ret.data), (None, {}))
+            # Resynchronize before the next call
+            client.synced = False
+
+    def test_one_call_at_a_time(self):
+        client = self.agent('busy')
+        results = self.run_calls([ client.api.ping(), client.api.ping() ])
+        self.assertEqual(results[0][0].data, {})
+        self.assertTrue(isinstance(results[1][1], ProtocolError))
+
+    def test_wedged_agent(self):
+        good = self.agent('good')
+        wedged = self.agent('wedged', wedged=True)
+        start = time.time()
+        results = self.run_calls([ good.api.ping(), wedged.api.ping() ])
+        self.assertEqual(results[0][0].data, {})
+        self.assertTrue(isinstance(results[1][1], Exception))
+        self.assertTrue(time.time() - start < 2)
+
+        # The wedged agent is not retried until its backoff has passed
+        self.assertEqual(wedged.backoff, wedged.min_backoff)
+        results = self.run_calls([ wedged.api.ping() ])
+        self.assertTrue(isinstance(results[0][1], ProtocolError))
+
+    def test_backoff(self):
+        client = AsyncQemuGuestAgentClient("%s/missing.agent" % self.dir)
+        for expected in (1, 2, 4):
+            client.next_attempt = 0
+            self.assertRaises(ProtocolError, client.api.ping().next)
+            self.assertEqual(client.backoff, expected)
+
+class TestGuestQemuAgent(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.files = { '/proc/meminfo': 'MemTotal: 1000 kB\n'
+                                        'MemFree: 100 kB\n'
+                                        'Buffers: 10 kB\n'
+                                        'Cached: 20 kB\n',
+                       '/proc/vmstat': 'pgfault 5\npgmajfault 1\n'
+                                       'pswpin 7\npswpout 8\n' }
+        self.engine = CollectionEngine('TestEngine', 1, 1)
+        self.engine.start()
+
+    def tearDown(self):
+        self.engine.stop()
+        self.engine.join()
+        shutil.rmtree(self.dir)
+
+    def collector(self, name, **kwargs):
+        self.agent = FakeAgent("%s/%s.agent" % (self.dir, name), self.files,
+                               **kwargs)
+        return GuestQemuAgent({ 'name': name,
+                                'config': { 'socket_path': self.dir } })
+
+    def collect_async(self, collector):
+        results = []
+        done = threading.Event()
+        def callback(data, error):
+            results.append((data, error))
+            done.set()
+        self.engine.submit(collector, callback)
+        done.wait(5)
+        return results[0]
+
+    def check(self, data, round_trips):
+        self.assertEqual((data['mem_available'], data['mem_free'],
+                          data['minor_fault'], data['agent_round_trips']),
+                         (1000, 130, 5, round_trips))
+
+    def test_seek(self):
+        collector = self.collector('seek')
+        self.check(collector.collect(), 2)
+        # The open files are read again in one exchange
+        for i in range(2):
+            self.check(collector.collect(), 1)
+        self.assertEqual(len(self.agent.handles), 2)
+
+    def test_no_seek(self):
+        collector = self.collector('noseek', seek=False)
+        self.check(collector.collect(), 4)
+        self.assertFalse(collector.seek_supported)
+        # The files are reopened for each collection without trying to seek,
+        # and the old handles are closed at the same time
+        for i in range(2):
+            self.check(collector.collect(), 2)
+        self.assertEqual(len(self.agent.handles), 2)
+
+    def test_no_seek_async(self):
+        collector = self.collector('noseek', seek=False)
+        # The first collection also synchronizes the channel
+        for round_trips in (5, 2, 2):
+            (data, error) = self.collect_async(collector)
+            self.assertEqual(error, None)
+            self.check(data, round_trips)
+        self.assertEqual(len(self.agent.handles), 2)
+
+    def test_error_text(self):
+        collector = self.collector('disabled')
+        handle = self.agent.handle
+        def disabled_open(request):
+            if request['execute'] == 'guest-file-open':
+                return { 'error': { 'class': 'GenericError',
+                                    'desc': 'Command has been disabled' } }
+            return handle(request)
+        self.agent.handle = disabled_open
+        try:
+            collector.collect()
+            self.fail("collect() did not fail")
+        except CollectionError, e:
+            self.assertTrue('Command has been disabled' in str(e))
+
+if __name__ == '__main__':
+    unittest.main()
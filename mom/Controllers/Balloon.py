@@ -22,6 +22,9 @@ class Balloon:
     a guest's memory balloon.  Output triggers are:
         - balloon_target - Set guest balloon to this size (kB)
     """
+    # The statistics read by this controller
+    fields = set(['balloon_cur'])
+
     def __init__(self, properties):
         self.hypervisor_iface = properties['hypervisor_iface']
         self.logger = logging.getLogger('mom.Controllers.Balloon')
@@ -24,6 +24,9 @@ class KSM:
         - ksm_pages_to_scan - Set the number of pages to be scanned per work unit
         - ksm_sleep_millisecs - Set the time to sleep between scans
     """
+    # The statistics read by this controller
+    fields = set()
+
     def __init__(self, properties):
         self.hypervisor_iface = properties['hypervisor_iface']
         self.logger = logging.getLogger('mom.Controllers.KSM')
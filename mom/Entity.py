@@ -14,6 +14,8 @@
 # License along with this program; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
 
+from mom.StatsBuffer import StatsBuffer, StatsView
+
 class EntityError(Exception):
     def __init__(self, message):
         self.message = message
@@ -28,7 +30,10 @@ class Entity:
     def __init__(self, monitor=None):
         self.properties = {}
         self.variables = {}
-        self.statistics = []
+        # A read-only StatsView of the Monitor's recent samples
+        self.statistics = StatsBuffer([], 0).view()
+        # The age of each statistic in the most recent sample
+        self.stat_ages = {}
         self.controls = {}
         self.monitor = monitor
 
@@ -39,8 +44,23 @@ class Entity:
         self.variables[name] = val
 
     def _set_statistics(self, stats):
-        for row in stats:
-            self.statistics.append(row)
+        """
+        Set the statistics from a StatsView or from a list of sample
+        dictionaries
+        """
+        if not isinstance(stats, StatsView):
+            stats = list(stats)
+            fields = []
+            if len(stats) > 0:
+                fields = stats[0].keys()
+            buffer = StatsBuffer(fields, len(stats))
+            for row in stats:
+                buffer.append(row)
+            stats = buffer.view()
+        self.statistics = stats
+
+    def _set_stat_ages(self, ages):
+        self.stat_ages = ages
 
     def _store_variables(self):
         """
@@ -56,8 +76,8 @@ class Entity:
         # Add the most-recent stats to the top-level namespace for easy access
         # from within rules scripts.
         if len(self.statistics) > 0:
-            for stat in self.statistics[-1].keys():
-                setattr(self, stat, self.statistics[-1][stat])
+            for (stat, val) in self.statistics[-1].items():
+                setattr(self, stat, val)
 
     def _disp(self, name=''):
         """
@@ -91,7 +111,19 @@ class Entity:
         Returns None if no statistics are available
         """
         if len(self.statistics) > 0:
-            return self.statistics[-1][name]
+            return self.statistics.latest(name)
+        else:
+            return None
+
+    def StatAge(self, name):
+        """
+        Get the age in seconds of the most-recently recorded value of a
+        statistic.  It is more than zero when the statistic comes from a
+        collector with a longer interval and was carried forward.
+        Returns None if no statistics are available
+        """
+        if len(self.statistics) > 0:
+            return self.stat_ages.get(name, 0)
         else:
             return None
 
@@ -101,10 +133,42 @@ class Entity:
         """
         if (len(self.statistics) == 0):
             raise EntityError("Statistic '%s' not available" % name)
-        total = 0
-        for row in self.statistics:
-            total = total + row[name]
-        return float(total / len(self.statistics))
+        return float(self.statistics.sum(name) / len(self.statistics))
+
+    def StatMin(self, name):
+        """
+        Get the smallest recent value of a statistic.
+        """
+        if (len(self.statistics) == 0):
+            raise EntityError("Statistic '%s' not available" % name)
+        return self.statistics.min(name)
+
+    def StatMax(self, name):
+        """
+        Get the largest recent value of a statistic.
+        """
+        if (len(self.statistics) == 0):
+            raise EntityError("Statistic '%s' not available" % name)
+        return self.statistics.max(name)
+
+    def StatStdDev(self, name):
+        """
+        Calculate the standard deviation of a statistic using all recent values.
+        """
+        if (len(self.statistics) == 0):
+            raise EntityError("Statistic '%s' not available" % name)
+        return self.statistics.stddev(name)
+
+    def StatEWMA(self, name, alpha):
+        """
+        Calculate the exponentially weighted moving average of a statistic.
+        alpha is the weight (between 0 and 1) given to each new value.
+        """
+        if (len(self.statistics) == 0):
+            raise EntityError("Statistic '%s' not available" % name)
+        if alpha <= 0 or alpha > 1:
+            raise EntityError("Invalid EWMA weight: %s" % alpha)
+        return self.statistics.ewma(name, alpha)
 
     def SetVar(self, name, val):
         """
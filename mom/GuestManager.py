@@ -16,16 +16,26 @@
 
 import threading
 import time
+import Queue
 import sys
 import re
 import logging
 from mom.GuestMonitor import GuestMonitor
+from mom.Scheduler import Scheduler
+from mom.CollectionEngine import CollectionEngine
 
 class GuestManager(threading.Thread):
     """
     The GuestManager thread maintains a list of currently active guests on the
-    system.  When a new guest is discovered, a new GuestMonitor is spawned.
+    system.  When a new guest is discovered, a new GuestMonitor is created and
+    scheduled for periodic collection on a bounded pool of worker threads.
     When GuestMonitors stop running, they are removed from the list.
+
+    If the hypervisor interface reports guest lifecycle events, guests are
+    added and removed as soon as they start and stop.  The list of guests is
+    then only polled once per guest-reconcile-interval to catch missed events.
+    A guest whose information is not available yet when it starts is retried
+    once per guest-manager-interval until the next poll.
     """
     def __init__(self, config, hypervisor_iface):
         threading.Thread.__init__(self, name='GuestManager')
@@ -35,6 +45,23 @@ class GuestManager(threading.Thread):
         self.logger = logging.getLogger('mom.GuestManager')
         self.guests = {}
         self.guests_sem = threading.Semaphore()
+        self.events = Queue.Queue()
+        # The uuids of started guests whose monitors could not be created yet,
+        # indexed by id
+        self.pending = {}
+        self.used_fields = None
+        workers = max(1, self.config.getint('main', 'guest-worker-threads'))
+        self.engine = None
+        if self.config.getboolean('main', 'async-guest-collection'):
+            timeout = self.config.getfloat('main', 'collector-timeout')
+            self.engine = CollectionEngine('GuestCollectionEngine', workers,
+                                           timeout)
+            self.engine.start()
+            # Scheduled jobs only start collections, the engine's executors
+            # run the collectors that block
+            workers = 1
+        self.scheduler = Scheduler('GuestScheduler', workers)
+        self.scheduler.start()
         self.start()
 
     def spawn_guest_monitors(self, domain_list):
@@ -42,56 +69,129 @@ class GuestManager(threading.Thread):
         Get the list of running domains and spawn GuestMonitors for any guests
         we are not already tracking.  The GuestMonitor constructor might block
         so don't hold guests_sem while calling it.
+        Return: The list of ids whose information could not be retrieved
         """
+        failed = []
         self.guests_sem.acquire()
         spawn_list = set(domain_list) - set(self.guests)
         self.guests_sem.release()
+        interval = self.config.getint('main', 'guest-monitor-interval')
         for id in spawn_list:
             info = self.hypervisor_iface.getVmInfo(id)
             if info is None:
                 self.logger.error("Failed to get guest:%s information -- monitor "\
                     "can't start", id)
+                failed.append(id)
                 continue
             guest = GuestMonitor(self.config, info, self.hypervisor_iface)
-            if guest.isAlive():
+            guest.set_used_fields(self.used_fields)
+            if guest.isRunning():
                 self.guests_sem.acquire()
                 if id not in self.guests:
                     self.guests[id] = guest
+                    self.scheduler.add(id, self._collect_fn(guest), interval,
+                                       guest.isRunning)
                 else:
                     del guest
                 self.guests_sem.release()
+        return failed
+
+    def _collect_fn(self, guest):
+        """
+        Return: The function that runs one collection for a guest
+        """
+        if self.engine is None:
+            return guest.collect
+        engine = self.engine
+        return lambda: guest.collect_async(engine)
 
     def wait_for_guest_monitors(self):
         """
-        Wait for GuestMonitors to exit
+        Stop all GuestMonitors and wait for the scheduler to exit
         """
-        while True:
-            self.guests_sem.acquire()
-            if len(self.guests) > 0:
-                (id, thread) = self.guests.popitem()
-            else:
-                id = None
-            self.guests_sem.release()
-            if id is not None:
-                thread.join(0)
-            else:
-                break
+        self.guests_sem.acquire()
+        for (id, monitor) in self.guests.items():
+            monitor.terminate()
+            self.scheduler.remove(id)
+        self.guests.clear()
+        self.guests_sem.release()
+        self.scheduler.stop()
+        self.scheduler.join(5)
+        if self.engine is not None:
+            self.engine.stop()
+            self.engine.join(5)
 
     def check_threads(self, domain_list):
         """
-        Check for stale and/or deceased threads and remove them.
+        Check for stale and/or stopped monitors and remove them.
         """
         self.guests_sem.acquire()
-        for (id, thread) in self.guests.items():
-            # Check if the thread has died
-            if not thread.isAlive():
-                del self.guests[id]
+        for (id, monitor) in self.guests.items():
+            # Check if the monitor has stopped
+            if not monitor.isRunning():
+                self._remove_monitor(id)
             # Check if the domain has ended according to hypervisor interface
             elif id not in domain_list:
-                thread.terminate()
-                del self.guests[id]
+                self._remove_monitor(id)
+        self.guests_sem.release()
+
+    def remove_guest(self, uuid):
+        """
+        Stop monitoring the guest with the given uuid
+        """
+        self.guests_sem.acquire()
+        for (id, monitor) in self.guests.items():
+            if monitor.getGuestUUID() == uuid:
+                self._remove_monitor(id)
         self.guests_sem.release()
 
+    def _remove_monitor(self, id):
+        """
+        Stop a GuestMonitor and forget about it.  guests_sem must be held.
+        """
+        self.guests[id].terminate()
+        self.scheduler.remove(id)
+        del self.guests[id]
+
+    def guest_event(self, event, id, uuid):
+        """
+        Handle a guest lifecycle event from the hypervisor interface.  This is
+        called on the hypervisor interface's thread so just queue the event.
+        """
+        self.events.put((event, id, uuid))
+
+    def _process_event(self, event, id, uuid):
+        self.logger.debug("Guest %s (id %s) %s", uuid, id, event)
+        if event == 'started':
+            # The qemu process may not be fully set up yet
+            for failed in self.spawn_guest_monitors([id]):
+                self.pending[failed] = uuid
+        elif event == 'stopped':
+            for (pending_id, pending_uuid) in self.pending.items():
+                if pending_uuid == uuid:
+                    del self.pending[pending_id]
+            self.remove_guest(uuid)
+
+    def retry_pending(self):
+        """
+        Try again to spawn GuestMonitors for started guests that failed
+        """
+        retry = self.pending
+        self.pending = {}
+        for id in self.spawn_guest_monitors(retry.keys()):
+            self.pending[id] = retry[id]
+
+    def reconcile(self):
+        """
+        Bring the list of monitored guests in line with the running guests
+        """
+        domain_list = self.hypervisor_iface.getVmList()
+        if domain_list is not None:
+            # Guests that still fail are retried at the next reconcile
+            self.pending.clear()
+            self.spawn_guest_monitors(domain_list)
+            self.check_threads(domain_list)
+
     def interrogate(self):
         """
         Interrogate all active GuestMonitors
@@ -109,15 +209,70 @@ class GuestManager(threading.Thread):
     def run(self):
         self.logger.info("Guest Manager starting");
         interval = self.config.getint('main', 'guest-manager-interval')
+        if self.hypervisor_iface.registerGuestEventHandler(self.guest_event):
+            self.logger.info("Using guest lifecycle events")
+            poll_interval = self.config.getint('main',
+                                               'guest-reconcile-interval')
+        else:
+            poll_interval = interval
+        next_poll = 0
+        next_retry = 0
         while self.config.getint('__int__', 'running') == 1:
-            domain_list = self.hypervisor_iface.getVmList()
-            if domain_list is not None:
-                self.spawn_guest_monitors(domain_list)
-                self.check_threads(domain_list)
-            time.sleep(interval)
+            if time.time() >= next_poll:
+                self.reconcile()
+                next_poll = time.time() + poll_interval
+            elif len(self.pending) > 0 and time.time() >= next_retry:
+                self.retry_pending()
+                next_retry = time.time() + interval
+            if len(self.pending) == 0:
+                next_retry = time.time() + interval
+            # Wake up at least once per interval to check for shutdown
+            timeout = max(0, min(next_poll, next_retry) - time.time())
+            timeout = min(timeout, interval)
+            try:
+                (event, id, uuid) = self.events.get(True, timeout)
+            except Queue.Empty:
+                continue
+            self._process_event(event, id, uuid)
         self.wait_for_guest_monitors()
         self.logger.info("Guest Manager ending")
 
+    def set_used_fields(self, fields):
+        """
+        Pass the statistics read by the policy on to all GuestMonitors
+        """
+        self.guests_sem.acquire()
+        self.used_fields = fields
+        for monitor in self.guests.values():
+            monitor.set_used_fields(fields)
+        self.guests_sem.release()
+
+    def get_active_collectors(self):
+        """
+        Return: The names of the active collectors of each ready guest
+        """
+        ret = {}
+        self.guests_sem.acquire()
+        for monitor in self.guests.values():
+            name = monitor.getGuestName()
+            if monitor.isReady() and name is not None:
+                ret[name] = monitor.get_active_collectors()
+        self.guests_sem.release()
+        return ret
+
+    def get_guest_pids(self):
+        """
+        Return: The list of the qemu process ids of all monitored guests
+        """
+        ret = []
+        self.guests_sem.acquire()
+        for monitor in self.guests.values():
+            pid = monitor.properties.get('pid')
+            if pid is not None:
+                ret.append(pid)
+        self.guests_sem.release()
+        return ret
+
     def rpc_get_active_guests(self):
         ret = []
         self.guests_sem.acquire()
@@ -14,30 +14,30 @@
 # License along with this program; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
 
-import threading
 import ConfigParser
-import time
 import re
 import logging
 from mom.Monitor import Monitor
 from mom.Collectors import Collector
 
 
-class GuestMonitor(Monitor, threading.Thread):
+class GuestMonitor(Monitor):
     """
-    A GuestMonitor thread collects and reports statistics about 1 running guest
+    A GuestMonitor collects and reports statistics about 1 running guest.  It
+    has no thread of its own: the GuestManager's scheduler calls collect() once
+    per guest-monitor-interval.
     """
     def __init__(self, config, info, hypervisor_iface):
-        threading.Thread.__init__(self, name="guest:%s" % id)
         self.config = config
         self.logger = logging.getLogger('mom.GuestMonitor')
 
-        self.setName("GuestMonitor-%s" % info['name'])
-        Monitor.__init__(self, config, self.getName())
-        self.setDaemon(True)
+        Monitor.__init__(self, config, "GuestMonitor-%s" % info['name'])
         self.data_sem.acquire()
         self.properties.update(info)
         self.properties['hypervisor_iface'] = hypervisor_iface
+        # GuestQemuProc shares stat file reads between guests in an interval
+        self.properties['interval'] = self.config.getint('main',
+                                                'guest-monitor-interval')
         self.data_sem.release()
 
         collector_list = self.config.get('guest', 'collectors')
@@ -45,16 +45,12 @@ class GuestMonitor(Monitor, threading.Thread):
                             self.properties, self.config)
         if self.collectors is None:
             self.logger.error("Guest Monitor initialization failed")
-            return
-        self.start()
-                            
-    def run(self):
-        self.logger.info("%s starting", self.getName())
-        interval = self.config.getint('main', 'guest-monitor-interval')
-        while self._should_run():
-            self.collect()
-            time.sleep(interval)
-        self.logger.info("%s ending", self.getName())
+
+    def isRunning(self):
+        """
+        Check if this monitor should still be collecting statistics
+        """
+        return self.collectors is not None and self._should_run()
 
     def getGuestName(self):
         """
@@ -65,3 +61,9 @@ class GuestMonitor(Monitor, threading.Thread):
             return self.properties['name']
         except KeyError:
             return None
+
+    def getGuestUUID(self):
+        try:
+            return self.properties['uuid']
+        except KeyError:
+            return None
@@ -26,16 +26,17 @@ class HostMonitor(Monitor, threading.Thread):
     """
     The Host Monitor thread collects and reports statistics about the host.
     """
-    def __init__(self, config):
+    def __init__(self, config, guest_manager=None):
         threading.Thread.__init__(self, name="HostMonitor")
         Monitor.__init__(self, config, self.getName())
         self.setDaemon(True)
         self.config = config
         self.logger = logging.getLogger('mom.HostMonitor')
         self.interval = self.config.getint('main', 'host-monitor-interval')
-        # Append monitor interval to properties because HostKSM needs it
-        # to calculate ksmd cpu usage.
+        # Append monitor interval to properties for the collectors
         self.properties['interval'] = self.interval
+        # HostKSM reads the memory size of the guests' qemu processes
+        self.properties['guest_manager'] = guest_manager
         collector_list = self.config.get('host', 'collectors')
         self.collectors = Collector.get_collectors(collector_list,
                             self.properties, self.config)
@@ -28,6 +28,15 @@ class HypervisorInterface:
         """
         pass
 
+    def registerGuestEventHandler(self, handler):
+        """
+        This method asks to be told when guests start and stop.  The handler
+        is called as handler(event, id, uuid) where event is 'started' or
+        'stopped', possibly from another thread.  It returns True if lifecycle
+        events are supported, otherwise the list of guests must be polled.
+        """
+        return False
+
     def getVmInfo(self, uuid):
         """
         This method returns basic information of a given guest, including
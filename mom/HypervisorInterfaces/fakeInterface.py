@@ -0,0 +1,97 @@
+# Memory Overcommitment Manager
+# Copyright (C) 2010 Adam Litke, IBM Corporation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public
+# License along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+
+import os
+import threading
+import logging
+from mom.HypervisorInterfaces.HypervisorInterface import *
+
+class fakeInterface(HypervisorInterface):
+    """
+    fakeInterface is a hypervisor interface for testing.  It has no real
+    guests: they are started and stopped by calling startVm() and stopVm(),
+    which also deliver the lifecycle events.  Every guest reports the pid of
+    the current process.
+    """
+    def __init__(self, config):
+        self.logger = logging.getLogger('mom.fakeInterface')
+        self.lock = threading.Lock()
+        # Running guests: id -> (name, uuid)
+        self.domains = {}
+        self.next_id = 1
+        self.event_handler = None
+        self.balloon = {}
+
+    def startVm(self, name, notify=True):
+        """
+        Start a fake guest.  If notify is False, no event is delivered.
+        Return: The id of the new guest
+        """
+        self.lock.acquire()
+        dom_id = self.next_id
+        self.next_id += 1
+        uuid = "00000000-0000-0000-0000-%012x" % dom_id
+        self.domains[dom_id] = (name, uuid)
+        self.balloon[uuid] = 1048576
+        self.lock.release()
+        if notify and self.event_handler is not None:
+            self.event_handler('started', dom_id, uuid)
+        return dom_id
+
+    def stopVm(self, dom_id, notify=True):
+        self.lock.acquire()
+        (name, uuid) = self.domains.pop(dom_id)
+        self.lock.release()
+        if notify and self.event_handler is not None:
+            self.event_handler('stopped', -1, uuid)
+
+    def registerGuestEventHandler(self, handler):
+        self.event_handler = handler
+        return True
+
+    def getVmList(self):
+        self.lock.acquire()
+        ret = self.domains.keys()
+        self.lock.release()
+        return ret
+
+    def getVmInfo(self, id):
+        self.lock.acquire()
+        try:
+            (name, uuid) = self.domains[id]
+        except KeyError:
+            return None
+        finally:
+            self.lock.release()
+        return { 'name': name, 'uuid': uuid, 'pid': os.getpid() }
+
+    def getStatsFields(self):
+        return set()
+
+    def getVmMemoryStats(self, uuid):
+        return {}
+
+    def getVmBalloonInfo(self, uuid):
+        return { 'balloon_max': 1048576, 'balloon_cur': self.balloon[uuid] }
+
+    def setVmBalloonTarget(self, uuid, target):
+        self.balloon[uuid] = target
+
+    def ksmTune(self, tuningParams):
+        pass
+
+def instance(config):
+    return fakeInterface(config)
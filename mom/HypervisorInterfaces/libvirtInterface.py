@@ -15,23 +15,130 @@
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
 
 import libvirt
-import re
+import os
+import time
+import threading
 import logging
-from subprocess import *
+from collections import OrderedDict
 from mom.HypervisorInterfaces.HypervisorInterface import *
 
+# Where libvirt keeps the pidfiles of qemu domains
+qemu_run_dirs = [ '/var/run/libvirt/qemu', '/run/libvirt/qemu' ]
+
+def _procStartTime(pid):
+    """
+    Return: The start time of a process (in clock ticks since boot) or None
+    """
+    try:
+        f = open('/proc/%i/stat' % pid, 'r')
+        try:
+            stat = f.read()
+        finally:
+            f.close()
+    except IOError:
+        return None
+    # The command name may contain spaces so skip past it
+    return int(stat[stat.rindex(')') + 2:].split()[19])
+
+def _procUUID(pid):
+    """
+    Return: The value of the -uuid option on the command line of a process
+    """
+    try:
+        f = open('/proc/%i/cmdline' % pid, 'r')
+        try:
+            args = f.read().split('\0')
+        finally:
+            f.close()
+    except IOError:
+        return None
+    try:
+        return args[args.index('-uuid') + 1]
+    except (ValueError, IndexError):
+        return None
+
+class DomainCache:
+    """
+    A bounded, thread-safe cache of virDomain handles indexed by uuid.  When
+    it is full, the least recently used handle is dropped.  Lookups are
+    counted as hits and misses.
+    """
+    def __init__(self, size=1024):
+        self.size = size
+        self.domains = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, uuid):
+        self.lock.acquire()
+        try:
+            dom = self.domains.pop(uuid, None)
+            if dom is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.domains[uuid] = dom
+            return dom
+        finally:
+            self.lock.release()
+
+    def add(self, uuid, dom):
+        self.lock.acquire()
+        try:
+            self.domains.pop(uuid, None)
+            self.domains[uuid] = dom
+            if len(self.domains) > self.size:
+                self.domains.popitem(last=False)
+        finally:
+            self.lock.release()
+
+    def invalidate(self, uuid):
+        self.lock.acquire()
+        self.domains.pop(uuid, None)
+        self.lock.release()
+
+    def clear(self):
+        self.lock.acquire()
+        self.domains.clear()
+        self.lock.release()
+
+    def __str__(self):
+        return "%i domains, %i hits, %i misses" % (len(self.domains),
+                                                   self.hits, self.misses)
+
 class libvirtInterface(HypervisorInterface):
     """
     libvirtInterface provides a wrapper for the libvirt API so that libvirt-
     related error handling can be consolidated in one place.  An instance of
     this class provides a single libvirt connection that can be shared by all
     threads.  If the connection is broken, an attempt will be made to reconnect.
+
+    Domain lifecycle events are delivered by the default libvirt event loop,
+    which runs on a thread of its own.
     """
     def __init__(self, config):
         self.conn = None
         self.uri = config.get('main', 'libvirt-hypervisor-uri')
         self.logger = logging.getLogger('mom.libvirtInterface')
+        self.event_handler = None
+        # uuid -> (pid, start time) of the qemu process of each domain
+        self.pid_cache = {}
+        # uuid -> pids of all qemu processes, from scanning /proc
+        self.pid_index = {}
+        self.pid_index_time = 0
+        self.pid_index_max_age = 1
+        self.domain_cache = DomainCache()
+        # A snapshot of the balloon statistics of all active domains, shared
+        # by all guests collected in the same tick
+        self.bulk_stats = {}
+        self.bulk_stats_time = 0
+        self.bulk_stats_max_age = \
+            config.getint('main', 'guest-monitor-interval') / 2.0
+        self.bulk_stats_supported = True
+        self.bulk_stats_lock = threading.Lock()
         libvirt.registerErrorHandler(self._error_handler, None)
+        self._start_event_loop()
         self._connect()
         self._setStatsFields()
 
@@ -50,8 +157,69 @@ class libvirtInterface(HypervisorInterface):
         except libvirt.libvirtError, e:
             self.logger.error("libvirtInterface: error setting up " \
                     "connection: %s", e.message)
+            return
+        # Callbacks do not survive the connection
+        if self.event_handler is not None:
+            self._registerLifecycleEvents()
+
+    def _start_event_loop(self):
+        """
+        The event loop implementation must be registered before the connection
+        is opened.
+        """
+        self.event_loop = None
+        try:
+            libvirt.virEventRegisterDefaultImpl()
+        except (AttributeError, libvirt.libvirtError):
+            self.logger.info("libvirtInterface: domain events are not "\
+                             "supported by this version of libvirt")
+            return
+        self.event_loop = threading.Thread(target=self._run_event_loop,
+                                           name='libvirtEventLoop')
+        self.event_loop.setDaemon(True)
+        self.event_loop.start()
+
+    def _run_event_loop(self):
+        while True:
+            try:
+                if libvirt.virEventRunDefaultImpl() < 0:
+                    time.sleep(1)
+            except libvirt.libvirtError, e:
+                self.logger.warn("libvirtInterface: event loop error: %s",
+                                 e.message)
+                time.sleep(1)
+
+    def _registerLifecycleEvents(self):
+        try:
+            self.conn.domainEventRegisterAny(None,
+                    libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE,
+                    self._lifecycleEvent, None)
+        except (AttributeError, libvirt.libvirtError), e:
+            self.logger.warn("libvirtInterface: unable to register for "\
+                             "domain events: %s", e)
+            return False
+        return True
+
+    def _lifecycleEvent(self, conn, domain, event, detail, opaque):
+        """
+        Report domains that start or stop.  Starting includes incoming
+        migration and stopping includes outgoing migration and crashes.
+        """
+        try:
+            # The ID of a stopped domain is no longer valid
+            dom_id = domain.ID()
+            uuid = domain.UUIDString()
+        except libvirt.libvirtError:
+            return
+        self.domain_cache.invalidate(uuid)
+        if event == libvirt.VIR_DOMAIN_EVENT_STARTED:
+            self.event_handler('started', dom_id, uuid)
+        elif event == libvirt.VIR_DOMAIN_EVENT_STOPPED:
+            self.event_handler('stopped', dom_id, uuid)
 
     def _reconnect(self):
+        # Domain handles belong to the old connection
+        self.domain_cache.clear()
         try:
             self.conn.close()
         except libvirt.libvirtError:
@@ -73,12 +241,16 @@ class libvirtInterface(HypervisorInterface):
             return dom
 
     def _getDomainFromUUID(self, dom_uuid):
+        dom = self.domain_cache.get(dom_uuid)
+        if dom is not None:
+            return dom
         try:
             dom = self.conn.lookupByUUIDString(dom_uuid)
         except libvirt.libvirtError, e:
             self._handleException(e)
             return None
         else:
+            self.domain_cache.add(dom_uuid, dom)
             return dom
 
     def _domainIsRunning(self, domain):
@@ -86,14 +258,14 @@ class libvirtInterface(HypervisorInterface):
             if domain.info()[0] == libvirt.VIR_DOMAIN_RUNNING:
                 return True
         except libvirt.libvirtError, e:
-            self._handleException(e)
+            self._handleException(e, domain)
         return False
 
     def _domainGetName(self, domain):
         try:
             name = domain.name()
         except libvirt.libvirtError, e:
-            self._handleException(e)
+            self._handleException(e, domain)
             return None
         return name
 
@@ -101,7 +273,7 @@ class libvirtInterface(HypervisorInterface):
         try:
             uuid = domain.UUIDString()
         except libvirt.libvirtError, e:
-            self._handleException(e)
+            self._handleException(e, domain)
             return None
         return uuid
 
@@ -109,38 +281,104 @@ class libvirtInterface(HypervisorInterface):
         try:
             info = domain.info()
         except libvirt.libvirtError, e:
-            self._handleException(e)
+            self._handleException(e, domain)
             return None
         return info
 
-    def _domainGetPid(self, uuid):
+    def _domainGetPid(self, uuid, name):
+        """
+        Find the pid of the qemu process associated with this guest.  libvirt
+        records it in a pidfile named after the domain.  Failing that, look for
+        the process with our uuid on its command line.  Results are cached and
+        checked against the start time of the process in case the pid has been
+        reused.
+        """
+        if uuid is None or name is None:
+            return None
+        cached = self.pid_cache.get(uuid)
+        if cached is not None:
+            if _procStartTime(cached[0]) == cached[1]:
+                return cached[0]
+            del self.pid_cache[uuid]
+
+        pid = self._pidFromPidfile(uuid, name)
+        if pid is None:
+            pid = self._pidFromCmdline(uuid)
+        if pid is None:
+            return None
+        start = _procStartTime(pid)
+        if start is not None:
+            self.pid_cache[uuid] = (pid, start)
+        return pid
+
+    def _pidFromPidfile(self, uuid, name):
+        for run_dir in qemu_run_dirs:
+            try:
+                f = open("%s/%s.pid" % (run_dir, name), 'r')
+                try:
+                    pid = int(f.read().strip())
+                finally:
+                    f.close()
+            except (IOError, ValueError):
+                continue
+            # The pidfile may belong to an earlier domain with the same name
+            if _procUUID(pid) == uuid:
+                return pid
+        return None
+
+    def _pidFromCmdline(self, uuid):
         """
-        This is an ugly way to find the pid of the qemu process associated with
-        this guest.  Scan ps output looking for our uuid and record the pid.
-        Something is probably wrong if more or less than 1 match is returned.
+        Look the uuid up in an index of the qemu processes on the system.  The
+        index is rebuilt when the uuid is missing, but not more often than
+        once per pid_index_max_age seconds.  This bounds the number of scans
+        of /proc when many guests start at once.
         """
-        p1 = Popen(["ps", "axww"], stdout=PIPE).communicate()[0]
-        matches = re.findall("^\s*(\d+)\s+.*" + uuid, p1, re.M)
-        if len(matches) < 1:
+        pids = self.pid_index.get(uuid, [])
+        if len(pids) == 1 and _procUUID(pids[0]) != uuid:
+            pids = []
+        if len(pids) == 0 and \
+                time.time() - self.pid_index_time >= self.pid_index_max_age:
+            self._buildPidIndex()
+            pids = self.pid_index.get(uuid, [])
+        if len(pids) < 1:
             self.logger.warn("No matching process for domain with uuid %s", \
                              uuid)
             return None
-        elif len(matches) > 1:
+        elif len(pids) > 1:
             self.logger.warn("Too many process matches for domain with uuid %s",\
                              uuid)
             return None
-        return int(matches[0])
+        return pids[0]
+
+    def _buildPidIndex(self):
+        index = {}
+        for entry in os.listdir('/proc'):
+            if not entry.isdigit():
+                continue
+            uuid = _procUUID(int(entry))
+            if uuid is not None:
+                index.setdefault(uuid, []).append(int(entry))
+        self.pid_index = index
+        self.pid_index_time = time.time()
+        # Forget about processes that have exited
+        for (uuid, (pid, start)) in self.pid_cache.items():
+            if _procStartTime(pid) != start:
+                del self.pid_cache[uuid]
 
     def _domainGetMemoryStats(self, domain):
         try:
             stats = domain.memoryStats()
         except libvirt.libvirtError, e:
-            self._handleException(e)
+            self._handleException(e, domain)
             return None
         return stats
 
 
-    def _handleException(self, e):
+    def _handleException(self, e, domain=None):
+        """
+        Handle an error from libvirt.  If it concerned a domain that no longer
+        exists, the cached handle for that domain is dropped.
+        """
         reconnect_errors = (libvirt.VIR_ERR_SYSTEM_ERROR,libvirt.VIR_ERR_INVALID_CONN)
         do_nothing_errors = (libvirt.VIR_ERR_NO_DOMAIN,)
         error = e.get_error_code()
@@ -148,7 +386,11 @@ class libvirtInterface(HypervisorInterface):
             self.logger.warn('libvirtInterface: connection lost, reconnecting.')
             self._reconnect()
         elif error in do_nothing_errors:
-            pass
+            if domain is not None:
+                try:
+                    self.domain_cache.invalidate(domain.UUIDString())
+                except libvirt.libvirtError:
+                    self.domain_cache.clear()
         else:
             self.logger.warn('libvirtInterface: Unhandled libvirt exception '\
                              '(%i).', error)
@@ -157,15 +399,26 @@ class libvirtInterface(HypervisorInterface):
         try:
             return domain.setMemory(target)
         except libvirt.libvirtError, e:
-            self._handleException(e)
+            self._handleException(e, domain)
             return False
 
+    def registerGuestEventHandler(self, handler):
+        if self.event_loop is None or self.conn is None:
+            return False
+        self.event_handler = handler
+        if not self._registerLifecycleEvents():
+            self.event_handler = None
+            return False
+        return True
+
     def getVmList(self):
         try:
             dom_list = self.conn.listDomainsID()
         except libvirt.libvirtError, e:
             self._handleException(e)
             return []
+        self.logger.debug("libvirtInterface: domain cache: %s",
+                          self.domain_cache)
         return dom_list
 
     def getVmInfo(self, id):
@@ -173,20 +426,85 @@ class libvirtInterface(HypervisorInterface):
         guest_domain = self._getDomainFromID(id)
         data['uuid'] = self._domainGetUUID(guest_domain)
         data['name'] = self._domainGetName(guest_domain)
-        data['pid'] = self._domainGetPid(data['uuid'])
+        data['pid'] = self._domainGetPid(data['uuid'], data['name'])
         if None in data.values():
             return None
         return data
 
+    def _getBulkStats(self, uuid):
+        """
+        Look a domain up in the snapshot of the statistics of all active
+        domains.  The snapshot is fetched with a single call and refreshed once
+        it is older than half the guest monitor interval.
+        Return: The domain's balloon statistics as reported by libvirt or None
+        if they are not in the snapshot
+        """
+        if not self.bulk_stats_supported:
+            return None
+        self.bulk_stats_lock.acquire()
+        try:
+            now = time.time()
+            if now - self.bulk_stats_time >= self.bulk_stats_max_age:
+                self._refreshBulkStats()
+                # Don't retry failures for every guest
+                self.bulk_stats_time = now
+            return self.bulk_stats.get(uuid)
+        finally:
+            self.bulk_stats_lock.release()
+
+    def _dropBulkStats(self, uuid):
+        """
+        Forget the snapshot of a domain whose statistics have just changed so
+        that it is read directly until the next refresh.
+        """
+        self.bulk_stats_lock.acquire()
+        try:
+            self.bulk_stats.pop(uuid, None)
+        finally:
+            self.bulk_stats_lock.release()
+
+    def _refreshBulkStats(self):
+        self.bulk_stats = {}
+        try:
+            records = self.conn.getAllDomainStats(
+                    libvirt.VIR_DOMAIN_STATS_BALLOON,
+                    libvirt.VIR_CONNECT_GET_ALL_DOMAINS_STATS_ACTIVE)
+        except AttributeError:
+            self.logger.info("libvirtInterface: bulk domain statistics are "\
+                             "not supported by this version of libvirt")
+            self.bulk_stats_supported = False
+            return
+        except libvirt.libvirtError, e:
+            if e.get_error_code() == libvirt.VIR_ERR_NO_SUPPORT:
+                self.logger.info("libvirtInterface: bulk domain statistics "\
+                                 "are not supported by this hypervisor")
+                self.bulk_stats_supported = False
+            else:
+                self._handleException(e)
+            return
+        for (domain, record) in records:
+            uuid = self._domainGetUUID(domain)
+            if uuid is not None:
+                self.bulk_stats[uuid] = record
+                self.domain_cache.add(uuid, domain)
+
     def getVmMemoryStats(self, uuid):
-        domain = self._getDomainFromUUID(uuid)
-        # Try to collect memory stats.  This function may not be available
-        info = self._domainGetMemoryStats(domain)
+        record = self._getBulkStats(uuid)
+        if record is not None:
+            info = {}
+            for key in self.mem_stats.keys():
+                if 'balloon.' + key in record:
+                    info[key] = record['balloon.' + key]
+        else:
+            domain = self._getDomainFromUUID(uuid)
+            # Try to collect memory stats.  This function may not be available
+            info = self._domainGetMemoryStats(domain)
         ret = {}
         if info is None or len(info.keys()) == 0:
             self.logger.debug('libvirt memoryStats() is not active')
-        for key in set(self.mem_stats.keys()) - set(info.keys()):
-            ret[key] = info[key]
+            return ret
+        for key in set(self.mem_stats.keys()) & set(info.keys()):
+            ret[self.mem_stats[key]] = info[key]
         return ret
 
     def _setStatsFields(self):
@@ -208,6 +526,10 @@ class libvirtInterface(HypervisorInterface):
         return set(self.mem_stats.values())
 
     def getVmBalloonInfo(self, uuid):
+        record = self._getBulkStats(uuid)
+        if record is not None and 'balloon.current' in record:
+            return {'balloon_max': record['balloon.maximum'],
+                    'balloon_cur': record['balloon.current']}
         domain = self._getDomainFromUUID(uuid)
         info = self._domainGetInfo(domain)
         if info is None:
@@ -222,6 +544,7 @@ class libvirtInterface(HypervisorInterface):
             if self._domainSetBalloonTarget(dom, target):
                 name = self._domainGetName(dom)
                 self.logger.warn("Error while ballooning guest:%i", name)
+            self._dropBulkStats(uuid)
 
     def ksmTune(self, tuningParams):
         def write_value(fname, value):
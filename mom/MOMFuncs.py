@@ -42,6 +42,10 @@ class MOMFuncs(object):
         self.logger.info("getPolicy()")
         return self.threads['policy_engine'].rpc_get_policy()
 
+    def getPolicyProfile(self):
+        self.logger.info("getPolicyProfile()")
+        return self.threads['policy_engine'].rpc_get_policy_profile()
+
     def setVerbosity(self, verbosity):
         self.logger.info("setVerbosity()")
         logger = logging.getLogger()
@@ -54,7 +58,12 @@ class MOMFuncs(object):
         guest_entities = self.threads['guest_manager'].interrogate().values()
         for entity in guest_entities:
             guest_stats[entity.properties['name']] = entity.statistics[0]
-        ret = { 'host': host_stats, 'guests': guest_stats }
+        collectors = {
+            'host': self.threads['host_monitor'].get_active_collectors(),
+            'guests': self.threads['guest_manager'].get_active_collectors(),
+        }
+        ret = { 'host': host_stats, 'guests': guest_stats,
+                'collectors': collectors }
         return ret
 
     def getActiveGuests(self):
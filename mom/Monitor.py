@@ -15,11 +15,12 @@
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
 
 import threading
+import time
 import ConfigParser
 import logging
-from collections import deque
 from mom.Collectors import Collector
 from mom.Entity import Entity
+from mom.StatsBuffer import StatsBuffer
 from mom.Plotter import Plotter
 
 class Monitor:
@@ -33,11 +34,19 @@ class Monitor:
         # Guard the data with a semaphore to ensure consistency.
         self.data_sem = threading.Semaphore()
         self.properties = {}
-        self.statistics = deque()
+        self.statistics = None
         self.variables = {}
         self.name = name
         self.fields = None
         self.collectors = []
+        # The last (data, time collected) of each collector
+        self.carried = None
+        # The statistics read by the policy or None if they all may be
+        self.used_fields = None
+        self.unused_interval = config.getint('main',
+                                             'unused-collector-interval')
+        # The age of each statistic in the latest sample (seconds)
+        self.stat_ages = {}
         self.logger = logging.getLogger('mom.Monitor')
         
         plot_dir = config.get('__int__', 'plot-subdir')
@@ -48,41 +57,170 @@ class Monitor:
         
         self.ready = None 
         self._terminate = False
+        # Set while an asynchronous collection is in progress
+        self.pending = False
         
     def collect(self):
         """
         Collect a set of statistics by invoking all defined collectors and
-        merging the data into one dictionary and pushing it onto the deque of
+        merging the data into one dictionary and adding it to the buffer of
         historical statistics.  Maintain a history length as specified in the
         config file.
         
         Note: Priority is given to collectors based on the order that they are
         listed in the config file (ie. if two collectors produce the same
         statistic only the value produced by the first collector will be saved).
+
+        A collector with an interval of its own is only run once per interval.
+        In between, its last values are carried forward.  The same is done for
+        collectors whose statistics are not read by the policy, at the
+        unused-collector-interval.
         Return: The dictionary of collected statistics
         """
         
-        # The first time we are called, populate the list of expected fields
-        if self.fields is None:
-            self.fields = set()
-            for c in self.collectors:
-                self.fields |= c.getFields()
-            self.logger.debug("Using fields: %s", repr(self.fields))
-            if self.plotter is not None:
-                self.plotter.setFields(self.fields)
-        
-        data = {}
-        for c in self.collectors:
+        self._init_fields()
+        now = time.time()
+        results = []
+        for (i, c) in enumerate(self.collectors):
+            if not self._due(i, now):
+                results.append(self.carried[i] + (None,))
+                continue
             try:
-                for (key, val) in c.collect().items():
-                    if key not in data:
-                        data[key] = val
+                data = c.collect()
+                self._carry(i, data, now)
+                results.append((data, now, None))
             except Collector.CollectionError, e:
-                self._disp_collection_error("Collection error: %s" % e.msg)
+                results.append((None, now, e))
             except Collector.FatalError, e:
-                self._set_not_ready("Fatal Collector error: %s" % e.msg)
+                results.append((None, now, e))
+                break
+        return self._store(results, now)
+
+    def collect_async(self, engine):
+        """
+        Start collecting a set of statistics on a CollectionEngine.  All
+        collectors run concurrently and the results are merged and stored as
+        in collect() once the last one has finished.  A collection is not
+        started while the previous one is still in progress.
+        """
+        if self.pending:
+            self.logger.debug("%s: previous collection still in progress",
+                              self.name)
+            return
+        self._init_fields()
+        now = time.time()
+        results = [ None ] * len(self.collectors)
+        due = []
+        for i in range(len(self.collectors)):
+            if self._due(i, now):
+                due.append(i)
+            else:
+                results[i] = self.carried[i] + (None,)
+        if len(due) == 0:
+            self._store(results, now)
+            return
+        self.pending = True
+        remaining = [ len(due) ]
+
+        def done(i, data, error):
+            if error is None:
+                self._carry(i, data, now)
+            results[i] = (data, now, error)
+            remaining[0] -= 1
+            if remaining[0] == 0:
+                self.pending = False
+                self._store(results, now)
+
+        for i in due:
+            engine.submit(self.collectors[i],
+                          lambda data, error, i=i: done(i, data, error))
+
+    def _due(self, i, now):
+        """
+        Check if collector i should be run in a collection started at now
+        """
+        interval = self._interval(self.collectors[i])
+        if interval <= 0 or self.carried[i] is None:
+            return True
+        return now - self.carried[i][1] >= interval
+
+    def _interval(self, collector):
+        """
+        Return: The number of seconds between runs of a collector or 0 if it
+        runs in every collection
+        """
+        if self._is_used(collector):
+            return collector.collect_interval
+        return max(collector.collect_interval, self.unused_interval)
+
+    def _is_used(self, collector):
+        fields = self.used_fields
+        return self.unused_interval <= 0 or fields is None or \
+               len(collector.getFields() & fields) > 0
+
+    def _carry(self, i, data, now):
+        """
+        Remember the data of a collector so it can be carried forward
+        """
+        self.carried[i] = (data, now)
+
+    def set_used_fields(self, fields):
+        """
+        Set the statistics that are read by the policy.  Collectors which
+        provide none of them are run once per unused-collector-interval.
+        """
+        self.used_fields = fields
+        self.logger.debug("%s: active collectors: %s", self.name,
+                          self.get_active_collectors())
+
+    def get_active_collectors(self):
+        """
+        Return: The names of the collectors that run at their usual interval
+        """
+        if self.collectors is None:
+            return []
+        return [ c.__class__.__name__ for c in self.collectors
+                 if self._is_used(c) ]
+
+    def _init_fields(self):
+        """
+        The first time we are called, populate the list of expected fields
+        """
+        if self.fields is not None:
+            return
+        self.carried = [ None ] * len(self.collectors)
+        self.fields = set()
+        for c in self.collectors:
+            self.fields |= c.getFields()
+        self.logger.debug("Using fields: %s", repr(self.fields))
+        if self.plotter is not None:
+            self.plotter.setFields(self.fields)
+        history = self.config.getint('main', 'sample-history-length')
+        self.statistics = StatsBuffer(self.fields, history)
+
+    def _store(self, results, now):
+        """
+        Merge the (data, time collected, error) results of the collectors, in
+        priority order, and add them to the statistics of the sample taken at
+        now.
+        Return: The dictionary of collected statistics or None
+        """
+        data = {}
+        ages = {}
+        for (result, collected, error) in results:
+            if isinstance(error, Collector.FatalError):
+                self._set_not_ready("Fatal Collector error: %s" % error.msg)
                 self.terminate()
                 return None
+            elif isinstance(error, Collector.CollectionError):
+                self._disp_collection_error("Collection error: %s" % error.msg)
+            elif error is not None:
+                self._disp_collection_error("Collection error: %s" % error)
+            else:
+                for (key, val) in result.items():
+                    if key not in data:
+                        data[key] = val
+                        ages[key] = now - collected
         if set(data) != self.fields:
             self._set_not_ready("Incomplete data: missing %s" % \
                                 (self.fields - set(data)))
@@ -90,8 +228,7 @@ class Monitor:
 
         self.data_sem.acquire()
         self.statistics.append(data)
-        if len(self.statistics) > self.config.getint('main', 'sample-history-length'):
-            self.statistics.popleft()
+        self.stat_ages = ages
         self.data_sem.release()
         self._set_ready()
         
@@ -114,7 +251,8 @@ class Monitor:
             ret._set_property(prop, self.properties[prop])
         for var in self.variables.keys():
             ret._set_variable(var, self.variables[var])
-        ret._set_statistics(self.statistics)
+        ret._set_statistics(self.statistics.view())
+        ret._set_stat_ages(self.stat_ages)
         self.data_sem.release()
         ret._finalize()
         return ret
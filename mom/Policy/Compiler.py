@@ -0,0 +1,688 @@
+# Memory Overcommitment Manager
+# Copyright (C) 2010 Adam Litke, IBM Corporation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public
+# License along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+
+from Parser import Token, PolicyError, Evaluator, Frame, UNBOUND, get_code
+from Vectorizer import Vectorizer
+
+class Scope(object):
+    """
+    The compile-time view of a Frame.  A scope knows the layout that will be
+    used for its frames, so variable references can be resolved to slots.  The
+    outermost scope is either the global scope or the body of a user function.
+    A scope without a layout stands for a frame whose layout is only known at
+    run time: the frame of a user function call while its arguments are being
+    evaluated.
+    """
+    def __init__(self, kind, layout, parent=None):
+        self.kind = kind
+        self.layout = layout
+        self.parent = parent
+
+class Compiler(object):
+    """
+    The Compiler lowers parsed policy code into a tree of nested Python
+    closures.  Each closure takes the Frame to evaluate in and has the same
+    semantics as passing its expression to Evaluator.eval().  The difference
+    is that the code is inspected once, when it is compiled, instead of on
+    every evaluation.
+
+    Variables use dynamic scoping: a user function sees the variables of its
+    caller.  The compiler resolves each reference to a list of candidate
+    (depth, slot) coordinates within the enclosing let, with and def scopes.
+    Only names that may be bound by a caller are searched for by name beyond
+    the body of a function.
+
+    Expressions that the compiler does not know how to lower (such as malformed
+    special forms) are compiled into a closure that hands them to the
+    interpreter.
+
+    When vectorize is set, the bodies of with statements are also compiled
+    with the Vectorizer so that all guests are handled in a single pass.
+
+    If a Profiler is given, the closures for user function bodies, special
+    forms and the first expression of each source line are wrapped so that
+    their calls are timed.  A vectorized with body is only timed as a whole.
+    """
+    # Smallest number of guests for which the vectorized body is used
+    vector_min_guests = 2
+
+    def __init__(self, evaluator, vectorize=True, profiler=None):
+        self.e = evaluator
+        self.vectorize = vectorize
+        self.profiler = profiler
+        # The source line of the expression being compiled, for profiling
+        self.line = None
+        self.stack = evaluator.stack
+        self.globals = None
+        self.scope = None
+        # Compiled user functions: name -> (funcs entry, slots, layout, body)
+        self.funcs = {}
+        # The parameters and body of the functions defined so far, for inlining
+        self.defs = {}
+        # Names that may be bound to a variable at run time.  A call whose
+        # function name is in this set must check the variables first.
+        self.bound = set()
+        # Names that may be bound in a frame other than the global one
+        self.local_names = set()
+        # Names of all user function parameters
+        self.params = set()
+        self.special_forms = {
+            'def': self.compile_def,
+            'set': self.compile_set,
+            'defvar': self.compile_defvar,
+            'let': self.compile_let,
+            'with': self.compile_with,
+            'if': self.compile_if,
+        }
+
+    def compile_program(self, code):
+        """
+        Compile a list of top-level expressions.
+        Return: A list of closures, one per expression, which are evaluated in
+        the global frame of the Evaluator
+        """
+        frame = self.stack.frame
+        while frame.parent is not None:
+            self.bound.update(frame.layout.keys())
+            self.local_names.update(frame.layout.keys())
+            frame = frame.parent
+        self.globals = frame
+        self.bound.update(frame.layout.keys())
+        for expr in code:
+            self._find_bindings(expr, True)
+
+        for name in self._find_defvars(code):
+            self.globals.reserve(name)
+        self.scope = Scope('global', self.globals.layout)
+        exprs = map(self.compile, code)
+
+        g = self.globals
+        return [ (lambda expr=expr: expr(g)) for expr in exprs ]
+
+    def _find_bindings(self, code, toplevel):
+        """
+        Record every name that the program binds with defvar, let, def or with.
+        Defvars outside of the top-level code, if and eval may bind a name in a
+        frame other than the global one.
+        """
+        if isinstance(code, Token) or len(code) == 0:
+            return
+        head = code[0]
+        name = None
+        if self._is_symbol(head):
+            name = head.value
+            if name == 'defvar' and len(code) > 1:
+                self._add_binding(code[1], not toplevel)
+            elif name == 'let' and len(code) > 1 and type(code[1]) == list:
+                for sym in code[1]:
+                    if type(sym) == list and len(sym) > 0:
+                        self._add_binding(sym[0], True)
+            elif name == 'def' and len(code) > 2 and type(code[2]) == list:
+                for param in code[2]:
+                    self._add_binding(param, True)
+                    if self._is_symbol(param):
+                        self.params.add(param.value)
+            elif name == 'with' and len(code) > 2:
+                self._add_binding(code[2], True)
+        toplevel = toplevel and name in ('if', 'eval', 'defvar', 'set')
+        for item in code:
+            if not isinstance(item, Token):
+                self._find_bindings(item, toplevel)
+
+    def _add_binding(self, token, local):
+        if self._is_symbol(token):
+            self.bound.add(token.value)
+            if local:
+                self.local_names.add(token.value)
+
+    def _find_defvars(self, code, names=None):
+        """
+        Find the names that defvar may bind in the frame which evaluates a list
+        of expressions.  Let, with and def bodies have frames of their own and
+        are skipped.  Extra names only cost an unused slot.
+        """
+        if names is None:
+            names = []
+        for expr in code:
+            if isinstance(expr, Token) or len(expr) == 0:
+                continue
+            head = expr[0]
+            if self._is_symbol(head) and head.value not in self.bound:
+                if head.value in ('let', 'with', 'def'):
+                    continue
+                if head.value == 'defvar' and len(expr) > 1 and \
+                        self._is_symbol(expr[1]):
+                    names.append(expr[1].value)
+            self._find_defvars(expr, names)
+        return names
+
+    def _find_refs(self, code, refs):
+        """
+        Collect the variable names referenced by code.
+        Return: True if the code contains a defvar
+        """
+        if isinstance(code, Token):
+            if code.kind == 'symbol':
+                refs.add(code.value.split('.')[0])
+            return False
+        has_defvar = False
+        for item in code:
+            if self._find_refs(item, refs):
+                has_defvar = True
+        if len(code) > 0 and self._is_symbol(code[0]) and \
+                code[0].value == 'defvar':
+            has_defvar = True
+        return has_defvar
+
+    def _make_layout(self, names, body):
+        """
+        Create the layout for a new scope.
+        Return: A tuple of (layout, slots for the names)
+        """
+        layout = {}
+        for name in names + self._find_defvars(body):
+            if name not in layout:
+                layout[name] = len(layout)
+        return (layout, [ layout[name] for name in names ])
+
+    def _enter(self, kind, layout):
+        self.scope = Scope(kind, layout, self.scope)
+
+    def _leave(self):
+        self.scope = self.scope.parent
+
+    def interpret(self, fn):
+        """
+        Wrap a function that uses the interpreter so that it runs with the
+        variable stack pointing at the frame being evaluated.
+        """
+        stack = self.stack
+        def interpreted(frame):
+            saved = stack.frame
+            stack.frame = frame
+            try:
+                return fn()
+            finally:
+                stack.frame = saved
+        return interpreted
+
+    def fallback(self, code):
+        """
+        Compile an expression by deferring it to the interpreter
+        """
+        e = self.e
+        return self.interpret(lambda: e.eval(code))
+
+    def compile(self, code):
+        """
+        Compile a single expression into a closure
+        """
+        if isinstance(code, Token):
+            return self.compile_token(code)
+
+        if len(code) == 0 or not isinstance(code[0], Token):
+            return self.fallback(code)
+        node = code[0]
+        if node.kind == 'symbol':
+            name = node.value
+        elif node.kind == 'operator' and node.value in self.e.operator_map:
+            name = self.e.operator_map[node.value]
+        else:
+            return self.fallback(code)
+
+        if self.profiler is not None:
+            return self.compile_profiled(name, code)
+        return self.compile_expr(name, code)
+
+    def compile_expr(self, name, code):
+        call = self.compile_call(name, code)
+        if '.' in name or name in self.bound:
+            return self.compile_dynamic(name, code[1:], call)
+        return call
+
+    def compile_profiled(self, name, code):
+        line = code[0].line
+        saved = self.line
+        self.line = line
+        expr = self.compile_expr(name, code)
+        self.line = saved
+
+        if '.' not in name and name not in self.bound and \
+                name in self.e.signatures and \
+                self.e.signatures[name][1] is not None:
+            expr = self.profiler.wrap(('form', name), expr)
+        if line is not None and line != saved:
+            expr = self.profiler.wrap(('line', line), expr)
+        return expr
+
+    def compile_token(self, token):
+        if token.kind == 'number':
+            try:
+                value = self.e.eval_number(token)
+            except PolicyError:
+                return self.fallback(token)
+            return lambda frame: value
+        elif token.kind == 'string':
+            value = token.value[1:-1]
+            return lambda frame: value
+        elif token.kind == 'symbol':
+            return self.compile_lookup(token.value)
+        elif token.kind == 'constant':
+            value = token.value
+            return lambda frame: value
+        else:
+            return self.fallback(token)
+
+    def _resolve(self, name):
+        """
+        Resolve a variable name in the current scope.
+        Return: A tuple of (candidates, tail).  Candidates is a list of (depth,
+        slot) coordinates to try in order.  A slot of None means that the frame
+        must be searched by name.  The tail describes where to look if none of
+        the candidates is bound.
+        """
+        candidates = []
+        depth = 0
+        scope = self.scope
+        while True:
+            if scope.layout is None:
+                candidates.append((depth, None))
+            elif name in scope.layout:
+                candidates.append((depth, scope.layout[name]))
+            if scope.parent is None:
+                break
+            scope = scope.parent
+            depth += 1
+
+        glayout = self.globals.layout
+        if scope.kind == 'global':
+            if name in glayout:
+                tail = ('undefined',)
+            else:
+                tail = ('global',)
+        elif name in self.local_names:
+            # A caller may have bound it.  Search from the caller's frame.
+            tail = ('search', depth + 1)
+        elif name in glayout:
+            tail = ('slot', glayout[name])
+        else:
+            tail = ('global',)
+        return (candidates, tail)
+
+    def _make_finder(self, name, candidates, tail):
+        """
+        Build a function that returns the value of a variable in a frame or
+        UNBOUND if it is not defined.
+        """
+        g = self.globals
+        if tail[0] == 'slot':
+            gslot = tail[1]
+            def find_tail(frame):
+                return g.values[gslot]
+        elif tail[0] == 'global':
+            def find_tail(frame):
+                slot = g.layout.get(name)
+                if slot is None:
+                    return UNBOUND
+                return g.values[slot]
+        elif tail[0] == 'search':
+            tail_depth = tail[1]
+            def find_tail(frame):
+                for i in xrange(tail_depth):
+                    frame = frame.parent
+                return frame.lookup(name)
+        else:
+            find_tail = lambda frame: UNBOUND
+
+        if len(candidates) == 0:
+            return find_tail
+        if len(candidates) == 1 and candidates[0][1] is not None:
+            (depth, slot) = candidates[0]
+            if depth == 0:
+                def find(frame):
+                    value = frame.values[slot]
+                    if value is UNBOUND:
+                        return find_tail(frame)
+                    return value
+                return find
+            elif depth == 1:
+                def find(frame):
+                    value = frame.parent.values[slot]
+                    if value is UNBOUND:
+                        return find_tail(frame)
+                    return value
+                return find
+
+        def find(frame):
+            for (depth, slot) in candidates:
+                f = frame
+                for i in xrange(depth):
+                    f = f.parent
+                if slot is None:
+                    slot = f.layout.get(name)
+                    if slot is None:
+                        continue
+                value = f.values[slot]
+                if value is not UNBOUND:
+                    return value
+            return find_tail(frame)
+        return find
+
+    def compile_lookup(self, name, allow_undefined=False):
+        """
+        Compile a variable reference.  Object references such as guest.Stat
+        are split into a variable lookup and an attribute access.
+        """
+        parts = name.split('.')
+        (candidates, tail) = self._resolve(parts[0])
+        find = self._make_finder(parts[0], candidates, tail)
+
+        if len(parts) > 1:
+            attr = parts[1]
+            def lookup_attr(frame):
+                obj = find(frame)
+                if obj is not UNBOUND and hasattr(obj, attr):
+                    return getattr(obj, attr)
+                # Let the frames search for an outer object with the attribute
+                return frame.get(name, allow_undefined)
+            return lookup_attr
+        elif allow_undefined:
+            def lookup_or_none(frame):
+                value = find(frame)
+                if value is UNBOUND:
+                    return None
+                return value
+            return lookup_or_none
+        else:
+            def lookup(frame):
+                value = find(frame)
+                if value is UNBOUND:
+                    raise PolicyError("undefined symbol %s" % name)
+                return value
+            return lookup
+
+    def compile_dynamic(self, name, args, call):
+        """
+        The function name might refer to a variable holding a callable (such as
+        an Entity method).  Check the variable when the expression is evaluated
+        and fall back to the compiled function call otherwise.
+        """
+        lookup = self.compile_lookup(name, allow_undefined=True)
+        exprs = map(self.compile, args)
+        def dynamic(frame):
+            func = lookup(frame)
+            if func is not None:
+                return func(*[expr(frame) for expr in exprs])
+            return call(frame)
+        return dynamic
+
+    def compile_call(self, name, code):
+        if name in self.e.signatures:
+            fn, kinds = self.e.signatures[name]
+            # Forms that the compiler knows about are lowered directly unless
+            # an Evaluator subclass has replaced them.
+            if name in self.special_forms and \
+                    fn is Evaluator.__dict__.get('c_%s' % name):
+                ret = self.special_forms[name](code[1:])
+            else:
+                ret = self.compile_form(fn, kinds, code[1:])
+            if ret is None:
+                return self.fallback(code)
+            return ret
+        elif hasattr(self.e, 'default'):
+            return self.compile_default(name, code)
+        else:
+            return self.fallback(code)
+
+    def compile_form(self, fn, kinds, args):
+        """
+        Compile a call to a function from the Evaluator dispatch table.
+        Functions without a signature get all of their arguments evaluated.
+        Specialize the common unary and binary cases.  Functions with a
+        signature may evaluate code themselves so they are run with the
+        variable stack pointing at the current frame.
+        """
+        e = self.e
+        if kinds is None:
+            exprs = map(self.compile, args)
+            if len(exprs) == 1:
+                x = exprs[0]
+                return lambda frame: fn(e, x(frame))
+            elif len(exprs) == 2:
+                x, y = exprs
+                return lambda frame: fn(e, x(frame), y(frame))
+            return lambda frame: fn(e, *[expr(frame) for expr in exprs])
+
+        if len(kinds) != len(args):
+            return None
+        exprs = []
+        for i in range(len(kinds)):
+            if kinds[i] == 'code':
+                exprs.append(lambda frame, code=args[i]: code)
+            elif kinds[i] == 'symbol':
+                if not self._is_symbol(args[i]):
+                    return None
+                exprs.append(lambda frame, name=args[i].value: name)
+            else:
+                exprs.append(self.compile(args[i]))
+        return self.interpret_with_args(fn, exprs)
+
+    def interpret_with_args(self, fn, exprs):
+        e = self.e
+        stack = self.stack
+        def form(frame):
+            values = [ expr(frame) for expr in exprs ]
+            saved = stack.frame
+            stack.frame = frame
+            try:
+                return fn(e, *values)
+            finally:
+                stack.frame = saved
+        return form
+
+    def compile_default(self, name, code):
+        args = code[1:]
+        if name == 'eval':
+            exprs = map(self.compile, args)
+            if len(exprs) == 0:
+                return self.fallback(code)
+            def multi(frame):
+                for expr in exprs:
+                    result = expr(frame)
+                return result
+            return multi
+
+        # The interpreter evaluates arguments in the frame of the function
+        # being called.  This only matters if they refer to a parameter name
+        # or define a variable.
+        refs = set()
+        if self._find_refs(args, refs) or len(refs & self.params) > 0:
+            self._enter('call', None)
+            exprs = map(self.compile, args)
+            self._leave()
+            in_callee = True
+        else:
+            exprs = map(self.compile, args)
+            in_callee = False
+
+        e = self.e
+        funcs = self.funcs
+        default = self.interpret(lambda: e.default(name, args))
+        nr_args = len(exprs)
+        def call(frame):
+            compiled = funcs.get(name)
+            if compiled is None or e.funcs.get(name) is not compiled[0]:
+                # The function was not defined by compiled code
+                return default(frame)
+            (entry, slots, layout, body) = compiled
+            if len(slots) != nr_args:
+                raise PolicyError('Function "%s" invoked with incorrect ' \
+                                  'arity' % name)
+            callee = Frame(frame, layout)
+            values = callee.values
+            if in_callee:
+                for i in xrange(nr_args):
+                    values[slots[i]] = exprs[i](callee)
+            else:
+                for i in xrange(nr_args):
+                    values[slots[i]] = exprs[i](frame)
+            return body(callee)
+        return call
+
+    def _is_symbol(self, token):
+        return isinstance(token, Token) and token.kind == 'symbol'
+
+    def compile_def(self, args):
+        if len(args) != 3 or not self._is_symbol(args[0]):
+            return None
+        name, params, code = args[0].value, args[1], args[2]
+        if type(params) == list and \
+                len(filter(self._is_symbol, params)) == len(params):
+            param_names = [ p.value for p in params ]
+            self.defs[name] = (param_names, code)
+            (layout, slots) = self._make_layout(param_names, [code])
+            # A function body is evaluated on top of its caller's frame, which
+            # is not known here, so it starts a new chain of scopes.
+            saved = self.scope
+            self.scope = Scope('function', layout)
+            body = self.compile(code)
+            self.scope = saved
+            if self.profiler is not None:
+                body = self.profiler.wrap(('def', name), body)
+        else:
+            slots = None
+
+        e = self.e
+        funcs = self.funcs
+        def define(frame):
+            entry = (params, code)
+            e.funcs[name] = entry
+            if slots is not None:
+                funcs[name] = (entry, slots, layout, body)
+            elif name in funcs:
+                del funcs[name]
+            return name
+        return define
+
+    def compile_set(self, args):
+        if len(args) != 2 or not self._is_symbol(args[0]):
+            return None
+        name = args[0].value
+        value = self.compile(args[1])
+        return lambda frame: frame.set(name, value(frame))
+
+    def compile_defvar(self, args):
+        if len(args) != 2 or not self._is_symbol(args[0]):
+            return None
+        name = args[0].value
+        value = self.compile(args[1])
+        if self.scope.layout is None:
+            return lambda frame: frame.alloc(name, value(frame))
+
+        if self.scope.kind == 'global':
+            slot = self.globals.reserve(name)
+        else:
+            slot = self.scope.layout[name]
+        def defvar(frame):
+            result = value(frame)
+            frame.values[slot] = result
+            return result
+        return defvar
+
+    def compile_let(self, args):
+        if len(args) != 2 or type(args[0]) != list:
+            return None
+        for sym in args[0]:
+            if type(sym) != list or len(sym) != 2 or \
+                    not self._is_symbol(sym[0]):
+                return None
+        names = [ sym[0].value for sym in args[0] ]
+        (layout, slots) = self._make_layout(names,
+                                [ sym[1] for sym in args[0] ] + [args[1]])
+        self._enter('let', layout)
+        values = [ self.compile(sym[1]) for sym in args[0] ]
+        body = self.compile(args[1])
+        self._leave()
+
+        nr_syms = len(names)
+        def let(frame):
+            inner = Frame(frame, layout)
+            for i in xrange(nr_syms):
+                inner.values[slots[i]] = values[i](inner)
+            return body(inner)
+        return let
+
+    def compile_with(self, args):
+        if len(args) != 3 or not self._is_symbol(args[0]) or \
+                not self._is_symbol(args[1]):
+            return None
+        iterable, iterator = args[0].value, args[1].value
+        # Iteration is restricted to the list of Guest entities.  Let the
+        # interpreter report the error for anything else.
+        if iterable != 'Guests':
+            return None
+        items = self.compile_lookup(iterable)
+        vector = None
+        if self.vectorize:
+            vector = Vectorizer(self).vectorize(iterator, args[2])
+        (layout, slots) = self._make_layout([iterator], [args[2]])
+        self._enter('with', layout)
+        body = self.compile(args[2])
+        self._leave()
+
+        slot = slots[0]
+        min_guests = self.vector_min_guests
+        def with_(frame):
+            guests = items(frame)
+            if vector is not None and len(guests) >= min_guests:
+                try:
+                    commit = vector(frame, guests)
+                except Exception:
+                    # Nothing has been changed yet.  Evaluate the guests one
+                    # at a time, which also reports any errors properly.
+                    commit = None
+                if commit is not None:
+                    # Errors from the Controls themselves are real errors
+                    return commit()
+            result = []
+            for item in guests:
+                inner = Frame(frame, layout)
+                inner.values[slot] = item
+                result.append(body(inner))
+            return result
+        return with_
+
+    def compile_if(self, args):
+        if len(args) != 3:
+            return None
+        cond, yes, no = map(self.compile, args)
+        def if_(frame):
+            if cond(frame):
+                return yes(frame)
+            else:
+                return no(frame)
+        return if_
+
+def eval(e, string):
+    """
+    Compile and evaluate a policy string.  This is the compiled counterpart of
+    Parser.eval().
+    """
+    code = Compiler(e).compile_program(get_code(e, string))
+    results = []
+    for expr in code:
+        results.append(expr())
+    return results
@@ -0,0 +1,78 @@
+# Memory Overcommitment Manager
+# Copyright (C) 2010 Adam Litke, IBM Corporation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public
+# License along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+
+from Parser import Token
+
+# Entity methods which take the name of a statistic as their first argument
+stat_methods = ('Stat', 'StatAge', 'StatAvg', 'StatMin', 'StatMax',
+                'StatStdDev', 'StatEWMA')
+
+# Entity methods which do not read statistics
+other_methods = ('Prop', 'SetVar', 'GetVar', 'Control', 'GetControl')
+
+def get_used_fields(code):
+    """
+    Find the statistics that a policy reads, either as an attribute of an
+    Entity (guest.mem_free, Host.mem_available) or by passing a string
+    literal to one of the Stat methods.
+    Return: The set of statistic names or None if any of them could be used.
+    That is the case when the name passed to a Stat method is not a string
+    literal or when a Stat method is used other than by calling it directly.
+    """
+    fields = set()
+    try:
+        _walk(code, fields)
+    except _Unknown:
+        return None
+    return fields
+
+class _Unknown(Exception):
+    pass
+
+def _method(token):
+    """
+    Return: The attribute name of a dotted symbol or None
+    """
+    if not isinstance(token, Token) or token.kind != 'symbol':
+        return None
+    parts = token.value.split('.')
+    if len(parts) < 2:
+        return None
+    return parts[1]
+
+def _walk(code, fields):
+    if isinstance(code, Token):
+        attr = _method(code)
+        if attr in stat_methods:
+            # The method is being passed around and may be called with any name
+            raise _Unknown()
+        if attr is not None and attr not in other_methods:
+            fields.add(attr)
+        return
+    if len(code) == 0:
+        return
+    if _method(code[0]) in stat_methods:
+        if len(code) < 2:
+            return
+        arg = code[1]
+        if not isinstance(arg, Token) or arg.kind != 'string':
+            raise _Unknown()
+        fields.add(arg.value[1:-1])
+        for expr in code[2:]:
+            _walk(expr, fields)
+        return
+    for expr in code:
+        _walk(expr, fields)
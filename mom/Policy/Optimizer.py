@@ -0,0 +1,284 @@
+# Memory Overcommitment Manager
+# Copyright (C) 2010 Adam Litke, IBM Corporation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public
+# License along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+
+from Parser import Token, ConstantToken, PolicyError, Evaluator, \
+                   ExternalFunctions
+
+class Optimizer(object):
+    """
+    The Optimizer simplifies parsed policy code before it is evaluated or
+    compiled:
+     - Operators and external functions whose arguments are all constant are
+       computed once, at load time.
+     - An if with a constant condition is replaced by the branch it selects.
+     - A top-level defvar of a constant value is hoisted: it is evaluated once
+       when the policy is loaded and references to the variable are replaced
+       by its value.  This only happens if nothing else in the policy binds or
+       sets a variable of the same name and nothing refers to it before the
+       defvar.
+
+    The rewritten code has the same results as the original.  Expressions that
+    raise an error are left alone so that the error is reported when the policy
+    is evaluated.
+    """
+    # Evaluator functions without side effects
+    pure_forms = ('add', 'sub', 'mul', 'div', 'lt', 'gt', 'lte', 'gte',
+                  'eq', 'neq', 'shl', 'shr', 'and', 'or', 'not')
+
+    def __init__(self, evaluator, reserved=()):
+        """
+        reserved is a list of variables that are assigned from outside of the
+        policy, such as the Host and Guests entities.
+        """
+        self.e = evaluator
+        self.reserved = set(reserved)
+        # The values of the hoisted variables
+        self.constants = {}
+        # A list of (line, source, value) for every simplified expression
+        self.folded = []
+        self.defvars = {}
+        self.bound = set()
+        # Variables that are referred to before their top-level defvar
+        self.used_early = set()
+
+    def optimize(self, code):
+        """
+        Optimize a list of top-level expressions.
+        Return: A tuple of (hoisted, code).  hoisted is a list of defvars to be
+        evaluated once, before the code.
+        """
+        used = set()
+        for expr in code:
+            self._find_bindings(expr)
+            name = self._defvar_name(expr)
+            if name in used:
+                self.used_early.add(name)
+            self._find_uses(expr, used)
+
+        hoisted = []
+        result = []
+        for expr in code:
+            name = self._hoistable(expr)
+            expr = self.fold(expr)
+            if name is not None and self._is_constant(expr[2]):
+                value = self._value(expr[2])
+                self.constants[name] = value
+                self.folded.append((self._line(expr), self.format(expr), value))
+                hoisted.append(expr)
+                # The variable is already defined, just produce the value
+                expr = ConstantToken(value, self._line(expr))
+            result.append(expr)
+        return (hoisted, result)
+
+    def _find_bindings(self, code):
+        """
+        Count the defvars of each name and record every other name that is
+        bound or set anywhere in the program.
+        """
+        if isinstance(code, Token) or len(code) == 0:
+            return
+        head = code[0]
+        if self._is_symbol(head):
+            name = head.value
+            if name == 'defvar' and len(code) > 1 and \
+                    self._is_symbol(code[1]):
+                self.defvars[code[1].value] = \
+                    self.defvars.get(code[1].value, 0) + 1
+            elif name == 'set' and len(code) > 1 and self._is_symbol(code[1]):
+                self.bound.add(code[1].value)
+            elif name == 'let' and len(code) > 1 and type(code[1]) == list:
+                for sym in code[1]:
+                    if type(sym) == list and len(sym) > 0 and \
+                            self._is_symbol(sym[0]):
+                        self.bound.add(sym[0].value)
+            elif name == 'def' and len(code) > 2 and type(code[2]) == list:
+                for param in code[2]:
+                    if self._is_symbol(param):
+                        self.bound.add(param.value)
+            elif name == 'with' and len(code) > 2 and \
+                    self._is_symbol(code[2]):
+                self.bound.add(code[2].value)
+        for item in code:
+            self._find_bindings(item)
+
+    def _find_uses(self, code, names):
+        """
+        Add the names of all symbols in code, other than the variables defined
+        by defvars, to names
+        """
+        if isinstance(code, Token):
+            if self._is_symbol(code):
+                names.add(code.value)
+            return
+        for (i, item) in enumerate(code):
+            if i != 1 or self._defvar_name(code) is None:
+                self._find_uses(item, names)
+
+    def _defvar_name(self, expr):
+        """
+        Return: The name of the variable if expr is a defvar of one value
+        """
+        if isinstance(expr, Token) or len(expr) != 3 or \
+                not self._is_symbol(expr[0]) or expr[0].value != 'defvar' or \
+                not self._is_symbol(expr[1]):
+            return None
+        return expr[1].value
+
+    def _hoistable(self, expr):
+        """
+        Return: The name of the variable if expr is a defvar that may be hoisted
+        """
+        name = self._defvar_name(expr)
+        if name is None:
+            return None
+        if '.' in name or name in self.bound or name in self.reserved or \
+                self.defvars.get(name) != 1 or self._is_variable('defvar') or \
+                name in self.used_early or \
+                self.e.stack.get(name, allow_undefined=True) is not None:
+            return None
+        return name
+
+    def _is_variable(self, name):
+        """
+        Check if a name is bound by the policy or in the Evaluator
+        """
+        return name in self.bound or name in self.defvars or \
+               self.e.stack.get(name, allow_undefined=True) is not None
+
+    def _is_symbol(self, token):
+        return isinstance(token, Token) and token.kind == 'symbol'
+
+    def _is_constant(self, code):
+        return isinstance(code, Token) and \
+               code.kind in ('number', 'string', 'constant')
+
+    def _value(self, token):
+        if token.kind == 'number':
+            return self.e.eval_number(token)
+        elif token.kind == 'string':
+            return token.value[1:-1]
+        return token.value
+
+    def _line(self, code):
+        while not isinstance(code, Token):
+            if len(code) == 0:
+                return None
+            code = code[0]
+        return code.line
+
+    def format(self, code):
+        """
+        Convert parsed code back into policy source
+        """
+        if isinstance(code, Token):
+            if code.kind == 'constant':
+                return repr(code.value)
+            return str(code.value)
+        return '(%s)' % ' '.join(map(self.format, code))
+
+    def fold(self, code):
+        """
+        Simplify an expression.
+        Return: The new expression
+        """
+        if isinstance(code, Token):
+            if self._is_symbol(code) and code.value in self.constants:
+                return ConstantToken(self.constants[code.value], code.line)
+            return code
+        if len(code) == 0 or not isinstance(code[0], Token):
+            return code
+
+        node = code[0]
+        if node.kind == 'symbol':
+            name = node.value
+        elif node.kind == 'operator' and node.value in self.e.operator_map:
+            name = self.e.operator_map[node.value]
+        else:
+            return code
+        args = code[1:]
+
+        if '.' in name or self._is_variable(name):
+            if getattr(ExternalFunctions, name, None) is not None and \
+                    name not in self.bound and name not in self.defvars and \
+                    self.e.stack.get(name) is getattr(ExternalFunctions, name):
+                return self.fold_call(code, getattr(ExternalFunctions, name))
+            return [node] + map(self.fold, args)
+        elif name in self.e.signatures:
+            fn, kinds = self.e.signatures[name]
+            if fn is not Evaluator.__dict__.get('c_%s' % name):
+                # A form added by an Evaluator subclass
+                return code
+            elif name in self.pure_forms:
+                return self.fold_call(code, lambda *a: fn(self.e, *a))
+            handler = getattr(self, 'fold_%s' % name, None)
+            if handler is None:
+                return code
+            return handler(code)
+        # Multiple statements and user function calls
+        return [node] + map(self.fold, args)
+
+    def fold_call(self, code, fn):
+        args = map(self.fold, code[1:])
+        if len(filter(self._is_constant, args)) != len(args):
+            return [code[0]] + args
+        try:
+            value = fn(*map(self._value, args))
+        except Exception:
+            # Report the error when the policy is evaluated
+            return [code[0]] + args
+        self.folded.append((self._line(code), self.format(code), value))
+        return ConstantToken(value, self._line(code))
+
+    def fold_if(self, code):
+        if len(code) != 4:
+            return code
+        (cond, yes, no) = map(self.fold, code[1:])
+        if not self._is_constant(cond):
+            return [code[0], cond, yes, no]
+        if self._value(cond):
+            branch = yes
+        else:
+            branch = no
+        self.folded.append((self._line(code), self.format(code),
+                            self.format(branch)))
+        return branch
+
+    def fold_def(self, code):
+        if len(code) != 4:
+            return code
+        return code[0:3] + [self.fold(code[3])]
+
+    def fold_defvar(self, code):
+        if len(code) != 3:
+            return code
+        return code[0:2] + [self.fold(code[2])]
+
+    fold_set = fold_defvar
+
+    def fold_let(self, code):
+        if len(code) != 3 or type(code[1]) != list:
+            return code
+        syms = []
+        for sym in code[1]:
+            if type(sym) == list and len(sym) == 2:
+                sym = [sym[0], self.fold(sym[1])]
+            syms.append(sym)
+        return [code[0], syms, self.fold(code[2])]
+
+    def fold_with(self, code):
+        if len(code) != 4:
+            return code
+        return code[0:3] + [self.fold(code[3])]
@@ -15,17 +15,19 @@
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
 
 import re
+import logging
 from spark import GenericScanner, GenericParser
 
 class PolicyError(Exception): pass
 
 class Token(object):
-    def __init__(self, kind, value=None):
+    def __init__(self, kind, value=None, line=None):
         self.kind = kind
         if value == None:
             self.value = kind
         else:
             self.value = value
+        self.line = line
 
     def __cmp__(self, rhs):
         return cmp(self.kind, rhs)
@@ -38,6 +40,14 @@ class NumericToken(Token):
         self.type = type
         Token.__init__(self, 'number', value)
 
+class ConstantToken(Token):
+    """
+    A value that was computed when the policy was loaded
+    """
+    def __init__(self, value, line=None):
+        Token.__init__(self, 'constant', line=line)
+        self.value = value
+
 class Scanner(GenericScanner):
     def __init__(self, operators=''):
         self.operators = operators
@@ -162,6 +172,113 @@ class Parser(GenericParser):
          '''
         return args[0]
 
+class SexpParser(object):
+    """
+    A linear-time tokenizer and parser for policy code.  It accepts the same
+    language as Scanner and Parser and produces the same tree of Tokens and
+    lists, but it does not need to build a spark scanner and an Earley parser
+    every time a policy is loaded.  Tokens are tagged with the line on which
+    they appear and syntax errors are reported with a line and column.
+    """
+    # Token patterns in the order Scanner tries them
+    token_res = [
+        ('open', r' [\(\[{] '),
+        ('close', r' [\)\]}] '),
+        ('float', r' -?(0|([1-9][0-9]*))*(\.[0-9]+)([Ee][+-]?[0-9]+)? '),
+        ('hex', r' 0[Xx][0-9A-Fa-f]+ '),
+        ('integer', r' -?(0(?![0-9Xx])|[1-9][0-9]*)(?![0-9eE]) '),
+        ('integer_with_exponent',
+                    r' -?(0(?![0-9Xx])|[1-9][0-9]*)[Ee][+-]?[0-9]+ '),
+        ('octal', r' 0[0-9]+ '),
+        ('comment', r' \#[^\n]* '),
+        ('single_quote_string', r" '([^'\\]|\\.)*' "),
+        ('string', r' "([^"\\]|\\.)*" '),
+        ('symbol', r' [A-Za-z_][A-Za-z0-9_\-\.]* '),
+        ('operator', None),
+        ('whitespace', r' \s+ '),
+    ]
+    numeric_types = { 'float': 'float', 'hex': 'hex', 'integer': 'integer',
+                      'integer_with_exponent': 'float', 'octal': 'octal' }
+    brackets = { '(': ')', '[': ']', '{': '}' }
+    _patterns = {}
+
+    def __init__(self, operators=''):
+        key = tuple(sorted(operators))
+        if key not in self._patterns:
+            self._patterns[key] = re.compile(self._make_re(operators),
+                                             re.VERBOSE)
+        self.re = self._patterns[key]
+
+    def _make_re(self, operators):
+        # Try longer operators first so that '<=' is not read as '<'
+        ops = sorted(operators, key=len, reverse=True)
+        rv = []
+        for (name, pattern) in self.token_res:
+            if name == 'operator':
+                if len(ops) == 0:
+                    continue
+                pattern = '|'.join([ re.escape(op) for op in ops ])
+            rv.append('(?P<%s>%s)' % (name, pattern))
+        return '|'.join(rv)
+
+    def _error(self, string, pos, msg):
+        line = string.count('\n', 0, pos) + 1
+        col = pos - (string.rfind('\n', 0, pos) + 1) + 1
+        return PolicyError('Syntax error at line %i, column %i: %s' %
+                           (line, col, msg))
+
+    def parse(self, string):
+        """
+        Parse a string into a list of values.
+        Return: The list of parsed values
+        """
+        match = self.re.match
+        pos = 0
+        end = len(string)
+        line = 1
+        cur = []
+        stack = []
+        while pos < end:
+            m = match(string, pos)
+            if m is None:
+                raise self._error(string, pos, "unexpected character '%s'" %
+                                  string[pos])
+            kind = m.lastgroup
+            text = m.group(kind)
+            if kind == 'open':
+                stack.append((cur, text, pos))
+                cur = []
+            elif kind == 'close':
+                if len(stack) == 0:
+                    raise self._error(string, pos, "unexpected '%s'" % text)
+                (parent, opener, start) = stack.pop()
+                if self.brackets[opener] != text:
+                    raise self._error(string, pos, "'%s' does not match '%s' "
+                        "at line %i" % (text, opener,
+                                        string.count('\n', 0, start) + 1))
+                if opener == '{':
+                    cur = [Token('symbol', 'eval', line)] + cur
+                parent.append(cur)
+                cur = parent
+            elif kind in self.numeric_types:
+                token = NumericToken(self.numeric_types[kind], text)
+                token.line = line
+                cur.append(token)
+            elif kind in ('string', 'single_quote_string'):
+                cur.append(Token('string', text, line))
+            elif kind in ('symbol', 'operator'):
+                cur.append(Token(kind, text, line))
+            if kind in ('whitespace', 'string', 'single_quote_string'):
+                line += text.count('\n')
+            pos = m.end()
+
+        if len(stack) > 0:
+            (parent, opener, start) = stack[-1]
+            raise self._error(string, start, "unclosed '%s'" % opener)
+        if len(cur) == 0:
+            raise self._error(string, pos, "expected a value")
+        return cur
+
 class ExternalFunctions(object):
     '''
     This class defines a set of Python functions that will be callable from
@@ -172,20 +289,44 @@ class ExternalFunctions(object):
     def abs(x):
         return __builtins__['abs'](x)
 
+def _class_attr(cls, name):
+    """
+    Return: The attribute of a class as it is stored in the class dictionary,
+    without binding it
+    """
+    for c in cls.__mro__:
+        if name in c.__dict__:
+            return c.__dict__[name]
+    return None
+
+def _form_function(fn):
+    """
+    Convert a special form as stored in a class into a function taking the
+    evaluator as its first argument.
+    """
+    if isinstance(fn, staticmethod):
+        f = fn.__get__(None, object)
+        wrapper = lambda e, *args: f(*args)
+    elif isinstance(fn, classmethod):
+        f = fn.__get__(None, object).im_func
+        wrapper = lambda e, *args: f(e.__class__, *args)
+    else:
+        return fn
+    wrapper.__doc__ = f.__doc__
+    return wrapper
+
 class GenericEvaluator(object):
     operator_map = {}
 
     def __init__(self):
-        pass
+        self.signatures = self.get_signatures()
 
     def get_operators(self):
         return self.operator_map.keys()
 
-    def parse_doc(self, doc):
-        scanner = Scanner(['...'])
-        tokens = scanner.tokenize(doc)
-        parser = Parser(start='value_list')
-        return parser.parse(tokens)
+    @staticmethod
+    def parse_doc(doc):
+        return SexpParser(['...']).parse(doc)
 
     # TODO: split up doc parsing...
     # use elipse syntax to indicate repetition in a
@@ -196,24 +337,81 @@ class GenericEvaluator(object):
     # is a list of zero or more tuples of symbol value
     # (symbol number ...)
     # is a list containing a symbol and zero or more numbers
-    def _dispatch(self, fn, args):
-        doc = fn.__doc__
-        if doc == None:
+    @classmethod
+    def parse_signature(cls, doc):
+        """
+        Convert a c_* function docstring into a tuple of argument kinds.
+        Return: The tuple of kinds or None if all arguments are evaluated
+        """
+        if doc is None:
+            return None
+        return tuple([ t.value for t in cls.parse_doc(doc) ])
+
+    @classmethod
+    def get_signatures(cls):
+        """
+        Get the dispatch table for this class.  It maps the name of every c_*
+        function to a tuple: (function, argument kinds).  The table is built
+        once per class so the docstrings are only parsed the first time.
+        """
+        if '_signatures' not in cls.__dict__:
+            table = {}
+            for attr in dir(cls):
+                if not attr.startswith('c_'):
+                    continue
+                fn = _form_function(_class_attr(cls, attr))
+                table[attr[2:]] = (fn, cls.parse_signature(fn.__doc__))
+            # Keep the signatures of forms inherited from register_form()
+            for base in reversed(cls.__mro__[1:]):
+                for (name, entry) in base.__dict__.get('_signatures', {}).items():
+                    attr = 'c_%s' % name
+                    if name in table and \
+                            _class_attr(cls, attr) is _class_attr(base, attr):
+                        table[name] = entry
+            cls._signatures = table
+        return cls._signatures
+
+    @classmethod
+    def register_form(cls, name, fn, signature=None):
+        """
+        Register a new special form for this class and its subclasses.  The
+        function is called with the evaluator instance as its first argument
+        unless it is a staticmethod or a classmethod.
+        The signature is a string of argument kinds in the same format as a
+        c_* docstring (eg. 'symbol code').  Arguments of kind 'code' are passed
+        unevaluated, 'symbol' arguments are passed as a name, and all others
+        are evaluated.  If no signature is given, all arguments are evaluated.
+        """
+        kinds = cls.parse_signature(signature)
+        cls.get_signatures()
+        setattr(cls, 'c_%s' % name, fn)
+        entry = (_form_function(fn), kinds)
+        classes = [cls]
+        while len(classes) > 0:
+            c = classes.pop()
+            # Update existing tables in place so evaluator instances see it
+            if '_signatures' in c.__dict__ and \
+                    c.__dict__.get('c_%s' % name, fn) is fn:
+                c._signatures[name] = entry
+            classes.extend(c.__subclasses__())
+
+    def _dispatch(self, name, args):
+        fn, types = self.signatures[name]
+        if types is None:
             args = map(self.eval, args)
         else:
-            types = self.parse_doc(doc)
             if len(types) != len(args):
                 raise PolicyError('arity mismatch in doc parsing')
             for i in range(len(types)):
-                if types[i].value == 'code':
+                if types[i] == 'code':
                     continue
-                elif types[i].value == 'symbol':
+                elif types[i] == 'symbol':
                     if not isinstance(args[i], Token) or args[i].kind != 'symbol':
                         raise PolicyError('malformed expression')
                     args[i] = args[i].value
                 else:
                     args[i] = self.eval(args[i])
-        return fn(*args)
+        return fn(self, *args)
 
     def eval(self, code):
         if isinstance(code, Token):
@@ -223,6 +421,8 @@ class GenericEvaluator(object):
                 return code.value[1:-1]
             elif code.kind == 'symbol':
                 return self.eval_symbol(code.value)
+            elif code.kind == 'constant':
+                return code.value
             else:
                 raise PolicyError('Unexpected token type "%s"' % code.kind)
 
@@ -242,49 +442,124 @@ class GenericEvaluator(object):
         if func is not None:
             args = map(self.eval, code[1:])
             return func(*args)
-        elif hasattr(self, 'c_%s' % name):
-            return self._dispatch(getattr(self, 'c_%s' % name), code[1:])
+        elif name in self.signatures:
+            return self._dispatch(name, code[1:])
         elif hasattr(self, "default"):
             return self.default(name, code[1:])
         else:
             raise PolicyError('Unknown function "%s" with no default handler' % name)
 
-class VariableStack(object):
-    def __init__(self):
-        self.stack = []
-
-    def enter_scope(self):
-        self.stack = [{}] + self.stack
-
-    def leave_scope(self):
-        self.stack = self.stack[1:]
+# Marks a slot whose variable has not been defined (yet) in a Frame
+UNBOUND = object()
+
+class Frame(object):
+    """
+    A Frame is one scope of the variable stack.  Variable values are stored in
+    an array of slots and the layout maps variable names to slots.  The policy
+    compiler creates all frames for the same let, with or def from one shared
+    layout so that it can resolve a variable to a (depth, slot) coordinate
+    ahead of time.  Slots that belong to variables which have not been defined
+    yet hold UNBOUND.
+    """
+    __slots__ = ('layout', 'values', 'parent', 'shared')
+
+    def __init__(self, parent=None, layout=None):
+        self.parent = parent
+        if layout is None:
+            self.layout = {}
+            self.values = []
+            self.shared = False
+        else:
+            self.layout = layout
+            self.values = [UNBOUND] * len(layout)
+            self.shared = True
+
+    def reserve(self, name):
+        """
+        Get the slot for a variable in this frame, adding one if necessary.
+        """
+        slot = self.layout.get(name)
+        if slot is None:
+            if self.shared:
+                # Other frames use this layout so this frame needs a copy
+                self.layout = dict(self.layout)
+                self.shared = False
+            slot = len(self.values)
+            self.layout[name] = slot
+            self.values.append(UNBOUND)
+        return slot
+
+    def alloc(self, name, value):
+        self.values[self.reserve(name)] = value
+        return value
+
+    def find(self, name):
+        """
+        Find the innermost frame in which a variable is defined.
+        Return: A (frame, slot) tuple or (None, None) if it is undefined.
+        """
+        frame = self
+        while frame is not None:
+            slot = frame.layout.get(name)
+            if slot is not None and frame.values[slot] is not UNBOUND:
+                return (frame, slot)
+            frame = frame.parent
+        return (None, None)
+
+    def lookup(self, name):
+        """
+        Return the value of a variable or UNBOUND if it is undefined.
+        """
+        (frame, slot) = self.find(name)
+        if frame is None:
+            return UNBOUND
+        return frame.values[slot]
 
     def get(self, name, allow_undefined=False):
         # Split the name on '.' to handle object references
         parts = name.split('.')
         obj = parts[0]
-        for scope in self.stack:
-            if scope.has_key(obj):
-                if len(parts) > 1:
-                    if hasattr(scope[obj], parts[1]):
-                        return getattr(scope[obj], parts[1])
+        frame = self
+        while frame is not None:
+            slot = frame.layout.get(obj)
+            if slot is not None:
+                value = frame.values[slot]
+                if value is UNBOUND:
+                    pass
+                elif len(parts) > 1:
+                    if hasattr(value, parts[1]):
+                        return getattr(value, parts[1])
                 else:
-                    return scope[obj]
+                    return value
+            frame = frame.parent
         if allow_undefined:
             return None
         raise PolicyError("undefined symbol %s" % name)
 
-    def set(self, name, value, alloc=False):
-        if alloc:
-            self.stack[0][name] = value
-            return value
+    def set(self, name, value):
+        (frame, slot) = self.find(name)
+        if frame is None:
+            raise PolicyError("undefined symbol %s" % name)
+        frame.values[slot] = value
+        return value
+
+class VariableStack(object):
+    def __init__(self):
+        self.frame = None
 
-        for scope in self.stack:
-            if scope.has_key(name):
-                scope[name] = value
-                return value
+    def enter_scope(self):
+        self.frame = Frame(self.frame)
 
-        raise PolicyError("undefined symbol %s" % name)
+    def leave_scope(self):
+        self.frame = self.frame.parent
+
+    def get(self, name, allow_undefined=False):
+        return self.frame.get(name, allow_undefined)
+
+    def set(self, name, value, alloc=False):
+        if alloc:
+            return self.frame.alloc(name, value)
+        return self.frame.set(name, value)
 
 class Evaluator(GenericEvaluator):
     operator_map = {'+': 'add', '-': 'sub',
@@ -431,7 +706,7 @@ class Evaluator(GenericEvaluator):
     def c_not(self, x):
         return not x
 
-def get_code(e, string):
+def get_code_spark(e, string):
     try:
         scanner = Scanner(e.get_operators())
         tokens = scanner.tokenize(string)
@@ -440,6 +715,23 @@ def get_code(e, string):
     except SystemExit:
         raise PolicyError("parse error")
 
+def get_code(e, string):
+    """
+    Parse a policy string with SexpParser.  The spark parser is only used if
+    SexpParser rejects the input since spark silently ignores everything after
+    a character it cannot tokenize.
+    """
+    try:
+        return SexpParser(e.get_operators()).parse(string)
+    except PolicyError, err:
+        try:
+            code = get_code_spark(e, string)
+        except PolicyError:
+            raise err
+        logger = logging.getLogger('mom.Policy')
+        logger.warn("Using the spark policy parser: %s", err)
+        return code
+
 def eval(e, string):
     code = get_code(e, string)
     results = []
@@ -18,25 +18,82 @@ import logging
 from Parser import Evaluator
 from Parser import get_code
 from Parser import PolicyError
+from Compiler import Compiler
+from Optimizer import Optimizer
+from Profiler import Profiler, ProfilingEvaluator
+from FieldUsage import get_used_fields
 
 class Policy:
-    def __init__(self, policy_string):
+    def __init__(self, policy_string, compiled=True, optimized=True,
+                 profile_ticks=0):
         self.logger = logging.getLogger('mom.Policy')
         self.policy_string = policy_string
-        self.evaluator = Evaluator()
+        if profile_ticks > 0:
+            self.profiler = Profiler(profile_ticks)
+            self.evaluator = ProfilingEvaluator(self.profiler)
+        else:
+            self.profiler = None
+            self.evaluator = Evaluator()
         self.code = get_code(self.evaluator, self.policy_string)
+        # The statistics this policy reads or None if it could read any
+        self.fields = get_used_fields(self.code)
+        self.folded = []
+        if optimized:
+            self.optimize()
+        if compiled:
+            # A vectorized with statement would hide the functions it calls
+            # from the profile
+            compiler = Compiler(self.evaluator, self.profiler is None,
+                                self.profiler)
+            self.compiled = compiler.compile_program(self.code)
+        else:
+            self.compiled = None
+
+    def optimize(self):
+        """
+        Simplify the policy code and define the constant variables.  They stay
+        defined in this Policy's Evaluator until the policy is replaced.
+        """
+        optimizer = Optimizer(self.evaluator, reserved=('Host', 'Guests'))
+        (hoisted, self.code) = optimizer.optimize(self.code)
+        for expr in hoisted:
+            self.evaluator.eval(expr)
+        self.folded = optimizer.folded
+        if len(self.folded) > 0:
+            self.logger.info("Policy optimizer simplified %i expressions" % \
+                             len(self.folded))
+        for (line, source, value) in self.folded:
+            self.logger.debug("Line %s: %s => %s" % (line, source, value))
+
+    def get_fields(self):
+        return self.fields
 
     def get_string(self):
         return self.policy_string
 
+    def get_profile(self):
+        """
+        Return: The profile of the most recent evaluations or None if profiling
+        is disabled
+        """
+        if self.profiler is None:
+            return None
+        return self.profiler.get_profile()
+
     def evaluate(self, host, guest_list):
         results = []
+        if self.profiler is not None:
+            self.profiler.new_tick()
         self.evaluator.stack.set('Host', host, alloc=True)
         self.evaluator.stack.set('Guests', guest_list, alloc=True)
         
         try:
-            for expr in self.code:
-                results.append(self.evaluator.eval(expr))
+            if self.compiled is not None:
+                for expr in self.compiled:
+                    results.append(expr())
+            else:
+                for expr in self.code:
+                    results.append(self.evaluator.eval(expr))
             self.logger.debug("Results: %s" % results)
         except PolicyError as e:
             self.logger.error("Policy error: %s" % e)
@@ -0,0 +1,148 @@
+# Memory Overcommitment Manager
+# Copyright (C) 2010 Adam Litke, IBM Corporation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public
+# License along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+
+import time
+from collections import deque
+from Parser import Token, Evaluator
+
+class Profiler(object):
+    """
+    The Profiler records how often policy code runs and how long it takes.
+    Measurements are kept per user function, per special form and per source
+    line.  The total time of an entry includes everything called from it while
+    its self time does not.
+
+    Each evaluation of the policy (a tick) gets its own set of measurements and
+    only the most recent ticks are kept.
+    """
+    # Names for each kind of entry in the profile
+    kinds = { 'def': 'functions', 'form': 'forms', 'line': 'lines' }
+
+    def __init__(self, ticks):
+        self.window = deque(maxlen=ticks)
+        # The entries being timed: [key, start time, time spent in children]
+        self.stack = []
+        # The number of times each key appears on the stack
+        self.active = {}
+        # Code run before the first tick, such as hoisted constants, is not
+        # part of the profile
+        self.current = {}
+
+    def new_tick(self):
+        self.current = {}
+        self.window.append(self.current)
+
+    def enter(self, key):
+        self.stack.append([key, time.time(), 0.0])
+        self.active[key] = self.active.get(key, 0) + 1
+
+    def leave(self):
+        (key, start, child) = self.stack.pop()
+        elapsed = time.time() - start
+        entry = self.current.get(key)
+        if entry is None:
+            entry = [0, 0.0, 0.0]
+            self.current[key] = entry
+        entry[0] += 1
+        self.active[key] -= 1
+        # Count recursive calls only once in the total time
+        if self.active[key] == 0:
+            entry[1] += elapsed
+        entry[2] += elapsed - child
+        if len(self.stack) > 0:
+            self.stack[-1][2] += elapsed
+
+    def wrap(self, key, fn):
+        """
+        Return a function which profiles calls to fn under the given key
+        """
+        enter = self.enter
+        leave = self.leave
+        def profiled(*args):
+            enter(key)
+            try:
+                return fn(*args)
+            finally:
+                leave()
+        return profiled
+
+    def get_profile(self):
+        """
+        Sum up the measurements over the ticks in the window.
+        Return: A dictionary with the number of ticks and a dictionary for
+        each kind of entry which maps names to their calls, total and self time
+        (in seconds).
+        """
+        profile = { 'ticks': len(self.window) }
+        for kind in self.kinds.values():
+            profile[kind] = {}
+        for tick in self.window:
+            for ((kind, name), (calls, total, own)) in tick.items():
+                entries = profile[self.kinds[kind]]
+                # Dictionaries passed through xmlrpc need string keys
+                name = str(name)
+                if name not in entries:
+                    entries[name] = { 'calls': 0, 'total': 0.0, 'self': 0.0 }
+                entries[name]['calls'] += calls
+                entries[name]['total'] += total
+                entries[name]['self'] += own
+        return profile
+
+class ProfilingEvaluator(Evaluator):
+    """
+    An Evaluator which profiles the code that it interprets
+    """
+    def __init__(self, profiler):
+        Evaluator.__init__(self)
+        self.profiler = profiler
+        self.line = None
+
+    def eval(self, code):
+        if isinstance(code, Token) or len(code) == 0 or \
+                not isinstance(code[0], Token):
+            return Evaluator.eval(self, code)
+        line = code[0].line
+        if line is None or line == self.line:
+            return Evaluator.eval(self, code)
+
+        # The first expression on a new line
+        saved = self.line
+        self.line = line
+        self.profiler.enter(('line', line))
+        try:
+            return Evaluator.eval(self, code)
+        finally:
+            self.profiler.leave()
+            self.line = saved
+
+    def _dispatch(self, name, args):
+        if self.signatures[name][1] is None:
+            # An operator
+            return Evaluator._dispatch(self, name, args)
+        self.profiler.enter(('form', name))
+        try:
+            return Evaluator._dispatch(self, name, args)
+        finally:
+            self.profiler.leave()
+
+    def default(self, name, args):
+        if name == 'eval':
+            return Evaluator.default(self, name, args)
+        self.profiler.enter(('def', name))
+        try:
+            return Evaluator.default(self, name, args)
+        finally:
+            self.profiler.leave()
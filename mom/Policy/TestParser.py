@@ -16,13 +16,20 @@
 
 import unittest
 import Parser
+import Compiler
+import Optimizer
+import Profiler
+import FieldUsage
 
 class TestEval(unittest.TestCase):
     def setUp(self):
         self.e = Parser.Evaluator()
 
+    def eval(self, pol):
+        return Parser.eval(self.e, pol)
+
     def verify(self, pol, expected):
-        results = Parser.eval(self.e, pol)
+        results = self.eval(pol)
         self.assertEqual(results, expected)
 
     def test_comments(self):
@@ -32,7 +39,7 @@ class TestEval(unittest.TestCase):
         (+ 3 # An expression with embedded comments
         2)
         """
-        results = Parser.eval(self.e, pol)
+        results = self.eval(pol)
         self.assertEqual(results, [ 12, 5 ])
 
     def test_whitespace(self):
@@ -166,7 +173,22 @@ class TestEval(unittest.TestCase):
         (if (== a 5) (defvar a 4) 0)    # if does not create a new scope
         a
         """
-        self.verify(pol, [ 10, 'foo', 2, 2, 'foo', 4, 2, 5, 4, 5, 4, 4 ]) 
+        self.verify(pol, [ 10, 'foo', 2, 2, 'foo', 4, 2, 5, 4, 5, 4, 4 ])
+
+    def test_dynamic_scope(self):
+        pol = """
+        (def get_x () x)                # Functions see their caller's scope
+        (let ((x 1)) (get_x))
+        (def f (x) (get_x))
+        (f 2)
+        (def g (y) (let ((x (+ y 1))) (get_x)))
+        (g 5)
+        (def h (x y) y)
+        (h 3 x)                         # Arguments see earlier parameters
+        (defvar x 7)
+        (get_x)
+        """
+        self.verify(pol, [ 'get_x', 1, 'f', 2, 'g', 6, 'h', 3, 7, 7 ])
 
     def test_multi_statements(self):
         pol = """
@@ -250,17 +272,292 @@ class TestEval(unittest.TestCase):
                              "This guest's name is Guest-2",
                              "This guest's name is Guest-4" ] ])
 
+    def test_register_form(self):
+        class ExtEvaluator(Parser.Evaluator):
+            pass
+        def c_unless(self, cond, code):
+            if not cond:
+                return self.eval(code)
+            return 0
+        def c_max(self, x, y):
+            return max(x, y)
+        ExtEvaluator.register_form('unless', c_unless, 'value code')
+        ExtEvaluator.register_form('max', c_max)
+        self.e = ExtEvaluator()
+        pol = """
+        (unless 0 (+ 1 2))
+        (unless 1 (+ 1 2))
+        (max 3 (- 10 2))
+        """
+        self.verify(pol, [ 3, 0, 8 ])
+        self.assertFalse('unless' in Parser.Evaluator.get_signatures())
+
+        # Subclasses inherit registered forms with their signatures
+        class SubEvaluator(ExtEvaluator):
+            pass
+        self.e = SubEvaluator()
+        self.verify("(unless 0 (+ 1 2))", [ 3 ])
+
+    def test_static_forms(self):
+        class ExtEvaluator(Parser.Evaluator):
+            @staticmethod
+            def c_twice(x):
+                return x * 2
+            @classmethod
+            def c_kind(cls, x):
+                return "%s %s" % (cls.__name__, x)
+        ExtEvaluator.register_form('half', staticmethod(lambda x: x / 2))
+        ExtEvaluator.register_form('name', classmethod(lambda cls, x: x),
+                                   'symbol')
+        self.e = ExtEvaluator()
+        self.verify('(twice 4) (kind 1) (half 4) (name foo)',
+                    [ 8, "ExtEvaluator 1", 2, "foo" ])
+
     def test_syntax_error(self):
         pol = """
         (+ 2 2
         """
-        self.assertRaises(Parser.PolicyError, Parser.eval, self.e, pol)
+        self.assertRaises(Parser.PolicyError, self.eval, pol)
         
     def test_parse_error(self):
         pol = """
         (2 + 2)
         """
-        self.assertRaises(Parser.PolicyError, Parser.eval, self.e, pol)
+        self.assertRaises(Parser.PolicyError, self.eval, pol)
+
+class TestParse(unittest.TestCase):
+    def setUp(self):
+        self.e = Parser.Evaluator()
+        self.parser = Parser.SexpParser(self.e.get_operators())
+
+    def test_spark_compat(self):
+        pol = """
+        (def f (a b) { (defvar c (+ a b)) c })   # Comment
+        [1 2.5 -3 0x1F 011 1e3 -.5] 'single' "double \\" quote"
+        (<= (<< 1 2) (>= a-b.c 3))
+        () [] {}"""
+        spark = Parser.get_code_spark(self.e, pol)
+        code = self.parser.parse(pol)
+        self.assertEqual(repr(code), repr(spark))
+        self.assertEqual(code[0][3][1][0].line, 2)
+
+    def assertSyntaxError(self, pol, msg):
+        try:
+            self.parser.parse(pol)
+        except Parser.PolicyError, e:
+            self.assertEqual(str(e), msg)
+        else:
+            self.fail("No syntax error raised")
+
+    def test_syntax_errors(self):
+        self.assertSyntaxError("(+ 1\n  (- 2 3]",
+            "Syntax error at line 2, column 9: ']' does not match '(' at line 2")
+        self.assertSyntaxError("1\n(+ 2 2",
+            "Syntax error at line 2, column 1: unclosed '('")
+        self.assertSyntaxError("(+ 1 2))",
+            "Syntax error at line 1, column 8: unexpected ')'")
+        self.assertSyntaxError("(+ 1 2) @",
+            "Syntax error at line 1, column 9: unexpected character '@'")
+
+class TestOptimizer(unittest.TestCase):
+    def optimize(self, pol):
+        e = Parser.Evaluator()
+        optimizer = Optimizer.Optimizer(e, reserved=['Host'])
+        (hoisted, code) = optimizer.optimize(Parser.get_code(e, pol))
+        for expr in hoisted:
+            e.eval(expr)
+        return (e, code, optimizer.folded)
+
+    def test_fold(self):
+        pol = """
+        (defvar a 2)                # Hoisted
+        (defvar b (* a 3))          # Folded and hoisted
+        (defvar c 1)
+        (set c 2)                   # c is not a constant
+        (defvar Host 4)             # Assigned from outside of the policy
+        (if (> b 5) (abs (- a b)) (/ 1 0))
+        (/ b 0)                     # Errors are left for evaluation
+        (def f (x) (+ x a))
+        (f (+ c b))
+        """
+        (e, code, folded) = self.optimize(pol)
+        self.assertEqual(e.stack.get('b'), 6)
+        self.assertEqual(map(Optimizer.Optimizer(e).format, code[2:]),
+                         [ '(defvar c 1)', '(set c 2)', '(defvar Host 4)', '4',
+                           '(/ 6 0)', '(def f (x) (+ x 2))', '(f (+ c 6))' ])
+        self.assertEqual([ line for (line, source, value) in folded ],
+                         [ 2, 3, 3, 7, 7, 7, 7 ])
+        results = map(e.eval, code[:6]) + map(e.eval, code[7:])
+        self.assertEqual(results, [ 2, 6, 1, 2, 4, 4, 'f', 10 ])
+
+    def test_shadowed(self):
+        pol = """
+        (defvar a 2)
+        (def f (a) (* a 2))         # a is bound by a parameter
+        (defvar add abs)            # Variables shadow operators
+        (+ -2)
+        """
+        (e, code, folded) = self.optimize(pol)
+        self.assertEqual(folded, [])
+        self.assertEqual(map(e.eval, code), [ 2, 'f', e.stack.get('abs'), 2 ])
+
+    def test_forward_reference(self):
+        pol = """
+        (+ a 1)                     # a is used before it is defined
+        (defvar a 2)
+        """
+        (e, code, folded) = self.optimize(pol)
+        self.assertEqual(folded, [])
+        self.assertRaises(Parser.PolicyError, e.eval, code[0])
+        self.assertEqual(e.eval(code[1]), 2)
+        self.assertEqual(e.eval(code[0]), 3)
+
+class TestProfiler(unittest.TestCase):
+    pol = """
+    (def fact (n)
+        (if (<= n 1) 1 (* n (fact (- n 1)))))
+    (fact 3)
+    """
+
+    def check(self, e, code, profiler):
+        for i in range(3):
+            profiler.new_tick()
+            for expr in code:
+                expr()
+        profile = profiler.get_profile()
+        self.assertEqual(profile['ticks'], 2)
+        fact = profile['functions']['fact']
+        self.assertEqual(fact['calls'], 6)
+        # Recursive calls are only counted once in the total time
+        self.assertTrue(fact['self'] <= fact['total'])
+        self.assertEqual(profile['forms']['if']['calls'], 6)
+        self.assertEqual(profile['lines']['4']['calls'], 2)
+
+    def test_interpreted(self):
+        profiler = Profiler.Profiler(2)
+        e = Profiler.ProfilingEvaluator(profiler)
+        code = Parser.get_code(e, self.pol)
+        self.check(e, [ lambda expr=expr: e.eval(expr) for expr in code ],
+                   profiler)
+
+    def test_compiled(self):
+        profiler = Profiler.Profiler(2)
+        e = Parser.Evaluator()
+        code = Compiler.Compiler(e, profiler=profiler).compile_program(
+                    Parser.get_code(e, self.pol))
+        self.check(e, code, profiler)
+
+class TestFieldUsage(unittest.TestCase):
+    def fields(self, pol):
+        return FieldUsage.get_used_fields(
+                    Parser.get_code(Parser.Evaluator(), pol))
+
+    def test_fields(self):
+        pol = """
+        (defvar free (/ Host.mem_free Host.mem_available))
+        (with Guests guest
+            (if (> (guest.StatAvg "swap_in") 0)
+                (guest.Control "balloon_target" guest.balloon_cur)
+                (guest.Prop "name")))
+        """
+        self.assertEqual(self.fields(pol), set([ 'mem_free', 'mem_available',
+                         'swap_in', 'balloon_cur' ]))
+
+    def test_computed_name(self):
+        self.assertEqual(self.fields('(Host.Stat (if 1 "a" "b"))'), None)
+        self.assertEqual(self.fields('(defvar n "a") (Host.Stat n)'), None)
+
+    def test_aliased_method(self):
+        pol = """
+        (def get (f) (f "mem_free"))
+        (get Host.StatAvg)
+        """
+        self.assertEqual(self.fields(pol), None)
+
+class TestCompiledEval(TestEval):
+    def eval(self, pol):
+        return Compiler.eval(self.e, pol)
+
+    def test_shadowed_builtin(self):
+        pol = """
+        (def g (x) (* x 2))
+        (let ((g abs)) (g -3))      # A callable variable shadows a function
+        (g -3)
+        """
+        self.verify(pol, [ 'g', 3, -6 ])
+
+    def test_runtime_errors(self):
+        # Malformed expressions only fail when they are evaluated
+        self.verify("(if 0 (if 1 2) 3)", [ 3 ])
+        self.assertRaises(Parser.PolicyError, self.eval, "(if 1 2)")
+        self.assertRaises(Parser.PolicyError, self.eval, "(with Hosts h 1)")
+        self.assertRaises(Parser.PolicyError, self.eval,
+                          "(def f (a) a) (f 1 2)")
+
+    def test_vectorized_with(self):
+        class Guest(object):
+            def __init__(self, cur, free):
+                self.cur = cur
+                self.free = free
+                self.controls = {}
+            def StatAvg(self, name):
+                return getattr(self, name) / 2
+            def Control(self, name, val):
+                self.controls[name] = val
+        pol = """
+        (defvar limit 50)
+        (def target (guest) {
+            (if (> guest.free limit)
+                (defvar new (- guest.cur (guest.StatAvg "free")))
+                (defvar new (+ guest.cur (abs (- limit guest.free)))))
+            (if (!= new guest.cur) (guest.Control "target" new) 0)
+            new
+        })
+        (def big (guest) (if (> guest.cur 150) { (defvar x 1) x } 0))
+        (with Guests guest (target guest))
+        (with Guests g (let ((a (target g)) (b (* a 2))) (+ a b)))
+        (with Guests guest (big guest))
+        (with Guests guest (/ 100 guest.free))
+        """
+        results = {}
+        for mode in ('interpreted', 'compiled'):
+            guests = [ Guest(100, 80), Guest(200, 10), Guest(300, 50),
+                       Guest(100, 0) ]
+            e = Parser.Evaluator()
+            e.stack.set('Guests', guests, True)
+            if mode == 'compiled':
+                fn = Compiler.eval
+            else:
+                fn = Parser.eval
+            try:
+                out = fn(e, pol)
+            except ZeroDivisionError:
+                out = 'error'
+            results[mode] = (out, [ g.controls for g in guests ])
+        self.assertEqual(results['interpreted'], results['compiled'])
+
+        # Run the last statement without the division by zero
+        self.e.stack.set('Guests', [ Guest(1, 80), Guest(3, 4) ], True)
+        self.verify(pol.replace('100 guest', '100.0 guest'),
+                    [ 50, 'target', 'big', [ -39, 49 ], [ -117, 147 ],
+                      [ 0, 0 ], [ 1.25, 25.0 ] ])
+
+    def test_vectorized_control_error(self):
+        class Guest(object):
+            def __init__(self, fail):
+                self.fail = fail
+                self.calls = 0
+            def Control(self, name, val):
+                self.calls += 1
+                if self.fail:
+                    raise ValueError(name)
+        guests = [ Guest(False), Guest(True), Guest(False) ]
+        self.e.stack.set('Guests', guests, True)
+        # The error is not retried one guest at a time, which would repeat
+        # the calls that already succeeded
+        self.assertRaises(ValueError, self.eval,
+                          '(with Guests g (g.Control "x" 1))')
+        self.assertEqual([ g.calls for g in guests ], [ 1, 1, 0 ])
 
 if __name__ == '__main__':
     unittest.main()
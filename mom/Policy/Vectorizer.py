@@ -0,0 +1,527 @@
+# Memory Overcommitment Manager
+# Copyright (C) 2010 Adam Litke, IBM Corporation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public
+# License along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+
+import operator
+from itertools import izip, repeat
+from Parser import Token, PolicyError, Evaluator, ExternalFunctions
+
+class Column(list):
+    """
+    The values of an expression for every guest in a batch.  Only the positions
+    selected by the batch that computed a column are meaningful.  Columns are
+    never modified once they have been created.
+    """
+    pass
+
+class Partial(Column):
+    """
+    A variable column that was only written for some of the guests.  The other
+    positions hold UNSET.
+    """
+    pass
+
+UNSET = object()
+
+class Unsupported(Exception):
+    """
+    Raised at compile time for code that cannot be vectorized
+    """
+    pass
+
+class Deopt(Exception):
+    """
+    Raised at run time when a batch cannot be evaluated as a whole
+    """
+    pass
+
+class Batch(object):
+    """
+    The state of one vectorized evaluation.  The variables and deferred calls
+    are shared by all of the sub-batches created for the branches of an if.
+    """
+    def __init__(self, size, idx=None, parent=None):
+        self.size = size
+        if parent is None:
+            self.idx = xrange(size)
+            self.full = True
+            self.vars = {}
+            self.calls = []
+            self.cache = {}
+        else:
+            self.idx = idx
+            self.full = False
+            self.vars = parent.vars
+            self.calls = parent.calls
+            self.cache = parent.cache
+
+    def sub(self, idx):
+        return Batch(self.size, idx, self)
+
+def is_column(value):
+    return isinstance(value, Column)
+
+def vmap(batch, fn, args):
+    """
+    Apply fn to each row of a list of arguments that are columns or scalars.
+    """
+    if len(args) == 1:
+        x = args[0]
+        if not is_column(x):
+            return fn(x)
+        if batch.full:
+            return Column(map(fn, x))
+        out = Column([None] * batch.size)
+        for i in batch.idx:
+            out[i] = fn(x[i])
+        return out
+
+    cols = map(is_column, args)
+    if not any(cols):
+        return fn(*args)
+    if batch.full:
+        seqs = [ args[i] if cols[i] else repeat(args[i])
+                 for i in range(len(args)) ]
+        return Column([ fn(*row) for row in izip(*seqs) ])
+    out = Column([None] * batch.size)
+    for i in batch.idx:
+        out[i] = fn(*[ args[j][i] if cols[j] else args[j]
+                       for j in range(len(args)) ])
+    return out
+
+# Operators which can be applied directly to each row of a column.  They must
+# behave exactly like the Evaluator functions of the same name.
+row_ops = {
+    'add': operator.add, 'sub': operator.sub,
+    'mul': operator.mul, 'div': operator.div,
+    'lt': operator.lt, 'gt': operator.gt,
+    'lte': operator.le, 'gte': operator.ge,
+    'eq': operator.eq, 'neq': operator.ne,
+    'shl': operator.lshift, 'shr': operator.rshift,
+    'and': lambda x, y: x and y,
+    'or': lambda x, y: x or y,
+    'not': operator.not_,
+}
+
+class Vectorizer(object):
+    """
+    The Vectorizer compiles the body of a (with Guests guest ...) statement so
+    that it is evaluated once for the whole list of guests instead of once per
+    guest.  Every expression produces either a scalar, when its value is the
+    same for all guests, or a Column.  Calls to user functions are inlined and
+    an if with a per-guest condition evaluates each branch for the guests that
+    take it.
+
+    Evaluation has no side effects until it completes: calls to guest.Control
+    are recorded and replayed afterwards.  If anything goes wrong (an error,
+    a variable that is only set for some guests or a redefined function), the
+    results are discarded and the caller evaluates the guests one by one.
+
+    Only a subset of the language is supported: constants, variables, the
+    Evaluator operators, let, defvar, set of local variables, if, multiple
+    statements, external functions, user functions and the read-only Entity
+    methods.  Compiling anything else raises Unsupported.
+    """
+    read_methods = ('Stat', 'StatAge', 'StatAvg', 'StatMin', 'StatMax',
+                    'StatStdDev', 'StatEWMA', 'Prop', 'GetVar')
+    deferred_methods = ('Control',)
+
+    def __init__(self, compiler):
+        self.c = compiler
+        self.e = compiler.e
+        self.scopes = []
+        self.nr_vars = 0
+        self.inlined = []
+        self.active = []
+
+    def vectorize(self, iterator, code):
+        """
+        Compile the body of a with statement.
+        Return: A function taking the enclosing frame and the list of items, or
+        None if the code is not supported.  The function evaluates the body
+        without side effects and returns another function which makes the
+        deferred Control calls and returns the list of results.
+        """
+        try:
+            # The frame of each iteration holds the iterator and the defvars
+            # of the body.
+            self._enter([iterator], [code])
+            body = self.compile(code)
+        except Unsupported:
+            return None
+
+        funcs = self.e.funcs
+        inlined = self.inlined
+        def evaluate(frame, items):
+            for (name, code) in inlined:
+                entry = funcs.get(name)
+                if entry is None or entry[1] is not code:
+                    raise Deopt()
+            batch = Batch(len(items))
+            batch.vars[0] = Column(items)
+            result = body(frame, batch)
+            calls = batch.calls
+            def commit():
+                for (fns, args, idx) in calls:
+                    for i in idx:
+                        fns[i](*[ a[i] if is_column(a) else a for a in args ])
+                if is_column(result):
+                    return list(result)
+                return [ result ] * len(items)
+            return commit
+        return evaluate
+
+    def _enter(self, names, body):
+        """
+        Open a scope for a let or an inlined function, with variables for names
+        and for anything that defvar may bind directly in body.
+        """
+        scope = {}
+        for name in names + self._find_defvars(body, []):
+            if name not in scope:
+                scope[name] = self.nr_vars
+                self.nr_vars += 1
+        self.scopes.append(scope)
+        return [ scope[name] for name in names ]
+
+    def _leave(self):
+        self.scopes.pop()
+
+    def _find_defvars(self, code, names):
+        for expr in code:
+            if isinstance(expr, Token) or len(expr) == 0:
+                continue
+            head = expr[0]
+            if self.c._is_symbol(head):
+                if head.value in ('let', 'with', 'def'):
+                    continue
+                if head.value == 'defvar' and len(expr) > 1 and \
+                        self.c._is_symbol(expr[1]):
+                    names.append(expr[1].value)
+            self._find_defvars(expr, names)
+        return names
+
+    def _candidates(self, name):
+        return [ scope[name] for scope in reversed(self.scopes)
+                 if name in scope ]
+
+    def compile(self, code):
+        if isinstance(code, Token):
+            return self.compile_token(code)
+        if len(code) == 0 or not isinstance(code[0], Token):
+            raise Unsupported()
+        node = code[0]
+        if node.kind == 'symbol':
+            name = node.value
+        elif node.kind == 'operator' and node.value in self.e.operator_map:
+            name = self.e.operator_map[node.value]
+        else:
+            raise Unsupported()
+        args = code[1:]
+
+        if '.' in name:
+            return self.compile_method(name, args)
+        elif name in self.c.bound:
+            return self.compile_external(name, args)
+        elif name in self.e.signatures:
+            fn, kinds = self.e.signatures[name]
+            if fn is not Evaluator.__dict__.get('c_%s' % name):
+                raise Unsupported()
+            if kinds is None:
+                return self.compile_op(name, args)
+            handler = getattr(self, 'compile_%s' % name, None)
+            if handler is None:
+                raise Unsupported()
+            return handler(args)
+        elif name == 'eval' and len(args) > 0:
+            return self.compile_eval(args)
+        elif name in self.c.defs:
+            return self.compile_inline(name, args)
+        raise Unsupported()
+
+    def compile_token(self, token):
+        if token.kind == 'number':
+            try:
+                value = self.e.eval_number(token)
+            except PolicyError:
+                raise Unsupported()
+            return lambda frame, batch: value
+        elif token.kind == 'string':
+            value = token.value[1:-1]
+            return lambda frame, batch: value
+        elif token.kind == 'symbol':
+            return self.compile_lookup(token.value)
+        elif token.kind == 'constant':
+            value = token.value
+            return lambda frame, batch: value
+        raise Unsupported()
+
+    def compile_lookup(self, name):
+        parts = name.split('.')
+        find = self._make_finder(parts[0])
+        if find is None:
+            outer = self.c.compile_lookup(name)
+            return lambda frame, batch: outer(frame)
+        if len(parts) == 1:
+            return find
+        attr = parts[1]
+        def lookup_attr(frame, batch):
+            obj = find(frame, batch)
+            if not is_column(obj):
+                return getattr(obj, attr)
+            if batch.full:
+                key = (id(obj), attr)
+                cached = batch.cache.get(key)
+                if cached is None:
+                    cached = (obj, Column([ getattr(o, attr) for o in obj ]))
+                    batch.cache[key] = cached
+                return cached[1]
+            return vmap(batch, lambda o: getattr(o, attr), [obj])
+        return lookup_attr
+
+    def _make_finder(self, name):
+        """
+        Build a function which finds a vector variable.  The innermost variable
+        that is set for all of the guests in the batch wins.  Variables which
+        are set for only some of them cannot be handled.
+        Return: None if the name is not a vector variable
+        """
+        candidates = self._candidates(name)
+        if len(candidates) == 0:
+            return None
+        outer = self.c.compile_lookup(name)
+        def find(frame, batch):
+            for var in candidates:
+                value = batch.vars.get(var, UNSET)
+                if value is UNSET:
+                    continue
+                if isinstance(value, Partial):
+                    unset = [ value[i] is UNSET for i in batch.idx ]
+                    if all(unset):
+                        continue
+                    elif any(unset):
+                        raise Deopt()
+                return value
+            return outer(frame)
+        return find
+
+    def _store(self, batch, var, value):
+        """
+        Set a vector variable for the guests in a batch
+        """
+        if batch.full:
+            batch.vars[var] = value
+            return
+        old = batch.vars.get(var, UNSET)
+        if old is UNSET:
+            new = Partial([UNSET] * batch.size)
+        elif is_column(old):
+            new = old.__class__(old)
+        else:
+            new = Column([old] * batch.size)
+        if is_column(value):
+            for i in batch.idx:
+                new[i] = value[i]
+        else:
+            for i in batch.idx:
+                new[i] = value
+        batch.vars[var] = new
+
+    def compile_op(self, name, args):
+        op = row_ops.get(name)
+        if op is None:
+            raise Unsupported()
+        exprs = map(self.compile, args)
+        if len(exprs) == 1:
+            x = exprs[0]
+            return lambda frame, batch: vmap(batch, op, [x(frame, batch)])
+        elif len(exprs) == 2:
+            x, y = exprs
+            return lambda frame, batch: vmap(batch, op, [x(frame, batch),
+                                                         y(frame, batch)])
+        raise Unsupported()
+
+    def compile_external(self, name, args):
+        """
+        A call through a variable.  Only the ExternalFunctions, which have no
+        side effects, can be applied to a column.
+        """
+        if len(self._candidates(name)) > 0:
+            raise Unsupported()
+        lookup = self.c.compile_lookup(name, allow_undefined=True)
+        external = getattr(ExternalFunctions, name, None)
+        if external is None:
+            raise Unsupported()
+        exprs = map(self.compile, args)
+        def call(frame, batch):
+            if lookup(frame) is not external:
+                raise Deopt()
+            return vmap(batch, external,
+                        [ expr(frame, batch) for expr in exprs ])
+        return call
+
+    def compile_method(self, name, args):
+        method = name.split('.')[1]
+        obj = self.compile_lookup(name.split('.')[0])
+        exprs = map(self.compile, args)
+        if method in self.deferred_methods:
+            def defer(frame, batch):
+                objs = obj(frame, batch)
+                fns = {}
+                for i in batch.idx:
+                    fns[i] = getattr(objs[i] if is_column(objs) else objs,
+                                     method)
+                values = [ expr(frame, batch) for expr in exprs ]
+                batch.calls.append((fns, values, batch.idx))
+                return None
+            return defer
+        elif method not in self.read_methods:
+            raise Unsupported()
+
+        def call(frame, batch):
+            objs = obj(frame, batch)
+            values = [ expr(frame, batch) for expr in exprs ]
+            if not is_column(objs):
+                return vmap(batch, getattr(objs, method), values)
+            fn = lambda o, *a: getattr(o, method)(*a)
+            if not batch.full or True in map(is_column, values):
+                return vmap(batch, fn, [objs] + values)
+            key = (id(objs), method) + tuple(values)
+            try:
+                cached = batch.cache.get(key)
+            except TypeError:
+                # Unhashable arguments
+                return vmap(batch, fn, [objs] + values)
+            if cached is None:
+                cached = (objs, vmap(batch, fn, [objs] + values))
+                batch.cache[key] = cached
+            return cached[1]
+        return call
+
+    def compile_eval(self, args):
+        exprs = map(self.compile, args)
+        def multi(frame, batch):
+            for expr in exprs:
+                result = expr(frame, batch)
+            return result
+        return multi
+
+    def compile_inline(self, name, args):
+        params, code = self.c.defs[name]
+        if name in self.active or len(params) != len(args):
+            raise Unsupported()
+        self.active.append(name)
+        # Arguments are evaluated in the scope of the function, like let
+        vars = self._enter(params, [code])
+        exprs = map(self.compile, args)
+        body = self.compile(code)
+        self._leave()
+        self.active.pop()
+        self.inlined.append((name, code))
+        return self._bind(vars, exprs, body)
+
+    def _bind(self, vars, exprs, body):
+        store = self._store
+        def bind(frame, batch):
+            for i in range(len(vars)):
+                store(batch, vars[i], exprs[i](frame, batch))
+            return body(frame, batch)
+        return bind
+
+    def compile_let(self, args):
+        if len(args) != 2 or type(args[0]) != list:
+            raise Unsupported()
+        for sym in args[0]:
+            if type(sym) != list or len(sym) != 2 or \
+                    not self.c._is_symbol(sym[0]):
+                raise Unsupported()
+        names = [ sym[0].value for sym in args[0] ]
+        vars = self._enter(names, [ sym[1] for sym in args[0] ] + [args[1]])
+        exprs = [ self.compile(sym[1]) for sym in args[0] ]
+        body = self.compile(args[1])
+        self._leave()
+        return self._bind(vars, exprs, body)
+
+    def compile_defvar(self, args):
+        if len(args) != 2 or not self.c._is_symbol(args[0]):
+            raise Unsupported()
+        var = self.scopes[-1][args[0].value]
+        value = self.compile(args[1])
+        store = self._store
+        def defvar(frame, batch):
+            result = value(frame, batch)
+            store(batch, var, result)
+            return result
+        return defvar
+
+    def compile_set(self, args):
+        if len(args) != 2 or not self.c._is_symbol(args[0]):
+            raise Unsupported()
+        candidates = self._candidates(args[0].value)
+        if len(candidates) == 0:
+            # Setting a variable outside of the with statement
+            raise Unsupported()
+        value = self.compile(args[1])
+        store = self._store
+        def set_(frame, batch):
+            result = value(frame, batch)
+            for var in candidates:
+                old = batch.vars.get(var, UNSET)
+                if old is UNSET:
+                    continue
+                if isinstance(old, Partial):
+                    unset = [ old[i] is UNSET for i in batch.idx ]
+                    if all(unset):
+                        continue
+                    elif any(unset):
+                        raise Deopt()
+                store(batch, var, result)
+                return result
+            raise Deopt()
+        return set_
+
+    def compile_if(self, args):
+        if len(args) != 3:
+            raise Unsupported()
+        cond, yes, no = map(self.compile, args)
+        def if_(frame, batch):
+            test = cond(frame, batch)
+            if not is_column(test):
+                if test:
+                    return yes(frame, batch)
+                else:
+                    return no(frame, batch)
+            yes_idx = []
+            no_idx = []
+            for i in batch.idx:
+                if test[i]:
+                    yes_idx.append(i)
+                else:
+                    no_idx.append(i)
+            if len(no_idx) == 0:
+                return yes(frame, batch)
+            if len(yes_idx) == 0:
+                return no(frame, batch)
+            out = Column([None] * batch.size)
+            for (idx, branch) in ((yes_idx, yes), (no_idx, no)):
+                value = branch(frame, batch.sub(idx))
+                if is_column(value):
+                    for i in idx:
+                        out[i] = value[i]
+                else:
+                    for i in idx:
+                        out[i] = value
+            return out
+        return if_
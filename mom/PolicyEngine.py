@@ -31,6 +31,8 @@ class PolicyEngine(threading.Thread):
         self.config = config
         self.logger = logging.getLogger('mom.PolicyEngine')
         self.policy_sem = threading.Semaphore()
+        self.controllers = []
+        self.policy_fields = None
         self.properties = {
             'hypervisor_iface': hypervisor_iface,
             'host_monitor': host_monitor,
@@ -58,20 +60,53 @@ class PolicyEngine(threading.Thread):
 
     def load_policy(self, str):
         ret = True
+        specified = True
         if str is None or str == "":
             self.logger.warn('%s: No policy specified.', self.getName())
             str = "0" # XXX: Parser should accept an empty program
+            specified = False
 
         try:
-            new_pol = Policy(str)
+            compiled = self.config.getboolean('main', 'policy-compile')
+            optimized = self.config.getboolean('main', 'policy-optimize')
+            profile_ticks = self.config.getint('main', 'policy-profile-ticks')
+            new_pol = Policy(str, compiled, optimized, profile_ticks)
         except PolicyError as e:
             self.logger.warn("Unable to load policy: %s" % e)
             return False
         self.policy_sem.acquire()
         self.policy = new_pol
         self.policy_sem.release()
+        # Without a policy, statistics are only collected to be reported so
+        # keep them all current
+        if specified:
+            self.policy_fields = new_pol.get_fields()
+        else:
+            self.policy_fields = None
+        self.update_field_usage()
         return True
 
+    def update_field_usage(self):
+        """
+        Tell the monitors which statistics are read by the policy and the
+        controllers so they can collect the others less often
+        """
+        fields = self.policy_fields
+        if fields is not None:
+            fields = set(fields)
+            for c in self.controllers:
+                # A controller that doesn't say what it reads could read
+                # anything
+                controller_fields = getattr(c, 'fields', None)
+                if controller_fields is None:
+                    fields = None
+                    break
+                fields |= controller_fields
+        if fields is not None:
+            self.logger.debug("Statistics in use: %s", sorted(fields))
+        self.properties['host_monitor'].set_used_fields(fields)
+        self.properties['guest_manager'].set_used_fields(fields)
+
     def rpc_get_policy(self):
         self.policy_sem.acquire()
         if self.policy is not None:
@@ -84,6 +119,16 @@ class PolicyEngine(threading.Thread):
     def rpc_set_policy(self, str):
         return self.load_policy(str)
 
+    def rpc_get_policy_profile(self):
+        self.policy_sem.acquire()
+        profile = None
+        if self.policy is not None:
+            profile = self.policy.get_profile()
+        self.policy_sem.release()
+        if profile is None:
+            return {}
+        return profile
+
     def get_controllers(self):
         """
         Initialize the Controllers called for in the config file.
@@ -101,6 +146,7 @@ class PolicyEngine(threading.Thread):
                 self.logger.warn("Unable to import controller: %s", name)
                 continue
             self.controllers.append(module.instance(self.properties))
+        self.update_field_usage()
 
     def do_controls(self):
         """
@@ -0,0 +1,206 @@
+# Memory Overcommitment Manager
+# Copyright (C) 2010 Adam Litke, IBM Corporation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public
+# License along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+
+import threading
+import time
+import logging
+import Queue
+
+class TimerWheel(object):
+    """
+    A hashed timing wheel.  Timers are kept in a ring of buckets, one per tick
+    of the given resolution, so adding a timer and advancing the clock take
+    constant time per timer.  Timers further in the future than one turn of the
+    wheel stay in their bucket until their tick comes around.
+    """
+    def __init__(self, resolution, slots, now=None):
+        if now is None:
+            now = time.time()
+        self.resolution = resolution
+        self.buckets = [ [] for i in range(slots) ]
+        # The last tick that has been processed
+        self.tick = self._tick(now)
+
+    def _tick(self, when):
+        return int(when / self.resolution)
+
+    def add(self, when, item):
+        """
+        Schedule item to expire at time when
+        """
+        tick = max(self._tick(when), self.tick + 1)
+        self.buckets[tick % len(self.buckets)].append((tick, item))
+
+    def advance(self, now):
+        """
+        Advance the clock to now.
+        Return: The list of expired items, in no particular order
+        """
+        now_tick = self._tick(now)
+        if now_tick <= self.tick:
+            return []
+        expired = []
+        # After a long pause, every bucket only needs to be checked once
+        count = min(now_tick - self.tick, len(self.buckets))
+        for tick in xrange(now_tick - count + 1, now_tick + 1):
+            bucket = self.buckets[tick % len(self.buckets)]
+            if len(bucket) == 0:
+                continue
+            remaining = []
+            for entry in bucket:
+                if entry[0] <= now_tick:
+                    expired.append(entry[1])
+                else:
+                    remaining.append(entry)
+            self.buckets[tick % len(self.buckets)] = remaining
+        self.tick = now_tick
+        return expired
+
+class Job(object):
+    """
+    A periodic job.  Each run has a deadline: the time of the following run.
+    A run that has not started by then is skipped.  The next run is scheduled
+    when a run finishes, so a job never runs on two workers at once.
+    """
+    def __init__(self, key, fn, interval, alive):
+        self.key = key
+        self.fn = fn
+        self.interval = interval
+        self.alive = alive
+        self.due = 0
+        self.deadline = 0
+        self.cancelled = False
+
+class Scheduler(threading.Thread):
+    """
+    The Scheduler runs periodic jobs on a bounded pool of worker threads.  The
+    scheduler thread itself only moves a timer wheel forward and hands jobs
+    that are due to the workers.
+    """
+    resolution = 0.25
+    slots = 256
+
+    def __init__(self, name, nr_workers):
+        threading.Thread.__init__(self, name=name)
+        self.setDaemon(True)
+        self.logger = logging.getLogger('mom.Scheduler')
+        self.lock = threading.Lock()
+        self.wheel = TimerWheel(self.resolution, self.slots)
+        self.jobs = {}
+        self.queue = Queue.Queue()
+        self.running = True
+        # Runs skipped because they started after their deadline
+        self.missed = 0
+        self.workers = []
+        for i in range(nr_workers):
+            worker = threading.Thread(target=self._worker,
+                                      name="%s-worker-%i" % (name, i))
+            worker.setDaemon(True)
+            self.workers.append(worker)
+
+    def add(self, key, fn, interval, alive=None):
+        """
+        Run fn every interval seconds, starting now.  If alive is given, the
+        job is dropped as soon as alive() returns False.
+        """
+        job = Job(key, fn, interval, alive)
+        job.due = time.time()
+        self.lock.acquire()
+        if key in self.jobs:
+            self.jobs[key].cancelled = True
+        self.jobs[key] = job
+        self.wheel.add(job.due, job)
+        self.lock.release()
+
+    def remove(self, key):
+        self.lock.acquire()
+        job = self.jobs.pop(key, None)
+        if job is not None:
+            job.cancelled = True
+        self.lock.release()
+
+    def _drop(self, job):
+        """
+        Remove a job unless it has already been replaced by another job with
+        the same key.
+        """
+        self.lock.acquire()
+        if self.jobs.get(job.key) is job:
+            del self.jobs[job.key]
+        job.cancelled = True
+        self.lock.release()
+
+    def _reschedule(self, job, now):
+        """
+        Schedule the next run of a job.  Keep the job's phase unless runs have
+        been missed.
+        """
+        job.due += job.interval
+        if job.due < now:
+            job.due = now
+        self.lock.acquire()
+        if not job.cancelled:
+            self.wheel.add(job.due, job)
+        self.lock.release()
+
+    def _dispatch(self, now):
+        self.lock.acquire()
+        expired = self.wheel.advance(now)
+        self.lock.release()
+        for job in expired:
+            if job.cancelled:
+                continue
+            job.deadline = job.due + job.interval
+            self.queue.put(job)
+
+    def _worker(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                break
+            if job.cancelled:
+                continue
+            if job.alive is not None and not job.alive():
+                self._drop(job)
+                continue
+            now = time.time()
+            if now > job.deadline:
+                self.missed += 1
+                self.logger.warn("%s: run skipped, %.1fs late", job.key,
+                                 now - job.due)
+            else:
+                try:
+                    job.fn()
+                except Exception, e:
+                    self.logger.error("%s: unexpected error: %s", job.key, e)
+                if time.time() > job.deadline:
+                    self.logger.warn("%s: run took longer than %is", job.key,
+                                     job.interval)
+            self._reschedule(job, time.time())
+
+    def run(self):
+        for worker in self.workers:
+            worker.start()
+        while self.running:
+            self._dispatch(time.time())
+            time.sleep(self.resolution)
+        for worker in self.workers:
+            self.queue.put(None)
+        for worker in self.workers:
+            worker.join()
+
+    def stop(self):
+        self.running = False
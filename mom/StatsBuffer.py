@@ -0,0 +1,320 @@
+# Memory Overcommitment Manager
+# Copyright (C) 2010 Adam Litke, IBM Corporation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public
+# License along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+
+import threading
+from array import array
+from collections import deque
+
+class StatsExpired(Exception):
+    def __init__(self, message):
+        self.message = message
+
+    def __str__(self):
+        return self.message
+
+# Array type codes for the Python types that can be stored compactly
+typecodes = { int: 'l', float: 'd' }
+
+# Types that window aggregates can be computed for
+numeric_types = (int, long, float)
+
+def ewma(values, alpha):
+    """
+    Calculate the exponentially weighted moving average of a sequence
+    """
+    avg = None
+    for value in values:
+        if avg is None:
+            avg = float(value)
+        else:
+            avg = alpha * value + (1 - alpha) * avg
+    return avg
+
+class WindowAggregate(object):
+    """
+    Running aggregates of one field over the samples in the history window.
+    The minimum and maximum are kept in monotonic deques of (seq, value) so
+    that the oldest entry is always the answer.  The number of floats in the
+    window is counted so that the sums can go back to being integers once the
+    last float has left it.
+    """
+    __slots__ = ('sum', 'sumsq', 'mins', 'maxs', 'floats')
+
+    def __init__(self):
+        self.sum = 0
+        self.sumsq = 0
+        self.mins = deque()
+        self.maxs = deque()
+        self.floats = 0
+
+    def add(self, seq, value, oldest):
+        """
+        Add sample number seq to the window.  Samples before oldest leave it.
+        """
+        self.sum += value
+        self.sumsq += value * value
+        if type(value) is float:
+            self.floats += 1
+        mins = self.mins
+        while len(mins) > 0 and mins[-1][1] >= value:
+            mins.pop()
+        mins.append((seq, value))
+        while mins[0][0] < oldest:
+            mins.popleft()
+        maxs = self.maxs
+        while len(maxs) > 0 and maxs[-1][1] <= value:
+            maxs.pop()
+        maxs.append((seq, value))
+        while maxs[0][0] < oldest:
+            maxs.popleft()
+
+    def remove(self, value):
+        self.sum -= value
+        self.sumsq -= value * value
+        if type(value) is float:
+            self.floats -= 1
+
+    def snapshot(self):
+        return (self.sum, self.sumsq, self.mins[0][1], self.maxs[0][1])
+
+class StatsBuffer(object):
+    """
+    A StatsBuffer holds the most recent samples collected by a Monitor.  It is
+    a fixed-capacity ring buffer stored column by column: each field has one
+    preallocated array and the field index, which maps field names to columns,
+    is shared by all samples.
+
+    The buffer keeps twice the configured history so that views handed out to
+    Entities remain valid while new samples are added.
+
+    For each numeric field, the buffer also maintains aggregates of the history
+    window as samples enter and leave it.  Views take a snapshot of them so
+    averages, extremes and deviations are available in constant time.
+    """
+    def __init__(self, fields, history):
+        self.fields = sorted(fields)
+        self.index = dict([ (name, i) for (i, name) in enumerate(self.fields) ])
+        self.history = history
+        self.capacity = 2 * history
+        # Columns are created when the type of their first value is known
+        self.columns = [ None ] * len(self.fields)
+        # None for fields that hold values of other types
+        self.aggregates = [ WindowAggregate() for name in self.fields ]
+        # The total number of samples appended to the buffer
+        self.seq = 0
+        self.lock = threading.Lock()
+
+    def append(self, data):
+        """
+        Add a sample.  data must contain a value for every field.
+        """
+        self.lock.acquire()
+        try:
+            self._append(data)
+        finally:
+            self.lock.release()
+
+    def _append(self, data):
+        if self.history == 0:
+            # A history length of 0 keeps no samples at all
+            return
+        slot = self.seq % self.capacity
+        # The sample that leaves the history window, if the window is full
+        old_slot = None
+        if self.seq >= self.history:
+            old_slot = (self.seq - self.history) % self.capacity
+        oldest = self.seq - self.history + 1
+        for (name, i) in self.index.items():
+            value = data[name]
+            agg = self.aggregates[i]
+            if agg is not None:
+                if type(value) not in numeric_types:
+                    self.aggregates[i] = None
+                else:
+                    if old_slot is not None:
+                        agg.remove(self.columns[i][old_slot])
+                    agg.add(self.seq, value, oldest)
+            column = self.columns[i]
+            if column is None:
+                column = self._new_column(type(value))
+                self.columns[i] = column
+            elif type(column) is not list and \
+                    typecodes.get(type(value)) != column.typecode:
+                # Values of other types are kept as they are
+                column = list(column)
+                self.columns[i] = column
+            column[slot] = value
+        self.seq += 1
+
+        # Running sums of floats accumulate rounding errors.  Recalculate them
+        # once per history length, and as soon as the window holds no floats so
+        # that the sums are exact integers again, as summing the window would
+        # give.
+        recalc = self.seq % self.history == 0
+        for (i, agg) in enumerate(self.aggregates):
+            if agg is not None and type(agg.sum) is float and \
+                    (recalc or agg.floats == 0):
+                values = self._window(i)
+                agg.sum = sum(values)
+                agg.sumsq = sum([ v * v for v in values ])
+
+    def _window(self, col):
+        return StatsView(self, max(0, self.seq - self.history), self.seq,
+                         []).column(self.fields[col])
+
+    def _new_column(self, value_type):
+        code = typecodes.get(value_type)
+        if code is None:
+            return [ None ] * self.capacity
+        return array(code, [ 0 ] * self.capacity)
+
+    def view(self):
+        """
+        Return: A StatsView of the last samples within the history length
+        """
+        self.lock.acquire()
+        try:
+            if self.seq == 0:
+                snapshot = []
+            else:
+                snapshot = [ agg and agg.snapshot() for agg in self.aggregates ]
+            return StatsView(self, max(0, self.seq - self.history), self.seq,
+                             snapshot)
+        finally:
+            self.lock.release()
+
+    def __len__(self):
+        return min(self.seq, self.history)
+
+class StatsView(object):
+    """
+    A read-only window onto a StatsBuffer.  A view behaves like a list of
+    sample dictionaries, oldest first, and also provides direct access to the
+    values of a single field.
+
+    Aggregates come from the snapshot taken when the view was created, or are
+    calculated from the samples for fields that have no running aggregates.
+    """
+    def __init__(self, buffer, start, end, aggregates):
+        self.buffer = buffer
+        self.start = start
+        self.end = end
+        self.aggregates = aggregates
+
+    def _check(self):
+        if self.buffer.seq - self.start > self.buffer.capacity:
+            raise StatsExpired("Statistics have been overwritten by newer "
+                               "samples")
+
+    def __len__(self):
+        return self.end - self.start
+
+    def __getitem__(self, i):
+        """
+        Return: The sample at position i as a dictionary
+        """
+        if i < 0:
+            i += len(self)
+        if i < 0 or i >= len(self):
+            raise IndexError("statistics index out of range")
+        self._check()
+        slot = (self.start + i) % self.buffer.capacity
+        row = {}
+        for (name, col) in self.buffer.index.items():
+            row[name] = self.buffer.columns[col][slot]
+        return row
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self[i]
+
+    def fields(self):
+        return self.buffer.fields
+
+    def latest(self, name):
+        """
+        Return: The most recent value of a field
+        """
+        if len(self) == 0:
+            raise IndexError("no statistics available")
+        self._check()
+        column = self.buffer.columns[self.buffer.index[name]]
+        return column[(self.end - 1) % self.buffer.capacity]
+
+    def column(self, name):
+        """
+        Return: A sequence of the values of a field, oldest first
+        """
+        self._check()
+        column = self.buffer.columns[self.buffer.index[name]]
+        capacity = self.buffer.capacity
+        first = self.start % capacity
+        last = first + len(self)
+        if last <= capacity:
+            return column[first:last]
+        return column[first:] + column[:last - capacity]
+
+    def _aggregate(self, name):
+        """
+        Return: The snapshot of the aggregates for a field or None
+        """
+        if len(self.aggregates) == 0:
+            return None
+        return self.aggregates[self.buffer.index[name]]
+
+    def sum(self, name):
+        agg = self._aggregate(name)
+        if agg is None:
+            return sum(self.column(name))
+        return agg[0]
+
+    def min(self, name):
+        agg = self._aggregate(name)
+        if agg is None:
+            return min(self.column(name))
+        return agg[2]
+
+    def max(self, name):
+        agg = self._aggregate(name)
+        if agg is None:
+            return max(self.column(name))
+        return agg[3]
+
+    def stddev(self, name):
+        """
+        Return: The population standard deviation of a field
+        """
+        n = len(self)
+        agg = self._aggregate(name)
+        if agg is None:
+            values = self.column(name)
+            total = sum(values)
+            sumsq = sum([ v * v for v in values ])
+        else:
+            total = agg[0]
+            sumsq = agg[1]
+        # Integer sums are exact, so only divide at the end
+        variance = float(n * sumsq - total * total) / (n * n)
+        return max(variance, 0.0) ** 0.5
+
+    def ewma(self, name, alpha):
+        """
+        Return: The exponentially weighted moving average of a field, seeded
+        with the oldest sample in the history.  Unlike the other aggregates it
+        depends on where the window starts, so it is calculated from the
+        samples each time.
+        """
+        return ewma(self.column(name), alpha)
@@ -0,0 +1,96 @@
+# Memory Overcommitment Manager
+# Copyright (C) 2010 Adam Litke, IBM Corporation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public
+# License along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+
+# Run from the top level directory with: python -m mom.TestGuestManager
+
+import unittest
+import time
+import ConfigParser
+from mom.GuestManager import GuestManager
+from mom.HypervisorInterfaces.fakeInterface import fakeInterface
+
+class TestGuestManager(unittest.TestCase):
+    def setUp(self):
+        config = ConfigParser.SafeConfigParser()
+        config.add_section('main')
+        config.set('main', 'guest-manager-interval', '1')
+        config.set('main', 'guest-reconcile-interval', '60')
+        config.set('main', 'guest-monitor-interval', '1')
+        config.set('main', 'guest-worker-threads', '2')
+        config.set('main', 'async-guest-collection', 'false')
+        config.set('main', 'sample-history-length', '10')
+        config.set('main', 'unused-collector-interval', '300')
+        config.add_section('guest')
+        config.set('guest', 'collectors', '')
+        config.add_section('__int__')
+        config.set('__int__', 'running', '1')
+        config.set('__int__', 'plot-subdir', '')
+        self.config = config
+        self.hypervisor = fakeInterface(config)
+
+    def tearDown(self):
+        self.config.set('__int__', 'running', '0')
+        self.manager.join(5)
+
+    def wait_for(self, fn):
+        for i in range(50):
+            if fn():
+                return True
+            time.sleep(0.1)
+        return False
+
+    def active(self):
+        return sorted(self.manager.rpc_get_active_guests())
+
+    def test_events(self):
+        self.hypervisor.startVm('existing', notify=False)
+        self.manager = GuestManager(self.config, self.hypervisor)
+        # Found by the first reconciliation
+        self.assertTrue(self.wait_for(lambda: self.active() == ['existing']))
+
+        # Events take effect well before the next reconciliation
+        new = self.hypervisor.startVm('new')
+        self.assertTrue(self.wait_for(lambda: 'new' in self.active()))
+        self.hypervisor.stopVm(new)
+        self.assertTrue(self.wait_for(lambda: self.active() == ['existing']))
+
+    def test_reconcile(self):
+        self.manager = GuestManager(self.config, self.hypervisor)
+        self.hypervisor.startVm('missed', notify=False)
+        self.assertEqual(self.active(), [])
+        self.manager.reconcile()
+        self.assertTrue(self.wait_for(lambda: self.active() == ['missed']))
+
+    def test_retry(self):
+        # The first lookup of a started guest fails
+        failures = []
+        get_info = self.hypervisor.getVmInfo
+        def flaky_info(id):
+            if id not in failures:
+                failures.append(id)
+                return None
+            return get_info(id)
+        self.hypervisor.getVmInfo = flaky_info
+        self.manager = GuestManager(self.config, self.hypervisor)
+        self.assertTrue(self.wait_for(lambda: self.manager.isAlive()))
+        time.sleep(0.5)
+        self.hypervisor.startVm('slow')
+        # Retried well before the next reconciliation
+        self.assertTrue(self.wait_for(lambda: self.active() == ['slow']))
+        self.assertEqual(len(failures), 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,144 @@
+# Memory Overcommitment Manager
+# Copyright (C) 2010 Adam Litke, IBM Corporation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public
+# License along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+
+# Run from the top level directory with: python -m mom.TestMonitor
+
+import unittest
+import time
+import threading
+import ConfigParser
+from mom.Monitor import Monitor
+from mom.Collectors.Collector import Collector
+from mom.CollectionEngine import CollectionEngine
+
+class CountingCollector(Collector):
+    """
+    Return the number of times collect() has been called as a field
+    """
+    def __init__(self, field, interval=0):
+        self.field = field
+        self.collect_interval = interval
+        self.count = 0
+
+    def collect(self):
+        self.count += 1
+        return { self.field: self.count }
+
+    def getFields(self=None):
+        return set([ self.field ])
+
+class TestMonitor(unittest.TestCase):
+    def setUp(self):
+        config = ConfigParser.SafeConfigParser()
+        config.add_section('main')
+        config.set('main', 'sample-history-length', '10')
+        config.set('main', 'unused-collector-interval', '300')
+        config.add_section('__int__')
+        config.set('__int__', 'plot-subdir', '')
+        self.monitor = Monitor(config, 'TestMonitor')
+        self.monitor.config = config
+        self.fast = CountingCollector('fast')
+        self.slow = CountingCollector('slow', interval=60)
+        self.monitor.collectors = [ self.fast, self.slow ]
+
+    def test_carry_forward(self):
+        for i in range(3):
+            self.monitor.collect()
+        self.assertEqual((self.fast.count, self.slow.count), (3, 1))
+        entity = self.monitor.interrogate()
+        self.assertEqual((entity.Stat('fast'), entity.Stat('slow')), (3, 1))
+        self.assertEqual(entity.StatAge('fast'), 0)
+        self.assertTrue(entity.StatAge('slow') > 0)
+
+        # Once its interval has passed the slow collector runs again
+        self.monitor.carried[1] = (self.monitor.carried[1][0], 0)
+        self.monitor.collect()
+        self.assertEqual((self.fast.count, self.slow.count), (4, 2))
+        self.assertEqual(self.monitor.interrogate().StatAge('slow'), 0)
+
+    def test_unused_fields(self):
+        self.monitor.set_used_fields(set([ 'slow' ]))
+        self.assertEqual(self.monitor.get_active_collectors(),
+                         [ 'CountingCollector' ])
+        for i in range(3):
+            self.monitor.collect()
+        self.assertEqual((self.fast.count, self.slow.count), (1, 1))
+        self.assertEqual(self.monitor.interrogate().Stat('fast'), 1)
+
+        # A new policy that reads the field runs the collector again
+        self.monitor.set_used_fields(None)
+        self.monitor.collect()
+        self.assertEqual(self.fast.count, 2)
+
+    def test_carry_forward_async(self):
+        engine = CollectionEngine('TestEngine', 1, 1)
+        engine.start()
+        try:
+            for i in range(3):
+                self.monitor.collect_async(engine)
+                for j in range(50):
+                    if not self.monitor.pending:
+                        break
+                    time.sleep(0.01)
+        finally:
+            engine.stop()
+            engine.join()
+        self.assertEqual((self.fast.count, self.slow.count), (3, 1))
+        self.assertEqual(self.monitor.interrogate().Stat('fast'), 3)
+
+class HungCollector(Collector):
+    """
+    Block in collect() until released
+    """
+    def __init__(self):
+        self.release = threading.Event()
+        self.count = 0
+
+    def collect(self):
+        self.count += 1
+        self.release.wait()
+        return {}
+
+class TestCollectionEngine(unittest.TestCase):
+    def collect(self, engine, collector):
+        results = []
+        done = threading.Event()
+        def callback(data, error):
+            results.append((data, error))
+            done.set()
+        engine.submit(collector, callback)
+        done.wait(5)
+        return results[0]
+
+    def test_hung_collector(self):
+        engine = CollectionEngine('TestEngine', 2, 0.2)
+        engine.start()
+        hung = HungCollector()
+        try:
+            for i in range(3):
+                (data, error) = self.collect(engine, hung)
+                self.assertTrue(error is not None)
+            # The hung collector only holds one of the executors
+            self.assertEqual(hung.count, 1)
+            fast = CountingCollector('fast')
+            self.assertEqual(self.collect(engine, fast), ({ 'fast': 1 }, None))
+        finally:
+            hung.release.set()
+            engine.stop()
+            engine.join()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,90 @@
+# Memory Overcommitment Manager
+# Copyright (C) 2010 Adam Litke, IBM Corporation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public
+# License along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+
+# Run from the top level directory with: python -m mom.TestScheduler
+
+import unittest
+import time
+import threading
+from mom.Scheduler import TimerWheel, Job, Scheduler
+
+class TestTimerWheel(unittest.TestCase):
+    def test_expiry_order(self):
+        wheel = TimerWheel(1, 8, now=0)
+        for (when, item) in ((3, 'c'), (1, 'a'), (2, 'b'), (20, 'far')):
+            wheel.add(when, item)
+        self.assertEqual(wheel.advance(0), [])
+        expired = []
+        for now in range(1, 4):
+            expired.append(wheel.advance(now))
+        self.assertEqual(expired, [ [ 'a' ], [ 'b' ], [ 'c' ] ])
+
+        # A timer more than one turn away stays in its bucket until its tick
+        self.assertEqual(wheel.advance(12), [])
+        self.assertEqual(wheel.advance(20), [ 'far' ])
+
+    def test_long_pause(self):
+        wheel = TimerWheel(1, 8, now=0)
+        for when in range(1, 6):
+            wheel.add(when, when)
+        self.assertEqual(sorted(wheel.advance(100)), [ 1, 2, 3, 4, 5 ])
+        # Timers in the past expire on the next tick
+        wheel.add(50, 'late')
+        self.assertEqual(wheel.advance(101), [ 'late' ])
+
+class TestScheduler(unittest.TestCase):
+    def run_worker(self, scheduler, jobs):
+        """
+        Run the given jobs on a worker in this thread
+        """
+        for job in jobs:
+            scheduler.queue.put(job)
+        scheduler.queue.put(None)
+        scheduler._worker()
+
+    def test_overdue(self):
+        scheduler = Scheduler('TestScheduler', 1)
+        runs = []
+        now = time.time()
+        job = Job('late', lambda: runs.append(1), 10, None)
+        # The run should have started before its deadline 20 seconds ago
+        job.due = now - 30
+        job.deadline = now - 20
+        self.run_worker(scheduler, [ job ])
+        self.assertEqual((runs, scheduler.missed), ([], 1))
+        # Missed runs are not made up for
+        self.assertTrue(job.due >= now)
+
+        job.deadline = job.due + job.interval
+        self.run_worker(scheduler, [ job ])
+        self.assertEqual((runs, scheduler.missed), ([ 1 ], 1))
+        # The next run keeps the phase of the job
+        self.assertEqual(job.due, job.deadline)
+
+    def test_shutdown(self):
+        scheduler = Scheduler('TestScheduler', 2)
+        ran = threading.Event()
+        scheduler.add('job', ran.set, 1)
+        scheduler.start()
+        self.assertTrue(ran.wait(2))
+        scheduler.stop()
+        scheduler.join(2)
+        self.assertFalse(scheduler.isAlive())
+        for worker in scheduler.workers:
+            self.assertFalse(worker.isAlive())
+
+if __name__ == '__main__':
+    unittest.main()
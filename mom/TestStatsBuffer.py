@@ -0,0 +1,129 @@
+# Memory Overcommitment Manager
+# Copyright (C) 2010 Adam Litke, IBM Corporation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public
+# License along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+
+# Run from the top level directory with: python -m mom.TestStatsBuffer
+
+import unittest
+from mom.Entity import Entity
+from mom.StatsBuffer import StatsBuffer, StatsExpired, ewma
+
+class TestStatsBuffer(unittest.TestCase):
+    def entity(self, buffer):
+        e = Entity()
+        e._set_statistics(buffer.view())
+        e._finalize()
+        return e
+
+    def test_wraparound(self):
+        buffer = StatsBuffer([ 'x', 'y' ], 3)
+        for i in range(10):
+            buffer.append({ 'x': i, 'y': -i })
+        view = buffer.view()
+        self.assertEqual((len(buffer), len(view)), (3, 3))
+        self.assertEqual(list(view), [ { 'x': 7, 'y': -7 },
+                                       { 'x': 8, 'y': -8 },
+                                       { 'x': 9, 'y': -9 } ])
+        self.assertEqual(view[-1], { 'x': 9, 'y': -9 })
+        self.assertEqual(list(view.column('x')), [ 7, 8, 9 ])
+        self.assertEqual(view.latest('y'), -9)
+        self.assertRaises(IndexError, lambda: view[3])
+
+    def test_expired(self):
+        buffer = StatsBuffer([ 'x' ], 3)
+        for i in range(3):
+            buffer.append({ 'x': i })
+        view = buffer.view()
+        # The view stays valid for one more history length
+        for i in range(3):
+            buffer.append({ 'x': 10 + i })
+        self.assertEqual(list(view.column('x')), [ 0, 1, 2 ])
+        self.assertEqual(view.sum('x'), 3)
+        buffer.append({ 'x': 20 })
+        self.assertRaises(StatsExpired, view.column, 'x')
+        self.assertRaises(StatsExpired, view.latest, 'x')
+        self.assertRaises(StatsExpired, lambda: view[0])
+
+    def test_column_types(self):
+        buffer = StatsBuffer([ 'x', 'name' ], 3)
+        buffer.append({ 'x': 1, 'name': 'a' })
+        buffer.append({ 'x': 2, 'name': 'b' })
+        # An int column holds floats once one arrives
+        buffer.append({ 'x': 2.5, 'name': 'c' })
+        view = buffer.view()
+        self.assertEqual(list(view.column('x')), [ 1, 2, 2.5 ])
+        self.assertEqual(type(view.latest('x')), float)
+        self.assertEqual(list(view.column('name')), [ 'a', 'b', 'c' ])
+        self.assertEqual((view.sum('x'), view.min('x'), view.max('x')),
+                         (5.5, 1, 2.5))
+
+        # and goes back to ints
+        for x in (4, 5, 6):
+            buffer.append({ 'x': x, 'name': 'd' })
+        view = buffer.view()
+        self.assertEqual(list(view.column('x')), [ 4, 5, 6 ])
+        self.assertEqual(type(view.sum('x')), int)
+        # Aggregates of other types are calculated from the samples
+        self.assertEqual(view.max('name'), 'd')
+
+    def test_ewma(self):
+        buffer = StatsBuffer([ 'x' ], 4)
+        for x in (1, 5, 2, 8, 3, 7):
+            buffer.append({ 'x': x })
+        e = self.entity(buffer)
+        first = e.StatEWMA('x', 0.5)
+        self.assertEqual(first, ewma([ 2, 8, 3, 7 ], 0.5))
+        self.assertEqual(e.StatEWMA('x', 0.5), first)
+
+        # Only the samples in the window count once it has moved on
+        buffer.append({ 'x': 4 })
+        self.assertEqual(self.entity(buffer).StatEWMA('x', 0.5),
+                         ewma([ 8, 3, 7, 4 ], 0.5))
+        self.assertEqual(e.StatEWMA('x', 0.5), first)
+
+    def check_window(self, buffer, window):
+        e = self.entity(buffer)
+        total = 0
+        for x in window:
+            total = total + x
+        mean = float(total) / len(window)
+        variance = sum([ (x - mean) ** 2 for x in window ]) / len(window)
+        self.assertEqual(e.StatAvg('x'), float(total / len(window)))
+        self.assertEqual((e.StatMin('x'), e.StatMax('x')),
+                         (min(window), max(window)))
+        self.assertAlmostEqual(e.StatStdDev('x'), variance ** 0.5)
+
+    def test_window_aggregates(self):
+        samples = [ 3, 9, -4, 2.5, 7, 11, -36, 18, 5, 5, 0.25, -1, 6, 2, 8 ]
+        buffer = StatsBuffer([ 'x' ], 3)
+        # The ring buffer wraps around several times
+        for i in range(len(samples)):
+            buffer.append({ 'x': samples[i] })
+            self.check_window(buffer, samples[max(0, i - 2):i + 1])
+
+        # Integer division once the last float has left the window
+        buffer = StatsBuffer([ 'x' ], 3)
+        for x in (1.5, 11, -36, 18):
+            buffer.append({ 'x': x })
+        self.assertEqual(self.entity(buffer).StatAvg('x'), -3.0)
+
+    def test_no_history(self):
+        buffer = StatsBuffer([ 'x' ], 0)
+        buffer.append({ 'x': 1 })
+        self.assertEqual(len(buffer), 0)
+        self.assertEqual(self.entity(buffer).Stat('x'), None)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -20,11 +20,11 @@ class MOM:
         # Start threads
         self.logger.info("MOM starting")
         self.config.set('__int__', 'running', '1')
-        host_monitor = HostMonitor(self.config)
         hypervisor_iface = self.get_hypervisor_interface()
         if not hypervisor_iface:
             self.shutdown()
         guest_manager = GuestManager(self.config, hypervisor_iface)
+        host_monitor = HostMonitor(self.config, guest_manager)
         policy_engine = PolicyEngine(self.config, hypervisor_iface, host_monitor, \
                                      guest_manager)
 
@@ -62,8 +62,13 @@ class MOM:
         self.config.set('main', 'main-loop-interval', '5')
         self.config.set('main', 'host-monitor-interval', '5')
         self.config.set('main', 'guest-manager-interval', '5')
+        self.config.set('main', 'guest-reconcile-interval', '60')
         self.config.set('main', 'hypervisor-interface', 'libvirt')
         self.config.set('main', 'guest-monitor-interval', '5')
+        self.config.set('main', 'guest-worker-threads', '4')
+        self.config.set('main', 'async-guest-collection', 'false')
+        self.config.set('main', 'collector-timeout', '5')
+        self.config.set('main', 'unused-collector-interval', '0')
         self.config.set('main', 'policy-engine-interval', '10')
         self.config.set('main', 'sample-history-length', '10')
         self.config.set('main', 'libvirt-hypervisor-uri', '')
@@ -71,6 +76,9 @@ class MOM:
         self.config.set('main', 'plot-dir', '')
         self.config.set('main', 'rpc-port', '-1')
         self.config.set('main', 'policy', '')
+        self.config.set('main', 'policy-compile', 'true')
+        self.config.set('main', 'policy-optimize', 'true')
+        self.config.set('main', 'policy-profile-ticks', '0')
         self.config.add_section('logging')
         self.config.set('logging', 'log', 'stdio')
         self.config.set('logging', 'verbosity', 'info')